@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported after Django is set up, since the engine uses its models
+from radar.asgi import RadarApplication  # noqa: E402
+
+application = RadarApplication(django_application)
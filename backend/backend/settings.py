@@ -28,6 +28,23 @@ DEBUG = bool(int(os.environ.get('DJANGO_DEBUG', 0)))
 ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS').split(',')
 
 REDIS_HOSTNAME = os.environ.get('REDIS_HOSTNAME', 'localhost')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+# path to the Redis unix socket, used instead of the hostname and port if set
+REDIS_UNIX_SOCKET = os.environ.get('REDIS_UNIX_SOCKET')
+# all the connections are shared by the process; when all of them are in use,
+# clients wait for REDIS_POOL_TIMEOUT seconds for one to be released
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 5))
+REDIS_SOCKET_CONNECT_TIMEOUT = \
+    float(os.environ.get('REDIS_SOCKET_CONNECT_TIMEOUT', 5))
+REDIS_SOCKET_KEEPALIVE = bool(int(os.environ.get('REDIS_SOCKET_KEEPALIVE', 1)))
+# 'redis', or 'memory' to keep bodies in the process itself instead of Redis,
+# which only works with a single process (e.g. for development and tests)
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'redis')
+# zones served to clients are advanced once every ZONE_TICK_INTERVAL seconds,
+# no matter how many clients watch them
+ZONE_TICK_INTERVAL = float(os.environ.get('ZONE_TICK_INTERVAL', 0.5))
 
 # Application definition
 
@@ -16,6 +16,9 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from radar import views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('health/scripts/', views.scripts_health),
 ]
@@ -0,0 +1,43 @@
+from backend import settings
+from caching.connections import AsyncRedisConnections, RedisConnections
+from caching.memory import MemoryBackend
+from caching.scripts import AsyncRedisScriptsPool, RedisScriptsPool
+
+
+MEMORY = 'memory'
+REDIS = 'redis'
+
+
+def get_client():
+    """Get a client with the interface of redis.Redis"""
+    if _uses_memory():
+        return MemoryBackend().store
+    return RedisConnections().redis()
+
+
+def get_async_client():
+    """Get a client with the interface of redis.asyncio.Redis"""
+    if _uses_memory():
+        return MemoryBackend().async_store
+    return AsyncRedisConnections().redis()
+
+
+def get_scripts_pool():
+    """Get a pool with the interface of RedisScriptsPool"""
+    if _uses_memory():
+        return MemoryBackend().scripts
+    return RedisScriptsPool()
+
+
+def get_async_scripts_pool():
+    """Get a pool with the interface of AsyncRedisScriptsPool"""
+    if _uses_memory():
+        return MemoryBackend().async_scripts
+    return AsyncRedisScriptsPool()
+
+
+def _uses_memory() -> bool:
+    if settings.CACHE_BACKEND not in (MEMORY, REDIS):
+        raise ValueError(f'Unknown cache backend {settings.CACHE_BACKEND!r}, '
+                         f'expected {REDIS!r} or {MEMORY!r}')
+    return settings.CACHE_BACKEND == MEMORY
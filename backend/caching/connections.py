@@ -0,0 +1,125 @@
+import threading
+import time
+from typing import Any, Dict, NamedTuple
+
+from redis import (
+    BlockingConnectionPool, ConnectionError, Redis, UnixDomainSocketConnection
+)
+from redis import asyncio as aioredis
+
+from backend import settings
+from share.metaclasses import Singleton
+
+
+class ConnectionStats(NamedTuple):
+    max_connections: int
+    in_use: int
+    acquisitions: int
+    """Number of connections ever taken from the pool"""
+    waits: int
+    """Number of times the pool was exhausted and a client had to wait"""
+    timeouts: int
+    """Number of times a client gave up waiting for a connection"""
+    wait_time: float
+    """Total time clients spent waiting for connections (in seconds)"""
+
+
+class InstrumentedConnectionPool(BlockingConnectionPool):
+    """
+    Blocking connection pool that keeps track of how often it runs out
+    of connections
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._in_use = 0
+        self._acquisitions = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+
+    def get_connection(self, *args, **kwargs):
+        exhausted = self.pool.empty()
+        started = time.monotonic()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except ConnectionError:
+            with self._stats_lock:
+                if exhausted:
+                    self._waits += 1
+                    self._timeouts += 1
+                    self._wait_time += time.monotonic() - started
+            raise
+        with self._stats_lock:
+            self._in_use += 1
+            self._acquisitions += 1
+            if exhausted:
+                self._waits += 1
+                self._wait_time += time.monotonic() - started
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        with self._stats_lock:
+            self._in_use -= 1
+
+    def stats(self) -> ConnectionStats:
+        with self._stats_lock:
+            return ConnectionStats(self.max_connections, self._in_use,
+                                   self._acquisitions, self._waits,
+                                   self._timeouts, self._wait_time)
+
+
+class RedisConnections(metaclass=Singleton):
+    """
+    Factory of Redis clients sharing one connection pool per process,
+    configured with REDIS_* settings
+    """
+
+    def __init__(self):
+        self.pool = InstrumentedConnectionPool(**connection_kwargs())
+
+    def redis(self) -> Redis:
+        """Get a client using the shared connection pool"""
+        return Redis(connection_pool=self.pool)
+
+    def stats(self) -> ConnectionStats:
+        return self.pool.stats()
+
+
+class AsyncRedisConnections(metaclass=Singleton):
+    """
+    Same as RedisConnections, but for asyncio clients.
+    The pool must only be used from one event loop
+    """
+
+    def __init__(self):
+        self.pool = aioredis.BlockingConnectionPool(**connection_kwargs(
+            unix_connection_class=aioredis.UnixDomainSocketConnection))
+
+    def redis(self) -> aioredis.Redis:
+        """Get a client using the shared connection pool"""
+        return aioredis.Redis(connection_pool=self.pool)
+
+
+def connection_kwargs(unix_connection_class=UnixDomainSocketConnection
+                      ) -> Dict[str, Any]:
+    """
+    Connection pool arguments made from the settings, shared by all kinds
+    of pools so that they are configured the same way
+    """
+    kwargs = {
+        'max_connections': settings.REDIS_MAX_CONNECTIONS,
+        'timeout': settings.REDIS_POOL_TIMEOUT,
+        'socket_timeout': settings.REDIS_SOCKET_TIMEOUT,
+        'socket_connect_timeout': settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+    }
+    if settings.REDIS_UNIX_SOCKET:
+        kwargs['connection_class'] = unix_connection_class
+        kwargs['path'] = settings.REDIS_UNIX_SOCKET
+    else:
+        kwargs['host'] = settings.REDIS_HOSTNAME
+        kwargs['port'] = settings.REDIS_PORT
+        kwargs['socket_keepalive'] = settings.REDIS_SOCKET_KEEPALIVE
+    return kwargs
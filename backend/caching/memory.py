@@ -0,0 +1,505 @@
+import hashlib
+import json
+import queue
+import threading
+import time
+from fnmatch import fnmatchcase
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from share.metaclasses import Singleton
+
+
+Value = Union[str, bytes, int, float]
+
+
+class MemoryStore:
+    """
+    In-process data store with the few Redis data types and commands the
+    engine needs: strings with expiration time, hashes, sorted sets and
+    pub/sub channels.
+
+    Every command holds the store's lock, so a sequence of commands made
+    under the lock is atomic, just like a Lua script in Redis
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._strings: Dict[str, Tuple[bytes, Optional[float]]] = {}
+        self._hashes: Dict[str, Dict[str, bytes]] = {}
+        self._zsets: Dict[str, Dict[str, float]] = {}
+        self._subscribers: Dict[str, List[queue.Queue]] = {}
+        self._scripts: Set[str] = set()
+
+    # strings
+
+    def get(self, name: str) -> Optional[bytes]:
+        with self.lock:
+            record = self._live_string(name)
+            return record[0] if record else None
+
+    def set(self, name: str, value: Value, ex: Optional[float] = None,
+            px: Optional[float] = None) -> bool:
+        with self.lock:
+            ttl = ex if px is None else px / 1000
+            expires = time.monotonic() + ttl if ttl is not None else None
+            self._strings[name] = (_encode(value), expires)
+            return True
+
+    def mset(self, mapping: Dict[str, Value]) -> bool:
+        with self.lock:
+            for name, value in mapping.items():
+                self.set(name, value)
+            return True
+
+    def incr(self, name: str) -> int:
+        with self.lock:
+            record = self._live_string(name)
+            value = int(record[0]) + 1 if record else 1
+            self._strings[name] = (_encode(value), record and record[1])
+            return value
+
+    def pttl(self, name: str) -> int:
+        """Same as in Redis: -2 for missing keys, -1 for persistent ones"""
+        with self.lock:
+            record = self._live_string(name)
+            if record is None:
+                return -2 if not self.exists(name) else -1
+            if record[1] is None:
+                return -1
+            return int((record[1] - time.monotonic()) * 1000)
+
+    def expire(self, name: str, seconds: float) -> bool:
+        with self.lock:
+            record = self._live_string(name)
+            if record is None:
+                return False
+            self._strings[name] = (record[0], time.monotonic() + seconds)
+            return True
+
+    # keys
+
+    def exists(self, *names: str) -> int:
+        with self.lock:
+            return sum(1 for name in names
+                       if self._live_string(name) or name in self._hashes
+                       or name in self._zsets)
+
+    def delete(self, *names: str) -> int:
+        with self.lock:
+            deleted = 0
+            for name in names:
+                if self.exists(name):
+                    deleted += 1
+                for data in (self._strings, self._hashes, self._zsets):
+                    data.pop(name, None)
+            return deleted
+
+    def keys(self, pattern: str = '*') -> List[bytes]:
+        """Keys matching the glob-style pattern (fnmatch flavour of it)"""
+        with self.lock:
+            names = [name for name in self._strings
+                     if self._live_string(name)]
+            names += list(self._hashes) + list(self._zsets)
+            return [name.encode() for name in names
+                    if fnmatchcase(name, pattern)]
+
+    # hashes
+
+    def hget(self, name: str, key: str) -> Optional[bytes]:
+        with self.lock:
+            return self._hashes.get(name, {}).get(key)
+
+    def hset(self, name: str, key: str, value: Value) -> int:
+        with self.lock:
+            fields = self._hashes.setdefault(name, {})
+            is_new = key not in fields
+            fields[key] = _encode(value)
+            return int(is_new)
+
+    def hdel(self, name: str, *keys: str) -> int:
+        with self.lock:
+            fields = self._hashes.get(name, {})
+            deleted = 0
+            for key in keys:
+                if key in fields:
+                    del fields[key]
+                    deleted += 1
+            if not fields:
+                self._hashes.pop(name, None)
+            return deleted
+
+    def hexists(self, name: str, key: str) -> bool:
+        with self.lock:
+            return key in self._hashes.get(name, {})
+
+    def hgetall(self, name: str) -> Dict[bytes, bytes]:
+        with self.lock:
+            return {key.encode(): value
+                    for key, value in self._hashes.get(name, {}).items()}
+
+    # sorted sets
+
+    def zadd(self, name: str, mapping: Dict[str, float],
+             nx: bool = False, xx: bool = False) -> int:
+        with self.lock:
+            scores = self._zsets.setdefault(name, {})
+            added = 0
+            for member, score in mapping.items():
+                if (nx and member in scores) or (xx and member not in scores):
+                    continue
+                added += member not in scores
+                scores[member] = float(score)
+            if not scores:
+                del self._zsets[name]
+            return added
+
+    def zrem(self, name: str, *members: str) -> int:
+        with self.lock:
+            scores = self._zsets.get(name, {})
+            removed = sum(1 for member in members
+                          if scores.pop(member, None) is not None)
+            if not scores:
+                self._zsets.pop(name, None)
+            return removed
+
+    def zscore(self, name: str, member: str) -> Optional[float]:
+        with self.lock:
+            return self._zsets.get(name, {}).get(member)
+
+    def zcard(self, name: str) -> int:
+        with self.lock:
+            return len(self._zsets.get(name, {}))
+
+    def zrange(self, name: str, start: int, end: int,
+               withscores: bool = False) -> List:
+        """Members ordered by score, then lexicographically, like in Redis"""
+        with self.lock:
+            ordered = sorted(self._zsets.get(name, {}).items(),
+                             key=lambda item: (item[1], item[0]))
+            end = len(ordered) if end == -1 else end + 1
+            ordered = ordered[start:end]
+            if withscores:
+                return [(member.encode(), score) for member, score in ordered]
+            return [member.encode() for member, _ in ordered]
+
+    def zrangebyscore(self, name: str, low: float,
+                      high: float) -> List[bytes]:
+        with self.lock:
+            return [member for member, score
+                    in self.zrange(name, 0, -1, withscores=True)
+                    if low <= score <= high]
+
+    # pub/sub
+
+    def publish(self, channel: str, message: Value) -> int:
+        with self.lock:
+            subscribers = self._subscribers.get(channel, [])
+            for messages in subscribers:
+                messages.put({'type': 'message', 'pattern': None,
+                              'channel': channel.encode(),
+                              'data': _encode(message)})
+            return len(subscribers)
+
+    def pubsub(self, **kwargs) -> 'MemoryPubSub':
+        return MemoryPubSub(self, **kwargs)
+
+    # server
+
+    def pipeline(self, transaction: bool = True) -> 'MemoryPipeline':
+        return MemoryPipeline(self)
+
+    def script_load(self, script: str) -> str:
+        """
+        Remember the script by its hash, like Redis does. The scripts are
+        never run though, the memory scripts pool has them in Python
+        """
+        sha = hashlib.sha1(script.encode()).hexdigest()
+        with self.lock:
+            self._scripts.add(sha)
+        return sha
+
+    def script_exists(self, *shas: str) -> List[bool]:
+        with self.lock:
+            return [sha in self._scripts for sha in shas]
+
+    def _subscribe(self, channel: str, messages: queue.Queue):
+        with self.lock:
+            self._subscribers.setdefault(channel, []).append(messages)
+
+    def _unsubscribe(self, channel: str, messages: queue.Queue):
+        with self.lock:
+            subscribers = self._subscribers.get(channel, [])
+            if messages in subscribers:
+                subscribers.remove(messages)
+
+    def _live_string(self, name):
+        record = self._strings.get(name)
+        if record is not None and record[1] is not None \
+                and record[1] <= time.monotonic():
+            del self._strings[name]
+            return None
+        return record
+
+
+class MemoryPipeline:
+    """Commands queued to be run at once, atomically"""
+
+    def __init__(self, store: MemoryStore):
+        self._store = store
+        self._commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self._store, name)
+
+        def queue_command(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queue_command
+
+    def execute(self) -> List[Any]:
+        with self._store.lock:
+            results = [command(*args, **kwargs)
+                       for command, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+
+class MemoryPubSub:
+    """Subscription to channels of a memory store"""
+
+    def __init__(self, store: MemoryStore,
+                 ignore_subscribe_messages: bool = False):
+        self._store = store
+        self._ignore_subscribe_messages = ignore_subscribe_messages
+        self._messages = queue.Queue()
+        self._channels = []
+
+    def subscribe(self, *channels: str):
+        for channel in channels:
+            self._store._subscribe(channel, self._messages)
+            self._channels.append(channel)
+            if not self._ignore_subscribe_messages:
+                self._messages.put({'type': 'subscribe', 'pattern': None,
+                                    'channel': channel.encode(),
+                                    'data': len(self._channels)})
+
+    def get_message(self, timeout: float = 0.0) -> Optional[Dict]:
+        try:
+            return self._messages.get(timeout=timeout) if timeout \
+                else self._messages.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        for channel in self._channels:
+            self._store._unsubscribe(channel, self._messages)
+        self._channels = []
+
+
+class MemoryScriptsPool:
+    """
+    Pure Python implementation of the scripts of RedisScriptsPool, with the
+    same arguments and replies, run against a memory store
+    """
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+        self.manifest = {f'{name}.lua': getattr(self, name) for name in (
+            'get_by_pattern', 'update_records', 'update_registry',
+            'register_bodies', 'ping_bodies', 'migrate_body_keys',
+            'purge_bodies')}
+        """Scripts by the names of the Lua scripts they stand for"""
+        self.loads = 0
+
+    def register_from_volume(self, script_name: str):
+        """
+        Get the script standing for the Lua script with the name.
+        Only the scripts of the manifest exist in memory
+        """
+        if script_name not in self.manifest:
+            raise FileNotFoundError(f'There is no {script_name} in memory')
+        return self.manifest[script_name]
+
+    def versions(self) -> Dict[str, str]:
+        return {name: 'memory' for name in self.manifest}
+
+    def load(self):
+        pass
+
+    def reload(self, loads: int):
+        pass
+
+    def health_check(self) -> Dict[str, bool]:
+        return {name: True for name in self.manifest}
+
+    def get_by_pattern(self, keys: Sequence = (), args: Sequence = ()):
+        max_iterations, pattern = int(args[0]), args[1]
+        with self.store.lock:
+            # an iteration of SCAN finds 10 or less keys
+            names = self.store.keys(pattern)[:max_iterations * 10]
+            return [self.store.get(name.decode()) for name in names]
+
+    def update_records(self, keys: Sequence = (), args: Sequence = ()):
+        max_relevant_keys, pattern = int(args[0]), args[1]
+        keys = list(keys)
+        reply = {'dropped_keys': [], 'new_records': {}}
+        with self.store.lock:
+            keys_to_add = max_relevant_keys - len(keys)
+            for key in keys:
+                if not self.store.exists(key):
+                    reply['dropped_keys'].append(key)
+                    keys_to_add += 1
+            known = set(keys)
+            for name in self.store.keys(pattern):
+                if keys_to_add <= 0:
+                    break
+                name = name.decode()
+                if name not in known:
+                    reply['new_records'][name] = \
+                        self.store.get(name).decode()
+                    keys_to_add -= 1
+        return json.dumps(reply).encode()
+
+    def update_registry(self, keys: Sequence = (), args: Sequence = ()):
+        registry, expiry, generation, _, arrivals = keys
+        max_relevant_keys = int(args[0])
+        known_keys = list(args[1:])
+        reply = {'dropped_keys': [], 'new_records': {}, 'arrivals': []}
+        with self.store.lock:
+            self.purge_bodies(keys)
+            keys_to_add = max_relevant_keys - len(known_keys)
+            for key in known_keys:
+                if self.store.zscore(expiry, key) is None:
+                    reply['dropped_keys'].append(key)
+                    keys_to_add += 1
+            known = set(known_keys)
+            for key, arrival in self.store.zrange(arrivals, 0, -1,
+                                                  withscores=True):
+                if keys_to_add <= 0:
+                    break
+                key = key.decode()
+                if key not in known:
+                    reply['new_records'][key] = \
+                        self.store.hget(registry, key).decode()
+                    reply['arrivals'].append([key, arrival])
+                    keys_to_add -= 1
+            reply['generation'] = int(self.store.get(generation) or 0)
+            earliest = self.store.zrange(expiry, 0, 0, withscores=True)
+            reply['next_expiry'] = earliest[0][1] if earliest else None
+        return json.dumps(reply).encode()
+
+    def register_bodies(self, keys: Sequence = (), args: Sequence = ()):
+        registry, expiry, generation, channel, arrivals = keys
+        now = _now()
+        expires = now + float(args[0]) * 1000
+        added = {}
+        with self.store.lock:
+            for key, body in zip(args[1::2], args[2::2]):
+                self.store.hset(registry, key, body)
+                self.store.zadd(expiry, {key: expires})
+                self.store.zadd(arrivals, {key: now}, nx=True)
+                added[key] = _decode(body)
+            self.store.incr(generation)
+            if added:
+                self.store.publish(channel, json.dumps(
+                    {'added': added, 'arrived': now}))
+        return len(added)
+
+    def ping_bodies(self, keys: Sequence = (), args: Sequence = ()):
+        expiry, = keys
+        now = _now()
+        expires = now + float(args[0]) * 1000
+        pinged = []
+        with self.store.lock:
+            for key in args[1:]:
+                score = self.store.zscore(expiry, key)
+                if score is not None and score > now:
+                    self.store.zadd(expiry, {key: expires}, xx=True)
+                    pinged.append(1)
+                else:
+                    pinged.append(0)
+        return pinged
+
+    def migrate_body_keys(self, keys: Sequence = (), args: Sequence = ()):
+        registry, expiry, generation, channel, arrivals = keys
+        now = _now()
+        added = {}
+        with self.store.lock:
+            for name in self.store.keys(args[0]):
+                name = name.decode()
+                ttl = self.store.pttl(name)
+                body = self.store.get(name)
+                if ttl > 0 and body is not None:
+                    self.store.hset(registry, name, body)
+                    self.store.zadd(expiry, {name: now + ttl})
+                    self.store.zadd(arrivals, {name: now}, nx=True)
+                    self.store.delete(name)
+                    added[name] = body.decode()
+            for key in self.store.zrange(expiry, 0, -1):
+                self.store.zadd(arrivals, {key.decode(): now}, nx=True)
+            if added:
+                self.store.incr(generation)
+                self.store.publish(channel, json.dumps(
+                    {'added': added, 'arrived': now}))
+        return len(added)
+
+    def purge_bodies(self, keys: Sequence = (), args: Sequence = ()):
+        registry, expiry, generation, channel, arrivals = keys
+        with self.store.lock:
+            expired = self.store.zrangebyscore(expiry, float('-inf'), _now())
+            names = [key.decode() for key in expired]
+            if names:
+                self.store.hdel(registry, *names)
+                self.store.zrem(arrivals, *names)
+                self.store.zrem(expiry, *names)
+                self.store.incr(generation)
+                self.store.publish(channel, json.dumps({'expired': names}))
+        return expired
+
+
+class AsyncMemoryProxy:
+    """
+    Makes the methods of the wrapped memory object give coroutines,
+    so that it can be used in place of asyncio Redis clients and scripts
+    """
+
+    def __init__(self, wrapped, sync_methods: Sequence[str] = ()):
+        self._wrapped = wrapped
+        self._sync_methods = set(sync_methods)
+        """Methods that stay synchronous, as they are in asyncio objects"""
+
+    def __getattr__(self, name):
+        attribute = getattr(self._wrapped, name)
+        if not callable(attribute) or name in self._sync_methods:
+            return attribute
+
+        async def call(*args, **kwargs):
+            return attribute(*args, **kwargs)
+        return call
+
+
+class MemoryBackend(metaclass=Singleton):
+    """The memory store and scripts shared by the process"""
+
+    def __init__(self):
+        self.store = MemoryStore()
+        self.scripts = MemoryScriptsPool(self.store)
+        self.async_store = AsyncMemoryProxy(
+            self.store, sync_methods=['pipeline', 'pubsub'])
+        self.async_scripts = AsyncMemoryProxy(self.scripts,
+                                              sync_methods=['versions'])
+
+
+def _now() -> float:
+    """Current time in ms, as the scripts get it from Redis"""
+    return time.time() * 1000
+
+
+def _encode(value: Value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+def _decode(value: Value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
@@ -1,16 +1,72 @@
-import redis
-from backend import settings
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional, Sequence
+
+from redis.exceptions import NoScriptError, RedisError
+
+from caching.connections import AsyncRedisConnections, RedisConnections
 from share.metaclasses import Singleton
 
 
+logger = logging.getLogger(__name__)
+
+
+class ManifestScript:
+    """
+    Lua script run with EVALSHA by the hash of its source.
+    If Redis doesn't have the script (e.g. after a restart), all the scripts
+    of the pool are loaded again at once and the call is retried
+    """
+
+    def __init__(self, pool: 'RedisScriptsPool', name: str, source: str):
+        self.name = name
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+        self._pool = pool
+
+    def __call__(self, keys: Sequence = (), args: Sequence = ()):
+        loads = self._pool.loads
+        try:
+            return self._evalsha(keys, args)
+        except NoScriptError:
+            self._pool.reload(loads)
+            return self._evalsha(keys, args)
+
+    def _evalsha(self, keys, args):
+        return self._pool._redis.evalsha(self.sha, len(keys), *keys, *args)
+
+
+class AsyncManifestScript(ManifestScript):
+    """Same as ManifestScript, but calling it gives a coroutine"""
+
+    async def __call__(self, keys: Sequence = (), args: Sequence = ()):
+        loads = self._pool.loads
+        try:
+            return await self._evalsha(keys, args)
+        except NoScriptError:
+            await self._pool.reload(loads)
+            return await self._evalsha(keys, args)
+
+
 class RedisScriptsPool(metaclass=Singleton):
     """
-    An object for accessing scripts added to redis db
+    An object for accessing scripts added to redis db.
+
+    All the scripts are kept in a manifest and loaded into Redis together:
+    when the pool is created and whenever Redis turns out to miss any of them
     """
     redis_scripts_folder_address = '/scripts/redis/'
+    _script_class = ManifestScript
 
     def __init__(self):
-        self._redis = redis.Redis(host=settings.REDIS_HOSTNAME)
+        self._redis = self._make_redis()
+        self.manifest: Dict[str, ManifestScript] = {}
+        """Registered scripts by their file names"""
+        self.loads = 0
+        """Number of times the scripts were loaded into Redis"""
+        self._load_lock = threading.Lock()
         self.get_by_pattern = self.register_from_volume('get_by_pattern.lua')
         """
         Get values of all keys matching the specified pattern
@@ -33,12 +89,155 @@ class RedisScriptsPool(metaclass=Singleton):
                                to known keys  
         """
 
-    def register_from_volume(self, script_name: str):
+        self.update_registry = self.register_from_volume('update_registry.lua')
+        """
+        Same as update_records, but for bodies kept in the body registry
+        :param keys[1]: hash of body strings by body keys
+        :param keys[2]: sorted set of body keys scored by their expiry time
+        :param keys[3]: generation of the body set, bumped whenever bodies are
+                        added or removed
+        :param keys[4]: channel to publish body events to
+        :param keys[5]: sorted set of body keys scored by their arrival time
+        :param args[1]: the maximum number of live keys that have to be processed
+        :param args[2...]: all the already known keys
+        :returns json object reply: see update_records, plus
+            reply.arrivals: array of [key, arrival time] pairs of the new
+                            records, which are taken in the order the bodies
+                            arrived
+            reply.generation: generation of the body set the reply is based on
+            reply.next_expiry: the earliest expiry time (ms) among live bodies,
+                               or null if there are none
+        """
+
+        self.register_bodies = self.register_from_volume('register_bodies.lua')
+        """
+        Add bodies to the body registry or replace them there
+        :param keys: same as for update_registry
+        :param args[1]: body expiration time in seconds
+        :param args[2...]: body keys, each followed by its body string
+        """
+
+        self.ping_bodies = self.register_from_volume('ping_bodies.lua')
+        """
+        Reset expiration time of bodies in the body registry
+        :param keys[1]: sorted set of body keys scored by their expiry time
+        :param args[1]: body expiration time in seconds
+        :param args[2...]: body keys
+        :returns array with 1 for every pinged body and 0 for every body that
+                 has already expired
+        """
+
+        self.migrate_body_keys = \
+            self.register_from_volume('migrate_body_keys.lua')
+        """
+        Move bodies stored as separate keys into the body registry
+        and give arrival time to registered bodies that have none
+        :param keys: same as for update_registry
+        :param args[1]: pattern of the body keys
+        :returns number of moved bodies
+        """
+
+        self.purge_bodies = self.register_from_volume('purge_bodies.lua')
+        """
+        Remove expired bodies from the body registry
+        :param keys: same as for update_registry
+        :returns array of removed body keys
+        """
+
+        self._preload()
+
+    def register_from_volume(self, script_name: str) -> ManifestScript:
         """
         Register a Lua script from /scripts volume to the Redis db
         and return script callable
         """
         script_address = self.redis_scripts_folder_address + script_name
         with open(script_address, 'r') as script_file:
-            script = self._redis.register_script(script_file.read())
+            script = self._script_class(self, script_name, script_file.read())
+        self.manifest[script_name] = script
         return script
+
+    def versions(self) -> Dict[str, str]:
+        """Hashes of the registered scripts by their names"""
+        return {name: script.sha for name, script in self.manifest.items()}
+
+    def load(self):
+        """Load all the registered scripts into Redis in one round trip"""
+        pipeline = self._redis.pipeline(transaction=False)
+        for script in self.manifest.values():
+            pipeline.script_load(script.source)
+        pipeline.execute()
+        self.loads += 1
+
+    def reload(self, loads: int):
+        """
+        Load the scripts again unless it was already done after
+        the given number of loads
+        """
+        with self._load_lock:
+            if self.loads == loads:
+                logger.warning('Redis is missing scripts, reloading them')
+                self.load()
+
+    def health_check(self) -> Dict[str, bool]:
+        """Check which of the registered scripts Redis has, by their names"""
+        exists = self._redis.script_exists(
+            *(script.sha for script in self.manifest.values()))
+        return dict(zip(self.manifest, exists))
+
+    def _preload(self):
+        try:
+            self.load()
+        except RedisError:
+            logger.exception('Failed to load scripts into Redis, '
+                             'they will be loaded when they are first used')
+
+    @staticmethod
+    def _make_redis():
+        return RedisConnections().redis()
+
+
+class AsyncRedisScriptsPool(RedisScriptsPool):
+    """
+    Same as RedisScriptsPool, but the scripts are run with asyncio clients,
+    so calling a script gives a coroutine.
+
+    Scripts can't be loaded when the pool is created, so load has to be
+    awaited on startup
+    """
+    _script_class = AsyncManifestScript
+    _async_load_lock: Optional[asyncio.Lock] = None
+    _async_load_lock_loop = None
+
+    async def load(self):
+        pipeline = self._redis.pipeline(transaction=False)
+        for script in self.manifest.values():
+            pipeline.script_load(script.source)
+        await pipeline.execute()
+        self.loads += 1
+
+    async def reload(self, loads: int):
+        async with self._get_async_load_lock():
+            if self.loads == loads:
+                logger.warning('Redis is missing scripts, reloading them')
+                await self.load()
+
+    async def health_check(self) -> Dict[str, bool]:
+        exists = await self._redis.script_exists(
+            *(script.sha for script in self.manifest.values()))
+        return dict(zip(self.manifest, exists))
+
+    def _preload(self):
+        pass
+
+    def _get_async_load_lock(self) -> asyncio.Lock:
+        """Get the load lock of the running event loop, making it if needed"""
+        loop = asyncio.get_event_loop()
+        if self._async_load_lock_loop is not loop:
+            self._async_load_lock = asyncio.Lock()
+            self._async_load_lock_loop = loop
+        return self._async_load_lock
+
+    @staticmethod
+    def _make_redis():
+        return AsyncRedisConnections().redis()
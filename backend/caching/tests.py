@@ -1,10 +1,20 @@
+import asyncio
 import pytest
 import redis
 import json
 import os
+import time
 from backend import settings
 
-from caching.scripts import RedisScriptsPool
+from caching.backends import (
+    get_async_client, get_client, get_scripts_pool
+)
+from caching.connections import (
+    AsyncRedisConnections, InstrumentedConnectionPool, RedisConnections,
+    connection_kwargs
+)
+from caching.memory import MemoryBackend, MemoryScriptsPool, MemoryStore
+from caching.scripts import AsyncRedisScriptsPool, RedisScriptsPool
 
 
 @pytest.fixture
@@ -81,3 +91,342 @@ def test_update_records(scripts_pool, r):
 
     r.delete(*live_records.keys())
 
+
+@pytest.fixture
+def registry(r):
+    keys = ['test:registry', 'test:expiry', 'test:generation', 'test:events',
+            'test:arrivals']
+    yield keys
+    r.delete(*keys)
+
+
+def test_register_bodies(scripts_pool, r, registry):
+    records = {'test:a': '1', 'test:b': '2'}
+    registered = scripts_pool.register_bodies(
+        keys=registry, args=[10, *(item for record in records.items()
+                                   for item in record)])
+    assert registered == len(records)
+    assert {key.decode(): value.decode() for key, value
+            in r.hgetall(registry[0]).items()} == records
+    assert r.zcard(registry[1]) == len(records)
+    assert r.get(registry[2]) == b'1', 'Registering has to bump generation'
+
+
+def test_ping_bodies(scripts_pool, r, registry):
+    scripts_pool.register_bodies(keys=registry, args=[1, 'test:a', '1'])
+    expiry_before = r.zscore(registry[1], 'test:a')
+
+    pinged = scripts_pool.ping_bodies(keys=registry[1:],
+                                      args=[10, 'test:a', 'test:b'])
+    assert pinged == [1, 0]
+    assert r.zscore(registry[1], 'test:a') > expiry_before
+    assert r.zscore(registry[1], 'test:b') is None, \
+        'Pinging unknown bodies must not register them'
+
+
+def test_update_registry(scripts_pool, r, registry):
+    known_expired_keys = {'test:a', 'test:b'}
+    known_live_records = {'test:c': '1', 'test:d': '2'}
+    unknown_live_records = {'test:e': '3', 'test:f': '4', 'test:g': '5'}
+    live_records = {**known_live_records, **unknown_live_records}
+    known_keys = known_expired_keys | set(known_live_records.keys())
+
+    scripts_pool.register_bodies(
+        keys=registry, args=[10, *(item for record in live_records.items()
+                                   for item in record)])
+    r.hset(registry[0], 'test:a', '0')
+    r.zadd(registry[1], {'test:a': 0})
+
+    result1 = json.loads(scripts_pool.update_registry(
+        keys=registry, args=[len(known_keys), *known_keys]))
+    assert set(result1['dropped_keys']) == known_expired_keys, \
+        'Invalid handling of expired keys'
+    assert len(result1['new_records']) == len(known_expired_keys), \
+        'Wrong number of new records retrieved ' \
+        '(should just compensate for expired keys in this case)'
+    assert result1['new_records'].items() <= unknown_live_records.items(), \
+        'new_records is not a subset of unknown_live_records'
+    assert not r.hexists(registry[0], 'test:a'), \
+        'Expired bodies have to be removed from the registry'
+
+    assert result1['generation'] == int(r.get(registry[2])) == 2, \
+        'Expiry has to bump generation'
+    assert result1['next_expiry'] == \
+        r.zrange(registry[1], 0, 0, withscores=True)[0][1]
+
+    result2 = json.loads(scripts_pool.update_registry(
+        keys=registry, args=[len(live_records) + 1, *known_keys]))
+    assert result2['new_records'] == unknown_live_records, \
+        'Wrong new records retrieved ' \
+        '(should just retrieve all unknown_live_records in this case)'
+
+
+def test_update_registry_in_arrival_order(scripts_pool, r, registry):
+    for key in ('test:c', 'test:a', 'test:b'):
+        scripts_pool.register_bodies(keys=registry, args=[10, key, '1'])
+        # the arrival times differ
+        time.sleep(0.002)
+    scripts_pool.ping_bodies(keys=registry[1:], args=[20, 'test:c'])
+    scripts_pool.register_bodies(keys=registry, args=[10, 'test:c', '2'])
+
+    result = json.loads(scripts_pool.update_registry(
+        keys=registry, args=[2]))
+    assert [key for key, _ in result['arrivals']] == ['test:c', 'test:a'], \
+        'New records have to be taken in the order the bodies arrived'
+    assert result['new_records'] == {'test:c': '2', 'test:a': '1'}
+
+
+def test_purge_bodies(scripts_pool, r, registry):
+    scripts_pool.register_bodies(keys=registry, args=[10, 'test:a', '1'])
+    r.hset(registry[0], 'test:b', '2')
+    r.zadd(registry[1], {'test:b': 0})
+    events = r.pubsub(ignore_subscribe_messages=True)
+    events.subscribe(registry[3])
+    events.get_message(timeout=1)
+
+    assert scripts_pool.purge_bodies(keys=registry) == [b'test:b']
+    assert not r.hexists(registry[0], 'test:b')
+    assert r.zscore(registry[1], 'test:b') is None
+    message = events.get_message(timeout=1)
+    assert json.loads(message['data']) == {'expired': ['test:b']}, \
+        'Expired bodies have to be published'
+    events.close()
+
+
+def test_migrate_body_keys(scripts_pool, r, registry):
+    r.set('test:a', '1', ex=10)
+    r.set('test:b', '2')
+    moved = scripts_pool.migrate_body_keys(keys=registry, args=['test:*'])
+    assert moved == 1, 'Only keys with expiration time have to be moved'
+    assert r.hget(registry[0], 'test:a') == b'1'
+    assert r.zscore(registry[1], 'test:a') is not None
+    assert not r.exists('test:a')
+    r.delete('test:b')
+
+
+def test_connection_kwargs(monkeypatch):
+    monkeypatch.setattr(settings, 'REDIS_UNIX_SOCKET', None)
+    kwargs = connection_kwargs()
+    assert kwargs['host'] == settings.REDIS_HOSTNAME
+    assert kwargs['max_connections'] == settings.REDIS_MAX_CONNECTIONS
+
+    monkeypatch.setattr(settings, 'REDIS_UNIX_SOCKET', '/tmp/redis.sock')
+    kwargs = connection_kwargs()
+    assert kwargs['path'] == '/tmp/redis.sock' and 'host' not in kwargs, \
+        'Unix socket has to be used instead of the hostname'
+
+
+def test_connections_are_shared():
+    connections = RedisConnections()
+    assert connections.redis().connection_pool is \
+        RedisScriptsPool()._redis.connection_pool
+
+
+def test_connection_pool_stats():
+    pool = InstrumentedConnectionPool(max_connections=1, timeout=0.01,
+                                      host=settings.REDIS_HOSTNAME)
+    connection = pool.get_connection('PING')
+    with pytest.raises(redis.ConnectionError):
+        pool.get_connection('PING')
+    stats = pool.stats()
+    assert (stats.in_use, stats.acquisitions, stats.waits, stats.timeouts) \
+        == (1, 1, 1, 1), 'Pool exhaustion has to be counted'
+    assert stats.wait_time > 0
+
+    pool.release(connection)
+    pool.get_connection('PING')
+    stats = pool.stats()
+    assert (stats.in_use, stats.acquisitions, stats.waits) == (1, 2, 1)
+    pool.disconnect()
+
+
+def test_async_scripts(r):
+    r.set('test:async', 'value')
+
+    async def get_by_pattern():
+        try:
+            return await AsyncRedisScriptsPool().get_by_pattern(
+                args=[1000, 'test:async'])
+        finally:
+            await AsyncRedisConnections().pool.disconnect()
+    assert asyncio.run(get_by_pattern()) == [b'value']
+    r.delete('test:async')
+
+
+def test_scripts_manifest(scripts_pool, r):
+    assert scripts_pool.versions()['update_registry.lua'] == \
+        scripts_pool.update_registry.sha
+    assert all(scripts_pool.health_check().values()), \
+        'All the scripts have to be loaded when the pool is created'
+
+    r.set('test:manifest', 'value')
+    r.script_flush()
+    assert not any(scripts_pool.health_check().values())
+    loads = scripts_pool.loads
+    assert scripts_pool.get_by_pattern(args=[1000, 'test:manifest']) == \
+        [b'value']
+    assert scripts_pool.loads == loads + 1
+    assert all(scripts_pool.health_check().values()), \
+        'All the scripts have to be reloaded at once'
+
+    scripts_pool.reload(loads)
+    assert scripts_pool.loads == loads + 1, \
+        "Scripts that were already reloaded don't have to be loaded again"
+    r.delete('test:manifest')
+
+
+def test_async_scripts_reload(r, monkeypatch):
+    async def reload():
+        scripts_pool = AsyncRedisScriptsPool()
+        load = scripts_pool.load
+
+        async def slow_load():
+            # let the other callers run into the missing scripts meanwhile
+            await asyncio.sleep(0.01)
+            await load()
+        monkeypatch.setattr(scripts_pool, 'load', slow_load)
+        try:
+            await scripts_pool.load()
+            r.script_flush()
+            assert await scripts_pool.get_by_pattern(
+                args=[1000, 'test:manifest']) == [b'value']
+            healthy = await scripts_pool.health_check()
+
+            r.script_flush()
+            loads = scripts_pool.loads
+            results = await asyncio.gather(*(
+                scripts_pool.get_by_pattern(args=[1000, 'test:manifest'])
+                for _ in range(5)))
+            assert results == [[b'value']] * 5
+            assert scripts_pool.loads == loads + 1, \
+                'Concurrent callers have to reload the scripts only once'
+            return healthy
+        finally:
+            await AsyncRedisConnections().pool.disconnect()
+    r.set('test:manifest', 'value')
+    assert all(asyncio.run(reload()).values())
+    r.delete('test:manifest')
+
+
+@pytest.fixture
+def memory_scripts():
+    return MemoryScriptsPool(MemoryStore())
+
+
+@pytest.fixture
+def memory_registry():
+    # a fresh memory store is empty, so the keys don't need cleaning up
+    return ['test:registry', 'test:expiry', 'test:generation', 'test:events',
+            'test:arrivals']
+
+
+def test_memory_expiration():
+    store = MemoryStore()
+    store.set('test:a', '1', px=10)
+    store.set('test:b', '2')
+    assert store.get('test:a') == b'1' and 0 < store.pttl('test:a') <= 10
+    assert store.pttl('test:b') == -1
+    time.sleep(0.02)
+    assert store.get('test:a') is None and not store.exists('test:a')
+    assert store.pttl('test:a') == -2
+
+
+
+def test_memory_hdel():
+    store = MemoryStore()
+    store.hset('test:hash', 'empty', '')
+    store.hset('test:hash', 'full', '1')
+    assert store.hdel('test:hash', 'empty', 'empty', 'missing') == 1, \
+        'Fields have to be counted once they are deleted, like in Redis'
+    assert store.hdel('test:hash', 'full') == 1
+    assert not store.exists('test:hash')
+
+def test_memory_get_by_pattern(memory_scripts):
+    memory_scripts.store.mset({'test:a': '1', 'test:b': '2', 'other': '3'})
+    assert set(memory_scripts.get_by_pattern(args=[10, 'test:*'])) == \
+        {b'1', b'2'}
+
+
+def test_memory_update_records(memory_scripts):
+    store = memory_scripts.store
+    store.mset({'test:c': '1', 'test:d': '2', 'test:e': '3'})
+    store.set('test:a', '0', px=1)
+    time.sleep(0.01)
+
+    result = json.loads(memory_scripts.update_records(
+        keys=['test:a', 'test:c'], args=[2, 'test:*']))
+    assert result['dropped_keys'] == ['test:a'], \
+        'Expired keys have to be dropped'
+    assert len(result['new_records']) == 1
+    assert result['new_records'].items() <= {'test:d': '2',
+                                             'test:e': '3'}.items()
+
+    result = json.loads(memory_scripts.update_records(
+        keys=['test:c'], args=[10, 'test:*']))
+    assert result['new_records'] == {'test:d': '2', 'test:e': '3'}
+
+
+def test_memory_registry(memory_scripts, memory_registry):
+    store = memory_scripts.store
+    events = store.pubsub(ignore_subscribe_messages=True)
+    events.subscribe(memory_registry[3])
+    for key in ('test:b', 'test:a'):
+        memory_scripts.register_bodies(keys=memory_registry,
+                                       args=[10, key, key])
+        time.sleep(0.002)
+    assert json.loads(events.get_message()['data'])['added'] == \
+        {'test:b': 'test:b'}
+    store.zadd(memory_registry[1], {'test:b': 0})
+    assert memory_scripts.ping_bodies(keys=memory_registry[1:2],
+                                      args=[10, 'test:a', 'test:b']) == [1, 0]
+
+    result = json.loads(memory_scripts.update_registry(
+        keys=memory_registry, args=[10, 'test:b']))
+    assert result['dropped_keys'] == ['test:b']
+    assert [key for key, _ in result['arrivals']] == ['test:a']
+    assert result['new_records'] == {'test:a': 'test:a'}
+    assert result['generation'] == int(store.get(memory_registry[2])) == 3
+    assert result['next_expiry'] == store.zscore(memory_registry[1], 'test:a')
+    events.get_message()
+    assert json.loads(events.get_message()['data']) == \
+        {'expired': ['test:b']}, 'Expired bodies have to be published'
+    events.close()
+
+
+def test_memory_migrate_body_keys(memory_scripts, memory_registry):
+    store = memory_scripts.store
+    store.set('test:a', '1', ex=10)
+    store.set('test:b', '2')
+    assert memory_scripts.migrate_body_keys(keys=memory_registry,
+                                            args=['test:*']) == 1
+    assert store.hget(memory_registry[0], 'test:a') == b'1'
+    assert store.zscore(memory_registry[4], 'test:a') is not None
+    assert not store.exists('test:a') and store.exists('test:b')
+
+
+def test_memory_scripts_manifest(memory_scripts):
+    assert memory_scripts.register_from_volume('update_registry.lua') == \
+        memory_scripts.update_registry
+    with pytest.raises(FileNotFoundError):
+        memory_scripts.register_from_volume('test.lua')
+    assert set(memory_scripts.health_check()) == \
+        set(memory_scripts.versions()) == set(memory_scripts.manifest)
+
+    store = memory_scripts.store
+    sha = store.script_load('return 1')
+    assert store.script_exists(sha, 'unknown') == [True, False]
+
+
+def test_cache_backend_setting(monkeypatch):
+    monkeypatch.setattr(settings, 'CACHE_BACKEND', 'memory')
+    assert get_scripts_pool() is MemoryBackend().scripts
+    assert get_client() is MemoryBackend().store
+
+    async def generation():
+        get_client().set('test:generation', 1)
+        return await get_async_client().get('test:generation')
+    assert asyncio.run(generation()) == b'1'
+
+    monkeypatch.setattr(settings, 'CACHE_BACKEND', 'unknown')
+    with pytest.raises(ValueError):
+        get_client()
@@ -0,0 +1,280 @@
+import asyncio
+import json
+import logging
+import re
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from redis import RedisError
+
+from caching.backends import get_async_scripts_pool
+from radar.engine.body_objects import AsyncBodyObjectsPool, BodyObjectsPool
+from radar.engine.frame_cache import FrameCache
+from radar.engine.scheduler import Frame, SubscriptionEnded, ZoneScheduler
+from radar.engine.zone import ZoneBuilder
+
+
+logger = logging.getLogger(__name__)
+
+
+class RadarApplication:
+    """
+    ASGI application streaming frames of zones itself, over Server-Sent
+    Events and WebSockets, and passing the rest of the requests to Django.
+
+    The zones are advanced by one scheduler, which runs from startup
+    (or the first stream, if the server doesn't send lifespan events)
+    until shutdown
+    """
+    frames_path = re.compile(r'^/zones/(?P<zone_id>\w+)/frames/$')
+    socket_path = re.compile(r'^/zones/(?P<zone_id>\w+)/socket/$')
+    zone_requests: Dict[str, str] = {'small': 'request_small_zone',
+                                     'medium': 'request_medium_zone',
+                                     'large': 'request_large_zone'}
+    """Names of ZoneBuilder methods making the zones by zone ids"""
+    stream_max_frames = 4
+    """Frames kept for a stream that can't be sent as fast as they're drawn"""
+    unknown_zone_close_code = 4404
+    failed_frames_close_code = 1011
+    """Closes sockets that can't be sent frames anymore (internal error)"""
+
+    def __init__(self, django_application,
+                 scheduler: Optional[ZoneScheduler] = None,
+                 frame_cache: Optional[FrameCache] = None):
+        self.django_application = django_application
+        self.scheduler = scheduler or ZoneScheduler()
+        self.frame_cache = frame_cache or FrameCache()
+        self.scheduler.zone_removed.append(self.frame_cache.forget)
+        self._started = False
+        self._start_lock: Optional[asyncio.Lock] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http':
+            match = self.frames_path.match(scope['path'])
+            if match:
+                return await self.stream_frames(
+                    match['zone_id'], receive, send, _is_compact(scope))
+        if scope['type'] == 'websocket':
+            match = self.socket_path.match(scope['path'])
+            if match:
+                return await self.frames_socket(
+                    match['zone_id'], receive, send, _is_compact(scope))
+            await receive()
+            return await send({'type': 'websocket.close'})
+        return await self.django_application(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.scheduler.stop()
+                await sync_to_async(BodyObjectsPool().unsubscribe)()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def start(self):
+        """
+        Load the scripts, make the zones, start listening to body events and
+        start the scheduler once
+        """
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._started:
+                return
+            try:
+                await get_async_scripts_pool().load()
+            except RedisError:
+                logger.exception('Failed to load scripts into Redis, they '
+                                 'will be loaded when they are first used')
+            # zones get their default bodies from the database
+            await sync_to_async(self._make_zones)()
+            # zones take their bodies from the table the listener keeps
+            # instead of polling Redis every tick
+            await sync_to_async(BodyObjectsPool().subscribe)()
+            self.scheduler.start()
+            self._started = True
+
+    async def stream_frames(self, zone_id: str, receive, send,
+                            compact: bool = False):
+        """
+        Send frames of the zone as Server-Sent Events for as long as
+        the client stays connected and the zone exists. A frame that
+        directly follows the previously sent one is sent as a delta,
+        any other one as a keyframe.
+        Clients asking for compact frames (with format=compact query)
+        get all of them run-length encoded instead
+        """
+        await self.start()
+        if zone_id not in self.scheduler.zones:
+            await send({'type': 'http.response.start', 'status': 404,
+                        'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body',
+                        'body': f'Unknown zone {zone_id}'.encode()})
+            return
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'),
+                                (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        subscription = self.scheduler.subscribe(zone_id,
+                                                self.stream_max_frames)
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        last_tick = None
+        try:
+            while True:
+                next_frame = asyncio.ensure_future(subscription.get())
+                await asyncio.wait({next_frame, disconnected},
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    next_frame.cancel()
+                    return
+                try:
+                    frame = next_frame.result()
+                except SubscriptionEnded:
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+                data = self._encode(frame, last_tick, compact)
+                last_tick = frame.tick
+                await send({'type': 'http.response.body',
+                            'body': b'event: frame\ndata: %s\n\n' % data,
+                            'more_body': True})
+        finally:
+            subscription.close()
+            disconnected.cancel()
+
+    async def frames_socket(self, zone_id: str, receive, send,
+                            compact: bool = False):
+        """
+        Send frames of the zone over a WebSocket the same way stream_frames
+        does, and take body messages from the client over the same socket:
+            {"type": "add", "id": <body id>, "body": <body string>}
+            {"type": "ping", "id": <body id>}
+        They are answered with "added" or "pinged" messages (the latter tell
+        if the body is still alive), or with "error" ones.
+
+        Only the latest frame waits for a client that is slower than
+        the ticks, the rest are dropped. The socket is closed if the zone
+        is removed or its frames fail to be sent
+        """
+        await self.start()
+        if (await receive())['type'] != 'websocket.connect':
+            return
+        if zone_id not in self.scheduler.zones:
+            await send({'type': 'websocket.close',
+                        'code': self.unknown_zone_close_code})
+            return
+        await send({'type': 'websocket.accept'})
+        socket = _FramesSocket(send)
+        subscription = self.scheduler.subscribe(zone_id, max_frames=1)
+        sending = asyncio.ensure_future(self._send_frames(subscription,
+                                                          socket, compact))
+        try:
+            while True:
+                next_message = asyncio.ensure_future(receive())
+                await asyncio.wait({next_message, sending},
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if sending.done():
+                    next_message.cancel()
+                    if sending.exception() is not None:
+                        logger.error('Failed to send frames of zone %s',
+                                     zone_id, exc_info=sending.exception())
+                        await socket.close(self.failed_frames_close_code)
+                    return
+                message = next_message.result()
+                if message['type'] == 'websocket.disconnect':
+                    return
+                reply = await self._handle_body_message(message.get('text'))
+                await socket.send(json.dumps(reply).encode())
+        finally:
+            subscription.close()
+            sending.cancel()
+
+    async def _send_frames(self, subscription, socket: '_FramesSocket',
+                           compact: bool):
+        last_tick = None
+        async for frame in subscription:
+            data = self._encode(frame, last_tick, compact)
+            last_tick = frame.tick
+            await socket.send(data)
+        await socket.close()
+
+    @staticmethod
+    async def _handle_body_message(text: Optional[str]) -> Dict:
+        try:
+            message = json.loads(text)
+            message_type, body_id = message['type'], str(message['id'])
+        except (TypeError, ValueError, KeyError):
+            return {'type': 'error', 'error': 'Invalid message'}
+        pool = AsyncBodyObjectsPool()
+        try:
+            if message_type == 'add':
+                body = message.get('body')
+                if not isinstance(body, str):
+                    return {'type': 'error', 'id': body_id,
+                            'error': 'Body has to be a string'}
+                await pool.add_body(body, body_id)
+                return {'type': 'added', 'id': body_id}
+            if message_type == 'ping':
+                alive = (await pool.ping_bodies([body_id]))[body_id]
+                return {'type': 'pinged', 'id': body_id, 'alive': alive}
+        except ValueError as error:
+            return {'type': 'error', 'id': body_id, 'error': str(error)}
+        except RedisError:
+            logger.exception('Failed to handle %s of %s',
+                             message_type, body_id)
+            return {'type': 'error', 'id': body_id,
+                    'error': 'Bodies are unavailable'}
+        return {'type': 'error', 'id': body_id,
+                'error': f'Unknown message type {message_type!r}'}
+
+    def _encode(self, frame: Frame, last_tick: Optional[int],
+                      compact: bool = False) -> bytes:
+        """
+        Get the frame encoded as a delta if it directly follows the frame of
+        last_tick, which the client has, otherwise as a keyframe
+        """
+        encoded = self.frame_cache.encode(frame)
+        if compact:
+            return encoded.compact
+        return encoded.delta if frame.tick - 1 == last_tick \
+            else encoded.keyframe
+
+    def _make_zones(self):
+        builder = ZoneBuilder()
+        for zone_id, request_zone in self.zone_requests.items():
+            if zone_id not in self.scheduler.zones:
+                self.scheduler.add_zone(zone_id,
+                                        getattr(builder, request_zone)())
+
+
+class _FramesSocket:
+    """Sends messages of both frames and replies to a WebSocket in turn"""
+
+    def __init__(self, send):
+        self._send = send
+        self._lock = asyncio.Lock()
+
+    async def send(self, data: bytes):
+        async with self._lock:
+            await self._send({'type': 'websocket.send',
+                              'text': data.decode()})
+
+    async def close(self, code: int = 1000):
+        async with self._lock:
+            await self._send({'type': 'websocket.close', 'code': code})
+
+
+def _is_compact(scope) -> bool:
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('format') == ['compact']
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
@@ -1,36 +1,105 @@
 import logging
 import json
-from dataclasses import dataclass
-from redis import Redis
-from typing import Iterable, Tuple, List, Iterator, Union, Dict
+import threading
+import time
+import numpy as np
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import islice
+from redis import RedisError
+from typing import (
+    Iterable, Tuple, List, Iterator, Union, Dict, NamedTuple, Optional,
+    Mapping
+)
 from typing_extensions import TypedDict
 
-from backend import settings
-from caching.scripts import RedisScriptsPool
+from caching.backends import (
+    get_async_client, get_async_scripts_pool, get_client, get_scripts_pool
+)
 from share.metaclasses import Singleton
 from radar.models import AlienBody
 from radar.validation import validate_body_str_profile
 
 
 logger = logging.getLogger(__name__)
+
+
+class BodiesCursor(NamedTuple):
+    """State of the body set that a requester of body updates last saw"""
+    generation: int
+    next_expiry: Optional[float]
+    """The earliest expiry time (ms) among live bodies, if there are any"""
+
+
 BodiesUpdate = TypedDict('BodiesUpdate', {'dropped_keys': List[str],
-                                          'new_records': Dict[str, str]})
+                                          'new_records': Dict[str, str],
+                                          'arrivals': Dict[str, float],
+                                          'cursor': Optional[BodiesCursor]})
+
+
+body_cache_size = 4096
+"""Maximum number of distinct bodies and body records kept interned"""
 
 
 @dataclass(frozen=True)
-class BodyObject:
-    key: str
-    matrix: List[List[str]]
+class BodyShape:
+    """Symbols of a body, shared by all the body objects that look alike"""
+    rows: Tuple[str, ...]
     width: int
     height: int
+    pixels: np.ndarray = field(init=False, repr=False, compare=False)
+    """Body symbols as a height x width array of ASCII codes"""
+
+    def __post_init__(self):
+        pixels = np.frombuffer(''.join(self.rows).encode('ascii'),
+                               dtype=np.uint8)
+        object.__setattr__(self, 'pixels',
+                           pixels.reshape(self.height, self.width))
+
+    @staticmethod
+    @lru_cache(maxsize=body_cache_size)
+    def parse(body: str) -> 'BodyShape':
+        rows = tuple(body.splitlines())
+        return BodyShape(rows=rows, width=len(rows[0]), height=len(rows))
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+@dataclass(frozen=True)
+class BodyObject:
+    key: str
+    shape: BodyShape
+
+    @property
+    def rows(self) -> Tuple[str, ...]:
+        return self.shape.rows
+
+    @property
+    def width(self) -> int:
+        return self.shape.width
+
+    @property
+    def height(self) -> int:
+        return self.shape.height
+
+    @property
+    def pixels(self) -> np.ndarray:
+        return self.shape.pixels
 
     @staticmethod
+    @lru_cache(maxsize=body_cache_size)
     def generate(key: str, body: str) -> 'BodyObject':
-        line_list = body.splitlines()
-        matrix = [list(line) for line in line_list]
+        """
+        Get a body object for the body string stored under the key.
+        Body objects are interned, so every zone that picks up the same
+        record shares a single instance, and records with the same body
+        share its shape
+        """
+        return BodyObject(key=key, shape=BodyShape.parse(body))
 
-        return BodyObject(key=key, matrix=matrix,
-                          width=len(matrix[0]), height=len(matrix))
+    def __deepcopy__(self, memo):
+        return self
 
 
 class BodyObjectsPool(metaclass=Singleton):
@@ -40,42 +109,170 @@ class BodyObjectsPool(metaclass=Singleton):
     body_key_prefix = 'body:'
     body_lookup_pattern = body_key_prefix + '*'
     body_expiration = 10    # in seconds
+    registry_key = 'bodies:registry'
+    """Hash of body strings by body keys"""
+    expiry_key = 'bodies:expiry'
+    """Sorted set of body keys scored by their expiry time"""
+    generation_key = 'bodies:generation'
+    """Counter bumped whenever bodies are added to the registry or expire"""
+    events_channel = 'bodies:events'
+    """Channel the registry scripts publish added and expired bodies to"""
+    arrivals_key = 'bodies:arrivals'
+    """Sorted set of body keys scored by the time they were first added"""
+    registry_keys = [registry_key, expiry_key, generation_key, events_channel,
+                     arrivals_key]
 
     def __init__(self, num_of_default_bodies=3):
         self.num_of_default_bodies = num_of_default_bodies
         self.__default_bodies: Tuple[BodyObject, ...] = \
             self._generate_defaults(num_of_default_bodies)
-        self._redis = Redis(host=settings.REDIS_HOSTNAME)
-        self._scripts = RedisScriptsPool()
+        self._redis = get_client()
+        self._scripts = get_scripts_pool()
+        self._listener: Optional[BodyEventsListener] = None
 
     def add_body(self, body: Union[str, bytes], body_id: str) -> None:
         """Cache the requested body string in Redis db"""
-        validate_body_str_profile(body)
-        key = self.make_body_key(body_id)
-        self._redis.set(key, body, self.body_expiration)
+        error = self.add_bodies({body_id: body})[body_id]
+        if error is not None:
+            raise error
+
+    def add_bodies(self, bodies: Mapping[str, Union[str, bytes]]
+                   ) -> Dict[str, Optional[ValueError]]:
+        """
+        Cache the requested body strings in Redis db in one round trip
+        :param bodies: body strings by body ids
+        :returns: validation error of every body by its id, None for the
+        bodies that were added
+        """
+        errors, args = self.registration_args(bodies)
+        if len(args) > 1:
+            self._scripts.register_bodies(keys=self.registry_keys, args=args)
+        return errors
 
     def ping_body(self, body_id: str):
         """Reset expiration time of a body"""
-        key = self.make_body_key(body_id)
-        self._redis.expire(key, self.body_expiration)
+        self.ping_bodies([body_id])
+
+    def ping_bodies(self, body_ids: Iterable[str]) -> Dict[str, bool]:
+        """
+        Reset expiration time of bodies in one round trip
+        :returns: whether every body was pinged by its id; expired bodies
+        can't be pinged and have to be added again
+        """
+        body_ids = list(body_ids)
+        if not body_ids:
+            return {}
+        pinged = self._scripts.ping_bodies(keys=[self.expiry_key],
+                                           args=self.ping_args(body_ids))
+        return {body_id: bool(is_pinged)
+                for body_id, is_pinged in zip(body_ids, pinged)}
 
     def update_bodies(self, known_bodies_keys: Iterable[str],
-                      max_capacity: int) -> BodiesUpdate:
+                      max_capacity: int,
+                      cursor: Optional[BodiesCursor] = None) -> BodiesUpdate:
         """
         Give update on state of body objects' records in Redis db
         :param known_bodies_keys: redis keys of already known bodies
         :param max_capacity: maximum relevant for requester number of bodies
         including already known ones
+        :param cursor: cursor of the previous update got by the requester;
+        if no body was added or expired since then, an empty update is given
+        without running the update script
+
+        New records are given in the order the bodies arrived, each with
+        its arrival time (ms)
+
+        While the pool is subscribed to body events, the update is made
+        from the in-process body table instead
         """
-        return json.loads(
-            self._scripts.update_records(keys=known_bodies_keys,
-                                         args=[max_capacity,
-                                               self.body_lookup_pattern])
-        )
+        if self.is_subscribed:
+            return self._listener.table.update(known_bodies_keys, max_capacity)
+        if cursor is not None and not _cursor_expired(cursor) \
+                and _generation(self._redis.get(self.generation_key)) \
+                == cursor.generation:
+            return _empty_update(cursor)
+        return _parse_update(self._scripts.update_registry(
+            keys=self.registry_keys, args=[max_capacity, *known_bodies_keys]))
+
+    def migrate_body_keys(self) -> int:
+        """
+        Move bodies stored as separate keys with expiration time
+        (the way they were stored before the body registry) into the registry
+        :returns: number of moved bodies
+        """
+        return self._scripts.migrate_body_keys(
+            keys=self.registry_keys,
+            args=[self.body_lookup_pattern])
+
+    def subscribe(self) -> 'BodyTable':
+        """
+        Start listening to body events in a background thread, unless it's
+        already done in this process, and return the body table the
+        listener keeps up to date
+        """
+        if self._listener is None or not self._listener.is_alive():
+            self._listener = BodyEventsListener(self, BodyTable())
+            self._listener.start()
+        return self._listener.table
+
+    @property
+    def is_subscribed(self) -> bool:
+        """Whether the body table is in sync with the body registry"""
+        return self._listener is not None and self._listener.ready.is_set()
+
+    def unsubscribe(self, timeout: Optional[float] = None):
+        """Stop listening to body events"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener.join(timeout)
+            self._listener = None
+
+    def load_bodies(self) -> Tuple[Dict[str, str], Dict[str, float]]:
+        """
+        Get all the body records of the body registry in the order
+        the bodies arrived, and their arrival times
+        """
+        pipeline = self._redis.pipeline()
+        pipeline.hgetall(self.registry_key)
+        pipeline.zrange(self.arrivals_key, 0, -1, withscores=True)
+        records, arrivals = pipeline.execute()
+        records = {key.decode(): body.decode()
+                   for key, body in records.items()}
+        arrivals = {key.decode(): arrival for key, arrival in arrivals
+                    if key.decode() in records}
+        return {key: records[key] for key in arrivals}, arrivals
+
+    def purge_expired_bodies(self) -> List[str]:
+        """Remove expired bodies from the registry and return their keys"""
+        return [key.decode() for key
+                in self._scripts.purge_bodies(keys=self.registry_keys)]
 
     def make_body_key(self, body_id: str):
         return self.body_key_prefix + body_id
 
+    def registration_args(self, bodies: Mapping[str, Union[str, bytes]]
+                          ) -> Tuple[Dict[str, Optional[ValueError]], List]:
+        """
+        Validate bodies and make register_bodies script arguments, for
+        the pools running the script
+        """
+        errors: Dict[str, Optional[ValueError]] = {}
+        args = [self.body_expiration]
+        for body_id, body in bodies.items():
+            try:
+                validate_body_str_profile(body)
+            except ValueError as error:
+                errors[body_id] = error
+                continue
+            errors[body_id] = None
+            args += [self.make_body_key(body_id), body]
+        return errors, args
+
+    def ping_args(self, body_ids: List[str]) -> List:
+        """Make ping_bodies script arguments"""
+        return [self.body_expiration,
+                *(self.make_body_key(body_id) for body_id in body_ids)]
+
     @property
     def first(self):
         return self._get_default(0)
@@ -97,3 +294,207 @@ class BodyObjectsPool(metaclass=Singleton):
         query = AlienBody.objects.filter(id__lte=num_of_defaults)
         return tuple(BodyObject.generate(str(body.id), body.body_str)
                      for body in query)
+
+
+class AsyncBodyObjectsPool(metaclass=Singleton):
+    """
+    Asyncio counterpart of BodyObjectsPool for the calls that go to Redis,
+    so that they don't block the event loop.
+    Everything else, including the body events subscription, is shared with
+    BodyObjectsPool
+    """
+
+    def __init__(self):
+        self.sync_pool = BodyObjectsPool()
+        self._redis = get_async_client()
+        self._scripts = get_async_scripts_pool()
+
+    async def add_body(self, body: Union[str, bytes], body_id: str) -> None:
+        """Cache the requested body string in Redis db"""
+        error = (await self.add_bodies({body_id: body}))[body_id]
+        if error is not None:
+            raise error
+
+    async def add_bodies(self, bodies: Mapping[str, Union[str, bytes]]
+                         ) -> Dict[str, Optional[ValueError]]:
+        """Same as BodyObjectsPool.add_bodies"""
+        errors, args = self.sync_pool.registration_args(bodies)
+        if len(args) > 1:
+            await self._scripts.register_bodies(
+                keys=self.sync_pool.registry_keys, args=args)
+        return errors
+
+    async def ping_body(self, body_id: str):
+        """Reset expiration time of a body"""
+        await self.ping_bodies([body_id])
+
+    async def ping_bodies(self, body_ids: Iterable[str]) -> Dict[str, bool]:
+        """Same as BodyObjectsPool.ping_bodies"""
+        body_ids = list(body_ids)
+        if not body_ids:
+            return {}
+        pinged = await self._scripts.ping_bodies(
+            keys=[self.sync_pool.expiry_key],
+            args=self.sync_pool.ping_args(body_ids))
+        return {body_id: bool(is_pinged)
+                for body_id, is_pinged in zip(body_ids, pinged)}
+
+    async def update_bodies(self, known_bodies_keys: Iterable[str],
+                            max_capacity: int,
+                            cursor: Optional[BodiesCursor] = None
+                            ) -> BodiesUpdate:
+        """Same as BodyObjectsPool.update_bodies"""
+        if self.sync_pool.is_subscribed:
+            return self.sync_pool.update_bodies(known_bodies_keys,
+                                                max_capacity)
+        if cursor is not None and not _cursor_expired(cursor) \
+                and _generation(
+                    await self._redis.get(self.sync_pool.generation_key)) \
+                == cursor.generation:
+            return _empty_update(cursor)
+        return _parse_update(await self._scripts.update_registry(
+            keys=self.sync_pool.registry_keys,
+            args=[max_capacity, *known_bodies_keys]))
+
+
+class BodyTable:
+    """
+    In-process copy of the body records of the body registry in the order
+    the bodies arrived, kept up to date by a BodyEventsListener
+    """
+
+    def __init__(self):
+        self._records: Dict[str, str] = {}
+        self._arrivals: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def reset(self, records: Dict[str, str], arrivals: Dict[str, float]):
+        """Replace the records, which have to be in the order of arrival"""
+        with self._lock:
+            self._records = dict(records)
+            self._arrivals = dict(arrivals)
+
+    def apply(self, event: Dict):
+        """Apply an event published by the body registry scripts"""
+        with self._lock:
+            for key, body in (event.get('added') or {}).items():
+                # replaced bodies keep their place and arrival time
+                self._records[key] = body
+                self._arrivals.setdefault(key, event['arrived'])
+            for key in event.get('expired') or ():
+                self._records.pop(key, None)
+                self._arrivals.pop(key, None)
+
+    def update(self, known_bodies_keys: Iterable[str],
+               max_capacity: int) -> BodiesUpdate:
+        """Same as BodyObjectsPool.update_bodies, but made from the table"""
+        known_bodies_keys = list(known_bodies_keys)
+        known = set(known_bodies_keys)
+        with self._lock:
+            dropped_keys = [key for key in known_bodies_keys
+                            if key not in self._records]
+            keys_to_add = max_capacity - len(known_bodies_keys) \
+                + len(dropped_keys)
+            new_records = dict(islice(
+                ((key, body) for key, body in self._records.items()
+                 if key not in known),
+                max(keys_to_add, 0)))
+            arrivals = {key: self._arrivals[key] for key in new_records}
+        return BodiesUpdate(dropped_keys=dropped_keys,
+                            new_records=new_records, arrivals=arrivals,
+                            cursor=None)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._records
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+
+class BodyEventsListener(threading.Thread):
+    """
+    Background thread keeping a body table in sync with the body registry
+    through the events published by the registry scripts.
+
+    Bodies only expire when they are purged from the registry, so the
+    listener also purges them every purge_interval seconds
+    """
+    purge_interval = 1.0    # in seconds
+    reconnect_delay = 1.0   # in seconds
+
+    def __init__(self, pool: BodyObjectsPool, table: BodyTable):
+        super().__init__(name='body-events', daemon=True)
+        self.table = table
+        self.ready = threading.Event()
+        """Set while the table is in sync with the registry"""
+        self._pool = pool
+        self._redis = get_client()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except RedisError:
+                logger.exception('Lost connection to body events')
+                self.ready.clear()
+                self._stopped.wait(self.reconnect_delay)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _listen(self):
+        pubsub = self._redis.pubsub()
+        try:
+            pubsub.subscribe(self._pool.events_channel)
+            # the table is loaded only after the subscription is confirmed,
+            # so no event is missed; events that are already reflected in
+            # the loaded records are harmless to apply again
+            while pubsub.get_message(timeout=self.reconnect_delay) is None:
+                if self._stopped.is_set():
+                    return
+            self._pool.purge_expired_bodies()
+            self.table.reset(*self._pool.load_bodies())
+            self.ready.set()
+            next_purge = time.monotonic() + self.purge_interval
+            while not self._stopped.is_set():
+                message = pubsub.get_message(
+                    timeout=max(next_purge - time.monotonic(), 0))
+                if message is not None and message['type'] == 'message':
+                    self.table.apply(json.loads(message['data']))
+                if time.monotonic() >= next_purge:
+                    self._pool.purge_expired_bodies()
+                    next_purge = time.monotonic() + self.purge_interval
+        finally:
+            self.ready.clear()
+            pubsub.close()
+
+
+def _cursor_expired(cursor: BodiesCursor) -> bool:
+    """Check if some body could have expired since the cursor was got"""
+    return cursor.next_expiry is not None \
+        and time.time() * 1000 >= cursor.next_expiry
+
+
+def _generation(value: Optional[bytes]) -> int:
+    return int(value or 0)
+
+
+def _empty_update(cursor: Optional[BodiesCursor]) -> BodiesUpdate:
+    return BodiesUpdate(dropped_keys=[], new_records={}, arrivals={},
+                        cursor=cursor)
+
+
+def _parse_update(reply: str) -> BodiesUpdate:
+    """Make an update out of update_registry script reply"""
+    reply = json.loads(reply)
+    # json objects are unordered, so the order comes from the arrivals;
+    # cjson can't tell an empty object from an empty array
+    arrivals = dict(reply['arrivals'])
+    new_records = reply['new_records'] or {}
+    return BodiesUpdate(dropped_keys=reply['dropped_keys'] or [],
+                        new_records={key: new_records[key]
+                                     for key in arrivals},
+                        arrivals=arrivals,
+                        cursor=BodiesCursor(reply['generation'],
+                                            reply['next_expiry']))
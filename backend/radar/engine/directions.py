@@ -1,7 +1,15 @@
 import random
-from typing import Dict, Callable, Sequence, ClassVar
-from radar.engine.directions_meta import Position
+import numpy as np
+from typing import (
+    Dict, Callable, Sequence, ClassVar, Set, Tuple, List, Optional,
+    TYPE_CHECKING
+)
+from radar.engine.directions_meta import Position, RiskZoneTable
 from radar.engine import directions_meta
+from radar.validation import body_max_width, body_max_height
+
+if TYPE_CHECKING:
+    from radar.engine.occupancy import OccupancyGrid
 
 
 class Direction:
@@ -22,6 +30,9 @@ class Direction:
         """
         self.name = name
         self.move_from_pos = handler
+        self.shift = handler(Position(0, 0))
+        self.code = None
+        """Index of the direction in DirectionPool.values"""
         self._risk_zone_provider = risk_zone_provider
         self._opposite_key = opposite_key
         self._opposite = None
@@ -35,17 +46,32 @@ class Direction:
         else:
             return self._opposite
 
-    def positions_to_occupy_by_movement(self, cur_pos, width, height):
-        return self._movement_affected_points(cur_pos, width, height,
-                                              self._risk_zone_provider)
+    def positions_to_occupy_by_movement(self, cur_pos, width,
+                                        height) -> Set[Position]:
+        return self._movement_affected_points(cur_pos, width, height, self)
 
-    def positions_freed_by_movement(self, new_pos, width, height):
+    def positions_freed_by_movement(self, new_pos, width,
+                                    height) -> Set[Position]:
         return self._movement_affected_points(new_pos, width, height,
-                                              self.opposite._risk_zone_provider)
+                                              self.opposite)
+
+    def cells_to_occupy_by_movement(self, cur_pos, width, height
+                                    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same as positions_to_occupy_by_movement, but as arrays of
+        x and y coordinates
+        """
+        offsets = risk_zones.zone_offsets(self.code, width, height)
+        return offsets[:, 0] + cur_pos.x, offsets[:, 1] + cur_pos.y
 
     @staticmethod
-    def _movement_affected_points(pos, width, height, provider):
-        return provider(pos, width=width, height=height)
+    def _movement_affected_points(pos, width, height, direction):
+        if not risk_zones.covers(width, height):
+            return direction._risk_zone_provider(pos, width=width,
+                                                 height=height)
+        offsets = risk_zones.zone_offsets(direction.code, width, height)
+        return {Position(pos.x + dx, pos.y + dy)
+                for dx, dy in offsets.tolist()}
 
 
 class __DirectionPoolMeta(type):
@@ -97,3 +123,61 @@ class DirectionPool(metaclass=__DirectionPoolMeta):
     def random_direction(cls) -> Direction:
         return random.choice(cls.values)
 
+    @classmethod
+    def feasible_directions(cls, grid: 'OccupancyGrid', pos: Position,
+                            width: int, height: int) -> List[Direction]:
+        """
+        Get all the directions an object can move in from pos without
+        running into anything on the grid
+        """
+        if not risk_zones.covers(width, height):
+            return [direction for direction in cls.values
+                    if grid.are_available(
+                        direction.positions_to_occupy_by_movement(
+                            pos, width, height))]
+        free = free_directions(grid, np.array([pos.x]), np.array([pos.y]),
+                               np.array([width]), np.array([height]))
+        return [cls.values[code] for code in np.flatnonzero(free[0])]
+
+    @classmethod
+    def random_feasible_direction(cls, grid: 'OccupancyGrid', pos: Position,
+                                  width: int, height: int
+                                  ) -> Optional[Direction]:
+        """
+        Pick a random direction among the ones an object can move in,
+        if there are any
+        """
+        directions = cls.feasible_directions(grid, pos, width, height)
+        return random.choice(directions) if directions else None
+
+
+for _code, _direction in enumerate(DirectionPool.values):
+    _direction.code = _code
+
+direction_shifts = np.array([direction.shift
+                             for direction in DirectionPool.values])
+"""(x, y) shifts of every direction in DirectionPool.values order"""
+opposite_codes = np.array([direction.opposite.code
+                           for direction in DirectionPool.values])
+"""Codes of opposite directions in DirectionPool.values order"""
+risk_zones = RiskZoneTable(
+    [direction._risk_zone_provider for direction in DirectionPool.values],
+    body_max_width, body_max_height)
+"""Risk zones of every direction in DirectionPool.values order"""
+
+
+def free_directions(grid: 'OccupancyGrid', x: np.ndarray, y: np.ndarray,
+                    width: np.ndarray, height: np.ndarray) -> np.ndarray:
+    """
+    Check risk zones of all the directions for many objects in one pass.
+    Returns a boolean matrix with a row per object and a column per
+    direction in DirectionPool.values order, True for free directions
+    """
+    num_of_directions = len(DirectionPool.values)
+    codes = np.tile(np.arange(num_of_directions), x.size)
+    owners, xs, ys = risk_zones.translate(
+        codes, *(np.repeat(array, num_of_directions)
+                 for array in (x, y, width, height)))
+    blocked = np.zeros(codes.size, dtype=bool)
+    blocked[owners[~grid.cells_vacant(xs, ys)]] = True
+    return ~blocked.reshape(x.size, num_of_directions)
@@ -1,4 +1,6 @@
+import numpy as np
 from collections import namedtuple
+from typing import Callable, Sequence, Set
 
 
 Position = namedtuple('Position', ('x', 'y'))
@@ -71,3 +73,54 @@ bottom_right_risk_zone = \
     _diagonal_risk_zone_provider(bottom_risk_zone, right_risk_zone,
                                  lambda **kwargs: Position(_rightmost_x_neighbor(**kwargs),
                                                            _lowest_y_neighbor(**kwargs)))
+
+
+class RiskZoneTable:
+    """
+    Risk zones of every provider for every object size up to
+    max_width x max_height, stored as offsets from the object's top left
+    corner, so that they only have to be translated to the object's position
+    """
+
+    def __init__(self, providers: Sequence[Callable[..., Set[Position]]],
+                 max_width: int, max_height: int):
+        self.max_width = max_width
+        self.max_height = max_height
+        max_zone_size = max_width + max_height + 1
+        self.offsets = np.zeros((len(providers), max_width + 1,
+                                 max_height + 1, max_zone_size, 2),
+                                dtype=np.int32)
+        self.sizes = np.zeros((len(providers), max_width + 1,
+                               max_height + 1), dtype=np.int32)
+        origin = Position(0, 0)
+        for code, provider in enumerate(providers):
+            for width in range(1, max_width + 1):
+                for height in range(1, max_height + 1):
+                    zone = sorted(provider(origin, width=width, height=height))
+                    self.offsets[code, width, height, :len(zone)] = zone
+                    self.sizes[code, width, height] = len(zone)
+        self.offsets.flags.writeable = False
+        self.sizes.flags.writeable = False
+
+    def covers(self, width: int, height: int) -> bool:
+        return 0 < width <= self.max_width and 0 < height <= self.max_height
+
+    def zone_offsets(self, code: int, width: int, height: int) -> np.ndarray:
+        """Offsets of the risk zone of a single object as N x 2 array"""
+        return self.offsets[code, width, height,
+                            :self.sizes[code, width, height]]
+
+    def translate(self, codes: np.ndarray, x: np.ndarray, y: np.ndarray,
+                  width: np.ndarray, height: np.ndarray):
+        """
+        Risk zones of many objects at once.
+        Returns indices of the objects the positions belong to and
+        the positions' coordinates
+        """
+        sizes = self.sizes[codes, width, height]
+        owners = np.repeat(np.arange(sizes.size), sizes)
+        starts = np.cumsum(sizes) - sizes
+        indices = np.arange(owners.size) - starts[owners]
+        offsets = self.offsets[codes[owners], width[owners],
+                               height[owners], indices]
+        return owners, x[owners] + offsets[:, 0], y[owners] + offsets[:, 1]
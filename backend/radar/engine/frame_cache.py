@@ -0,0 +1,86 @@
+import json
+from typing import Dict, NamedTuple, Optional
+
+from radar.engine.scheduler import Frame
+from share.metrics import Metrics
+
+
+frame_cache_hits = Metrics().hit_rate('frame_cache')
+"""Lookups of encoded frames that didn't have to encode them"""
+
+
+class EncodedFrame(NamedTuple):
+    """
+    A frame encoded into JSON messages for clients. All of them carry
+    zone and tick of the frame, and either the whole image, the runs of
+    the delta to the frame of the previous tick, or the run-length encoded
+    rows of the frame with the noise the client has to apply to them
+    """
+    keyframe: bytes
+    delta: bytes
+    compact: bytes
+
+
+class FrameCache:
+    """
+    Encoded frames by zone ids and ticks, so that all the clients watching
+    a zone get the same bytes, encoded once per tick.
+
+    Only the frames of the last max_ticks ticks of every zone are kept.
+    The frames are only kept in the process: every process draws its zones
+    with its own scheduler, so its frames are of no use to the others
+    """
+
+    def __init__(self, max_ticks: int = 4):
+        self.max_ticks = max_ticks
+        self._frames: Dict[str, Dict[int, EncodedFrame]] = {}
+
+    def get(self, zone_id: str, tick: int) -> Optional[EncodedFrame]:
+        """Get the encoded frame of the zone at the tick, if it's cached"""
+        encoded = self._frames.get(zone_id, {}).get(tick)
+        if encoded is None:
+            frame_cache_hits.miss()
+        else:
+            frame_cache_hits.hit()
+        return encoded
+
+    def encode(self, frame: Frame) -> EncodedFrame:
+        """Get the frame encoded, encoding and caching it if it isn't yet"""
+        encoded = self.get(frame.zone_id, frame.tick)
+        if encoded is None:
+            encoded = encode_frame(frame)
+            self._put(frame.zone_id, frame.tick, encoded)
+        return encoded
+
+    def forget(self, zone_id: str):
+        """Drop the frames of the zone"""
+        self._frames.pop(zone_id, None)
+
+    def _put(self, zone_id: str, tick: int, encoded: EncodedFrame):
+        frames = self._frames.setdefault(zone_id, {})
+        frames[tick] = encoded
+        for old_tick in [old_tick for old_tick in frames
+                         if old_tick <= tick - self.max_ticks]:
+            del frames[old_tick]
+
+
+def encode_frame(frame: Frame) -> EncodedFrame:
+    keyframe = _dumps({'zone': frame.zone_id, 'tick': frame.tick,
+                       'keyframe': True, 'image': frame.image})
+    if frame.delta.keyframe:
+        delta = keyframe
+    else:
+        delta = _dumps({'zone': frame.zone_id, 'tick': frame.tick,
+                        'keyframe': False, 'runs': frame.delta.runs})
+    if frame.compact is None:
+        compact = keyframe
+    else:
+        compact = _dumps({'zone': frame.zone_id, 'tick': frame.tick,
+                          'keyframe': True, 'rows': frame.compact.rows,
+                          'noise': [frame.compact.positive_noise,
+                                    frame.compact.negative_noise]})
+    return EncodedFrame(keyframe, delta, compact)
+
+
+def _dumps(message) -> bytes:
+    return json.dumps(message, separators=(',', ':')).encode()
@@ -1,17 +1,65 @@
-from typing import Set, Optional
+import numpy as np
+from copy import deepcopy
+from typing import (
+    Set, Optional, List, Iterator, Iterable, Dict, NamedTuple, Tuple
+)
 from radar.engine.body_objects import BodyObject
 from radar.engine.directions_meta import Position
-from radar.engine.directions import Direction, DirectionPool
+from radar.engine.directions import (
+    Direction, DirectionPool, direction_shifts, opposite_codes, risk_zones,
+    free_directions
+)
+from radar.engine.occupancy import OccupancyGrid
 
 
 class MovingObject:
+    """
+    A body moving across a zone.
+
+    While the object is attached to a MovingObjectsStore, its position and
+    direction live in the store's arrays and the object is only a view of
+    its slot there
+    """
+
     def __init__(self, body: BodyObject,
                  position: Optional[Position] = None):
-        self.direction: Direction = DirectionPool.random_direction()
         self.body = body
         self.height = self.body.height
         self.width = self.body.width
-        self.position: Position = position
+        self._store: Optional['MovingObjectsStore'] = None
+        self._slot: Optional[int] = None
+        self._position = position
+        self._direction: Direction = DirectionPool.random_direction()
+
+    @property
+    def position(self) -> Optional[Position]:
+        if self._store is None:
+            return self._position
+        return self._store.get_position(self._slot)
+
+    @position.setter
+    def position(self, position: Optional[Position]):
+        if self._store is None:
+            self._position = position
+        else:
+            self._store.set_position(self._slot, position)
+
+    @property
+    def direction(self) -> Direction:
+        if self._store is None:
+            return self._direction
+        return self._store.get_direction(self._slot)
+
+    @direction.setter
+    def direction(self, direction: Direction):
+        if self._store is None:
+            self._direction = direction
+        else:
+            self._store.set_direction(self._slot, direction)
+
+    @property
+    def is_attached(self) -> bool:
+        return self._store is not None
 
     def estimate_movement(self) -> Set[Position]:
         return self.direction.positions_to_occupy_by_movement(self.position,
@@ -24,8 +72,22 @@ class MovingObject:
                                                           self.width,
                                                           self.height)
 
-    def evade_collision(self):
-        self._get_new_direction()
+    def evade_collision(self, grid: Optional[OccupancyGrid] = None) -> bool:
+        """
+        Change direction after a collision.
+        If the grid is provided, the new direction is picked among the ones
+        the object can actually move in; when there are none, the direction
+        stays the same and False is returned
+        """
+        if grid is None:
+            self._get_new_direction()
+            return True
+        direction = DirectionPool.random_feasible_direction(
+            grid, self.position, self.width, self.height)
+        if direction is None:
+            return False
+        self.direction = direction
+        return True
 
     def _get_new_direction(self):
         old_direction = self.direction
@@ -33,8 +95,281 @@ class MovingObject:
             self.direction = DirectionPool.random_direction()
 
     def get_line_iterator(self):
-        return iter(self.body.matrix)
+        return iter(self.body.rows)
+
+    def clone(self) -> 'MovingObject':
+        """Get a detached copy of the object with the same state"""
+        return self._copy(self.body)
+
+    def snapshot(self) -> 'MovingObjectSnapshot':
+        """Get an immutable record of the object's current state"""
+        return MovingObjectSnapshot(self.body, self.position, self.direction,
+                                    self.width, self.height)
+
+    def __deepcopy__(self, memo):
+        return self._copy(deepcopy(self.body, memo))
+
+    def _copy(self, body: BodyObject) -> 'MovingObject':
+        copy = MovingObject(body, self.position)
+        copy.direction = self.direction
+        return copy
 
     def __repr__(self):
         return f'Obj: body key {self.body.key}; profile ' \
                f'{self.width}x{self.height}'
+
+
+class MovingObjectSnapshot(NamedTuple):
+    """
+    Immutable record of a moving object's state at some point.
+    The body is shared with the object, not copied
+    """
+    body: BodyObject
+    position: Optional[Position]
+    direction: Direction
+    width: int
+    height: int
+
+    def clone(self) -> MovingObject:
+        """Get a detached moving object with the recorded state"""
+        obj = MovingObject(self.body, self.position)
+        obj.direction = self.direction
+        return obj
+
+
+_directions = DirectionPool.values
+
+
+class MovingObjectsStore:
+    """
+    State of all moving objects of a zone kept in contiguous arrays
+    (x, y, width, height, direction code), so that all the objects
+    can be moved at once with vector operations.
+
+    Slots of detached objects are reused by the next attached ones.
+    Objects are also indexed by their body keys
+    """
+
+    def __init__(self, capacity: int = 64):
+        capacity = max(capacity, 1)
+        self._x = np.zeros(capacity, dtype=np.int32)
+        self._y = np.zeros(capacity, dtype=np.int32)
+        self._width = np.zeros(capacity, dtype=np.int32)
+        self._height = np.zeros(capacity, dtype=np.int32)
+        self._direction = np.zeros(capacity, dtype=np.int8)
+        self._placed = np.zeros(capacity, dtype=bool)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._views: List[Optional[MovingObject]] = [None] * capacity
+        self._free_slots = list(range(capacity - 1, -1, -1))
+        self._slots_by_key: Dict[str, List[int]] = {}
+        self._keys: Optional[List[str]] = None
+        self._random = np.random.default_rng()
+
+    def attach(self, obj: MovingObject):
+        """Move object's state into the store and make the object its view"""
+        if obj._store is self:
+            return
+        if obj.is_attached:
+            raise ValueError(f'{obj} is already attached to another store')
+        if not risk_zones.covers(obj.width, obj.height):
+            raise ValueError(f'{obj} is too big to be moved')
+        if not self._free_slots:
+            self._grow()
+        slot = self._free_slots.pop()
+        self._width[slot] = obj.width
+        self._height[slot] = obj.height
+        self._alive[slot] = True
+        self._views[slot] = obj
+        self._slots_by_key.setdefault(obj.body.key, []).append(slot)
+        self._keys = None
+        position, direction = obj.position, obj.direction
+        obj._store, obj._slot = self, slot
+        obj.position = position
+        obj.direction = direction
+
+    def detach(self, obj: MovingObject):
+        """Give object its state back and free its slot"""
+        if obj._store is not self:
+            raise ValueError(f'{obj} is not attached to the store')
+        slots = self._slots_by_key[obj.body.key]
+        slots.remove(obj._slot)
+        if not slots:
+            del self._slots_by_key[obj.body.key]
+        self._release(obj._slot)
+
+    def detach_keys(self, keys: Iterable[str]) -> List[MovingObject]:
+        """
+        Detach an object with the body key for every key occurrence
+        and return the detached objects; unknown keys are ignored
+        """
+        detached = []
+        for key in keys:
+            slots = self._slots_by_key.get(key)
+            if not slots:
+                continue
+            slot = slots.pop()
+            if not slots:
+                del self._slots_by_key[key]
+            detached.append(self._views[slot])
+            self._release(slot)
+        return detached
+
+    def find(self, key: str) -> Optional[MovingObject]:
+        """Get an object by its body key"""
+        slots = self._slots_by_key.get(key)
+        return self._views[slots[-1]] if slots else None
+
+    def snapshot(self) -> Tuple[MovingObjectSnapshot, ...]:
+        """Get records of all the objects' current states in slot order"""
+        slots = np.flatnonzero(self._alive)
+        placed = self._placed[slots].tolist()
+        return tuple(
+            MovingObjectSnapshot(
+                self._views[slot].body,
+                Position(x, y) if is_placed else None,
+                _directions[code], width, height)
+            for slot, is_placed, x, y, code, width, height in zip(
+                slots.tolist(), placed, self._x[slots].tolist(),
+                self._y[slots].tolist(), self._direction[slots].tolist(),
+                self._width[slots].tolist(), self._height[slots].tolist())
+        )
+
+    def keys(self) -> List[str]:
+        """Body keys of all the objects, repeated for objects sharing them"""
+        if self._keys is None:
+            self._keys = [key for key, slots in self._slots_by_key.items()
+                          for _ in slots]
+        return self._keys
+
+    def get_position(self, slot: int) -> Optional[Position]:
+        if not self._placed[slot]:
+            return None
+        return Position(int(self._x[slot]), int(self._y[slot]))
+
+    def set_position(self, slot: int, position: Optional[Position]):
+        if position is None:
+            self._placed[slot] = False
+        else:
+            self._x[slot], self._y[slot] = position
+            self._placed[slot] = True
+
+    def get_direction(self, slot: int) -> Direction:
+        return _directions[self._direction[slot]]
+
+    def set_direction(self, slot: int, direction: Direction):
+        self._direction[slot] = direction.code
+
+    def step(self, grid: OccupancyGrid,
+             max_attempts: int = 7) -> List[MovingObject]:
+        """
+        Move every placed object by one position in its direction at once
+        and return the objects that moved.
+
+        Objects that would run into something wait for one more attempt if
+        other objects moved meanwhile, otherwise they take a random direction
+        among the ones that are free (all of them are checked at once) or
+        stay in place if there are none. Objects claiming the same positions
+        are resolved in favour of the one with the lowest slot, the rest try
+        again. Nothing is tried more than max_attempts times
+        """
+        candidates = np.flatnonzero(self._alive & self._placed)
+        may_wait = np.ones(candidates.size, dtype=bool)
+        moved = []
+        for _ in range(max_attempts):
+            if not candidates.size:
+                break
+            codes = self._direction[candidates]
+            dx = direction_shifts[codes, 0]
+            dy = direction_shifts[codes, 1]
+            x, y = self._x[candidates], self._y[candidates]
+            width = self._width[candidates]
+            height = self._height[candidates]
+
+            owners, xs, ys = risk_zones.translate(codes, x, y, width, height)
+            vacant = grid.cells_vacant(xs, ys)
+            blocked = np.zeros(candidates.size, dtype=bool)
+            blocked[owners[~vacant]] = True
+            claims = ~blocked[owners]
+            winners = ~blocked & ~_lose_contests(owners[claims], xs[claims],
+                                                 ys[claims], grid,
+                                                 candidates.size)
+
+            entered = winners[owners]
+            grid.occupy_cells(xs[entered], ys[entered])
+            _, freed_xs, freed_ys = risk_zones.translate(
+                opposite_codes[codes[winners]],
+                x[winners] + dx[winners], y[winners] + dy[winners],
+                width[winners], height[winners])
+            grid.free_cells(freed_xs, freed_ys)
+            self._x[candidates[winners]] += dx[winners]
+            self._y[candidates[winners]] += dy[winners]
+            moved.extend(candidates[winners].tolist())
+
+            waiting = blocked & may_wait & winners.any()
+            evading = blocked & ~waiting
+            may_wait &= ~waiting
+            trapped = np.zeros(candidates.size, dtype=bool)
+            trapped[evading] = ~self._evade(candidates[evading], grid)
+
+            remaining = ~winners & ~trapped
+            candidates = candidates[remaining]
+            may_wait = may_wait[remaining]
+        return [self._views[slot] for slot in moved]
+
+    def _evade(self, slots: np.ndarray, grid: OccupancyGrid) -> np.ndarray:
+        """
+        Give objects random directions among the free ones.
+        Returns which of the objects had any free direction
+        """
+        free = free_directions(grid, self._x[slots], self._y[slots],
+                               self._width[slots], self._height[slots])
+        # the free direction with the biggest random key wins
+        keys = self._random.random(free.shape)
+        keys[~free] = -1
+        evaded = free.any(axis=1)
+        self._direction[slots[evaded]] = keys[evaded].argmax(axis=1)
+        return evaded
+
+    def __iter__(self) -> Iterator[MovingObject]:
+        return (self._views[slot] for slot in np.flatnonzero(self._alive))
+
+    def __len__(self) -> int:
+        return int(self._alive.sum())
+
+    def __contains__(self, obj: MovingObject) -> bool:
+        return obj._store is self
+
+    def _release(self, slot: int):
+        obj = self._views[slot]
+        position, direction = obj.position, obj.direction
+        obj._store, obj._slot = None, None
+        obj.position = position
+        obj.direction = direction
+        self._alive[slot] = False
+        self._placed[slot] = False
+        self._views[slot] = None
+        self._free_slots.append(slot)
+        self._keys = None
+
+    def _grow(self):
+        capacity = self._alive.size
+        for name in ('_x', '_y', '_width', '_height', '_direction',
+                     '_placed', '_alive'):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate(
+                (array, np.zeros(capacity, dtype=array.dtype))))
+        self._views += [None] * capacity
+        self._free_slots = list(range(capacity * 2 - 1, capacity - 1, -1))
+
+
+def _lose_contests(owners, xs, ys, grid, num_of_owners):
+    """
+    Find owners that claim any position claimed by an owner
+    with a lower index
+    """
+    cells = ys * grid.width + xs
+    first_claims = np.full(grid.width * grid.height, num_of_owners)
+    np.minimum.at(first_claims, cells, owners)
+    lost = np.zeros(num_of_owners, dtype=bool)
+    lost[owners[first_claims[cells] != owners]] = True
+    return lost
@@ -0,0 +1,145 @@
+import numpy as np
+from typing import Iterable, List, Optional, Tuple, Union
+
+from radar.engine.directions_meta import Position
+
+
+class OccupancyGrid:
+    """
+    Vacancy state of every position in a zone kept in a 2D boolean array
+    (True stands for a vacant position), so that checks and changes of whole
+    regions are done with array slices instead of cell by cell
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self._vacancy = np.ones((height, width), dtype=bool)
+        self._occupied_sums: Optional[np.ndarray] = None
+        self._random = np.random.default_rng()
+
+    @classmethod
+    def from_matrix(cls, matrix: List[List[bool]]) -> 'OccupancyGrid':
+        """Create a grid from the old-style list of rows of vacancy flags"""
+        vacancy = np.array(matrix, dtype=bool)
+        if vacancy.ndim != 2:
+            raise ValueError('Position vacancy matrix has to be 2-dimensional')
+        grid = cls(vacancy.shape[1], vacancy.shape[0])
+        grid._vacancy = vacancy
+        grid._occupied_sums = None
+        return grid
+
+    @classmethod
+    def make(cls, vacancy: 'PositionVacancy') -> 'OccupancyGrid':
+        """Return vacancy as a grid, converting it if needed"""
+        if isinstance(vacancy, cls):
+            return vacancy
+        return cls.from_matrix(vacancy)
+
+    @property
+    def vacancy(self) -> np.ndarray:
+        """Read-only view of the underlying vacancy array"""
+        view = self._vacancy.view()
+        view.flags.writeable = False
+        return view
+
+    def region_is_vacant(self, x: int, y: int,
+                         width: int, height: int) -> bool:
+        if not self._region_fits(x, y, width, height):
+            return False
+        return bool(self._vacancy[y:y + height, x:x + width].all())
+
+    def free_region(self, x: int, y: int, width: int, height: int):
+        self._vacancy[y:y + height, x:x + width] = True
+        self._occupied_sums = None
+
+    def occupy_region(self, x: int, y: int, width: int, height: int):
+        self._vacancy[y:y + height, x:x + width] = False
+        self._occupied_sums = None
+
+    def are_available(self, positions: Iterable[Position]) -> bool:
+        """Check that all the positions are inside the grid and vacant"""
+        return bool(self.cells_vacant(*self._to_coordinates(positions)).all())
+
+    def free_positions(self, positions: Iterable[Position]):
+        self.free_cells(*self._to_coordinates(positions))
+
+    def occupy_positions(self, positions: Iterable[Position]):
+        self.occupy_cells(*self._to_coordinates(positions))
+
+    def cells_vacant(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Check vacancy of every position given by coordinate arrays;
+        positions outside the grid are never vacant
+        """
+        in_bounds = ((xs >= 0) & (ys >= 0)
+                     & (xs < self.width) & (ys < self.height))
+        vacant = np.zeros(xs.shape, dtype=bool)
+        vacant[in_bounds] = self._vacancy[ys[in_bounds], xs[in_bounds]]
+        return vacant
+
+    def free_cells(self, xs: np.ndarray, ys: np.ndarray):
+        self._vacancy[ys, xs] = True
+        self._occupied_sums = None
+
+    def occupy_cells(self, xs: np.ndarray, ys: np.ndarray):
+        self._vacancy[ys, xs] = False
+        self._occupied_sums = None
+
+    def fitting_positions(self, width: int, height: int
+                          ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find all top left corners of vacant width x height regions.
+        Every region is checked in constant time with a summed-area table
+        of occupied positions, which is kept until the grid changes
+        """
+        if width > self.width or height > self.height:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        sums = self._get_occupied_sums()
+        occupied = (sums[height:, width:] - sums[:-height, width:]
+                    - sums[height:, :-width] + sums[:-height, :-width])
+        ys, xs = np.nonzero(occupied == 0)
+        return xs, ys
+
+    def random_fitting_position(self, width: int,
+                                height: int) -> Optional[Position]:
+        """
+        Pick a top left corner of a vacant width x height region
+        uniformly among all of them; None if the region fits nowhere
+        """
+        xs, ys = self.fitting_positions(width, height)
+        if not xs.size:
+            return None
+        i = self._random.integers(xs.size)
+        return Position(int(xs[i]), int(ys[i]))
+
+    def draw(self, void: str, matter: str) -> str:
+        """Represent vacant positions as void and occupied ones as matter"""
+        symbols = np.where(self._vacancy, ord(void), ord(matter))
+        lines = np.full((self.height, self.width + 1), ord('\n'),
+                        dtype=np.uint8)
+        lines[:, :-1] = symbols
+        return lines.tobytes()[:-1].decode('ascii')
+
+    def tolist(self) -> List[List[bool]]:
+        return self._vacancy.tolist()
+
+    def _get_occupied_sums(self) -> np.ndarray:
+        if self._occupied_sums is None:
+            sums = np.zeros((self.height + 1, self.width + 1), dtype=np.int32)
+            np.cumsum(np.cumsum(~self._vacancy, axis=0, dtype=np.int32),
+                      axis=1, out=sums[1:, 1:])
+            self._occupied_sums = sums
+        return self._occupied_sums
+
+    def _region_fits(self, x, y, width, height):
+        return (x >= 0 and y >= 0
+                and x + width <= self.width and y + height <= self.height)
+
+    @staticmethod
+    def _to_coordinates(positions: Iterable[Position]):
+        coordinates = np.array(list(positions), dtype=np.intp).reshape(-1, 2)
+        return coordinates[:, 0], coordinates[:, 1]
+
+
+PositionVacancy = Union[OccupancyGrid, List[List[bool]]]
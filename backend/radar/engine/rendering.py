@@ -0,0 +1,170 @@
+import numpy as np
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from radar.engine.moving_objects import MovingObject
+
+
+class FrameRenderer:
+    """
+    Composes frames of a zone in one preallocated character buffer.
+
+    Every row of the buffer ends with a line break, so the whole frame is
+    encoded into a string at once
+    """
+
+    def __init__(self, width: int, height: int, void: str, matter: str):
+        self.width = width
+        self.height = height
+        self._void = ord(void)
+        self._matter = ord(matter)
+        self._frame = np.empty((height, width + 1), dtype=np.uint8)
+        self._frame[:, -1] = ord('\n')
+        self._canvas = self._frame[:, :-1]
+        self._rows = np.arange(height)[:, np.newaxis]
+        self._random = np.random.default_rng()
+
+    def render(self, moving_objects: Iterable[MovingObject],
+               positive_noise: int = 3, negative_noise: int = 5) -> str:
+        """
+        Draw moving objects over the void and distort every row with
+        positive_noise percent of matter and negative_noise percent of void
+        """
+        self.compose(moving_objects, positive_noise, negative_noise)
+        return self._frame.tobytes()[:-1].decode('ascii')
+
+    def render_runs(self, moving_objects: Iterable[MovingObject],
+                    positive_noise: int = 3, negative_noise: int = 5
+                    ) -> 'RunLengthFrame':
+        """
+        Draw moving objects over the void into run-length encoded rows.
+        The noise is left for whoever expands the frame to apply, since
+        runs of random symbols take more space than the rest of the frame
+        """
+        self.compose(moving_objects, 0, 0)
+        return RunLengthFrame(encode_runs(self._canvas),
+                              positive_noise, negative_noise)
+
+    def render_both(self, moving_objects: Iterable[MovingObject],
+                    positive_noise: int = 3, negative_noise: int = 5
+                    ) -> Tuple[str, 'RunLengthFrame']:
+        """
+        Draw moving objects the way both render and render_runs do,
+        composing them once: the runs are taken before the noise is applied
+        """
+        self.compose(moving_objects, 0, 0)
+        runs = RunLengthFrame(encode_runs(self._canvas),
+                              positive_noise, negative_noise)
+        self._apply_noise(positive_noise, negative_noise)
+        return self._frame.tobytes()[:-1].decode('ascii'), runs
+
+    def compose(self, moving_objects: Iterable[MovingObject],
+                positive_noise: int = 3, negative_noise: int = 5):
+        """Draw a frame in the buffer without making anything out of it"""
+        self._canvas.fill(self._void)
+        for obj in moving_objects:
+            x, y = obj.position
+            self._canvas[y:y + obj.height, x:x + obj.width] = obj.body.pixels
+        self._apply_noise(positive_noise, negative_noise)
+
+    def _apply_noise(self, positive_noise, negative_noise):
+        positive = int(self.width * positive_noise / 100)
+        negative = int(self.width * negative_noise / 100)
+        if positive + negative == 0:
+            return
+        distorted = self._random.integers(0, self.width,
+                                          size=(self.height,
+                                                positive + negative))
+        # negative noise goes second so it takes over positions hit by both
+        self._canvas[self._rows, distorted[:, :positive]] = self._matter
+        self._canvas[self._rows, distorted[:, positive:]] = self._void
+
+
+class FrameDelta(NamedTuple):
+    """
+    Changes that turn one frame into the next one.
+    Every run is a (row, column, text) triple: text replaces the symbols of
+    the row starting from the column. A keyframe consists of whole rows
+    and doesn't depend on the previous frame
+    """
+    keyframe: bool
+    runs: Tuple[Tuple[int, int, str], ...]
+
+    def apply(self, frame: Optional[str]) -> str:
+        """Get the frame that results from applying the delta to frame"""
+        if self.keyframe:
+            return '\n'.join(text for _, _, text in self.runs)
+        lines = frame.split('\n')
+        for y, x, text in self.runs:
+            line = lines[y]
+            lines[y] = line[:x] + text + line[x + len(text):]
+        return '\n'.join(lines)
+
+
+RunLengthRows = Tuple[Tuple[str, Tuple[int, ...]], ...]
+
+
+class RunLengthFrame(NamedTuple):
+    """
+    Run-length encoded frame without noise. Every row is a (symbols, lengths)
+    pair: the row consists of runs of the symbols repeated as many times as
+    the corresponding lengths say
+    """
+    rows: RunLengthRows
+    positive_noise: int
+    """Percent of every row that has to be turned into matter"""
+    negative_noise: int
+    """Percent of every row that has to be turned into void after that"""
+
+    def expand(self) -> str:
+        """Get the frame as string, without applying the noise"""
+        return '\n'.join(''.join(symbol * length for symbol, length
+                                  in zip(symbols, lengths))
+                          for symbols, lengths in self.rows)
+
+
+def encode_runs(canvas: np.ndarray) -> RunLengthRows:
+    """Run-length encode rows of a height x width array of ASCII codes"""
+    height, width = canvas.shape
+    symbols = canvas.ravel()
+    # every row starts a new run, even if it starts with the last symbol
+    # of the previous row
+    run_starts = np.empty(symbols.size, dtype=bool)
+    run_starts[0] = True
+    np.not_equal(symbols[1:], symbols[:-1], out=run_starts[1:])
+    run_starts[::width] = True
+    starts = np.flatnonzero(run_starts)
+    lengths = np.diff(np.append(starts, symbols.size)).tolist()
+    run_symbols = symbols[starts].tobytes().decode('ascii')
+    row_bounds = np.searchsorted(starts,
+                                 np.arange(height + 1) * width).tolist()
+    return tuple((run_symbols[start:end], tuple(lengths[start:end]))
+                 for start, end in zip(row_bounds, row_bounds[1:]))
+
+
+def make_keyframe(frame: str) -> FrameDelta:
+    return FrameDelta(True, tuple((y, 0, line) for y, line
+                                  in enumerate(frame.split('\n'))))
+
+
+def make_delta(previous: bytes, current: bytes, width: int,
+               max_gap: int = 4) -> FrameDelta:
+    """
+    Find runs of changed symbols between two encoded frames of equal size.
+    Runs separated by at most max_gap unchanged symbols are merged,
+    since describing a run costs more than a few repeated symbols
+    """
+    changed = np.flatnonzero(np.frombuffer(previous, dtype=np.uint8)
+                             != np.frombuffer(current, dtype=np.uint8))
+    if not changed.size:
+        return FrameDelta(False, ())
+    line_length = width + 1
+    rows = changed // line_length
+    breaks = np.flatnonzero((np.diff(changed) > max_gap + 1)
+                            | (np.diff(rows) != 0)) + 1
+    starts = changed[np.concatenate(([0], breaks))]
+    ends = changed[np.concatenate((breaks - 1, [changed.size - 1]))] + 1
+    text = current.decode('ascii')
+    return FrameDelta(False, tuple(
+        (start // line_length, start % line_length, text[start:end])
+        for start, end in zip(starts.tolist(), ends.tolist())
+    ))
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Set
+
+from redis import RedisError
+
+from backend import settings
+from radar.engine.rendering import FrameDelta, RunLengthFrame
+from radar.engine.zone import Zone
+from share.metrics import Metrics
+
+
+logger = logging.getLogger(__name__)
+tick_duration = Metrics().latency('zone_tick')
+"""Time it takes to advance all the zones of a scheduler once"""
+
+
+class Frame(NamedTuple):
+    """A frame of a zone drawn at some tick of its scheduler"""
+    zone_id: str
+    tick: int
+    image: str
+    delta: FrameDelta
+    """
+    Changes to the frame of the previous tick, so it only makes sense to
+    consumers that got the frame of tick - 1; the rest have to use the image
+    """
+    compact: Optional[RunLengthFrame] = None
+    """The same frame run-length encoded, with noise left to the consumer"""
+
+
+class SubscriptionEnded(Exception):
+    """Raised to consumers of a zone that was removed from its scheduler"""
+    pass
+
+
+class FrameSubscription:
+    """
+    Frames of a zone waiting to be consumed, at most max_frames of them.
+    When a consumer falls behind, the oldest frames are dropped, so a slow
+    consumer neither holds the scheduler back nor piles frames up
+    """
+    _end = None
+    """Pushed instead of a frame when the zone is removed"""
+
+    def __init__(self, scheduler: 'ZoneScheduler', zone_id: str,
+                 max_frames: int = 1):
+        self.zone_id = zone_id
+        self.dropped = 0
+        """Number of frames dropped because the consumer fell behind"""
+        self._scheduler = scheduler
+        self._frames: asyncio.Queue = asyncio.Queue(max_frames)
+
+    def push(self, frame: Optional[Frame]):
+        if self._frames.full():
+            self._frames.get_nowait()
+            self.dropped += 1
+        self._frames.put_nowait(frame)
+
+    def end(self):
+        """Make consumers stop waiting for frames, the zone has no more"""
+        self.push(self._end)
+
+    async def get(self) -> Frame:
+        """
+        Wait for the next frame.
+        Raises SubscriptionEnded if the zone was removed
+        """
+        frame = await self._frames.get()
+        if frame is self._end:
+            # the end stays for every later get
+            self._frames.put_nowait(frame)
+            raise SubscriptionEnded(f'Zone {self.zone_id} was removed')
+        return frame
+
+    def close(self):
+        self._scheduler.unsubscribe(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Frame:
+        try:
+            return await self.get()
+        except SubscriptionEnded:
+            raise StopAsyncIteration
+
+
+class ZoneScheduler:
+    """
+    Advances its zones at a fixed rate and hands every new frame to all the
+    subscribers of the zone, so the cost of a zone doesn't depend on how many
+    clients watch it.
+
+    The scheduler and its subscriptions must only be used from one event loop
+    """
+
+    def __init__(self, tick_interval: Optional[float] = None):
+        self.tick_interval = settings.ZONE_TICK_INTERVAL \
+            if tick_interval is None else tick_interval
+        """Seconds between the starts of ticks"""
+        self.ticks = 0
+        """Number of ticks run so far"""
+        self.overruns = 0
+        """Number of ticks that took longer than tick_interval"""
+        self.zones: Dict[str, Zone] = {}
+        self._latest: Dict[str, Frame] = {}
+        self.zone_removed: List[Callable[[str], None]] = []
+        """Called with the id of every removed zone"""
+        self._subscriptions: Dict[str, Set[FrameSubscription]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def add_zone(self, zone_id: str, zone: Zone):
+        self.zones[zone_id] = zone
+        self._subscriptions.setdefault(zone_id, set())
+
+    def remove_zone(self, zone_id: str):
+        """Stop advancing the zone and end all of its subscriptions"""
+        del self.zones[zone_id]
+        self._latest.pop(zone_id, None)
+        for subscription in self._subscriptions.pop(zone_id, ()):
+            subscription.end()
+        for callback in self.zone_removed:
+            callback(zone_id)
+
+    def latest(self, zone_id: str) -> Optional[Frame]:
+        """Get the last frame drawn for the zone, if there is any"""
+        return self._latest.get(zone_id)
+
+    def subscribe(self, zone_id: str, max_frames: int = 1
+                  ) -> FrameSubscription:
+        """
+        Get frames of the zone from now on, starting with the last drawn one
+        """
+        if zone_id not in self.zones:
+            raise KeyError(f'Unknown zone {zone_id!r}')
+        subscription = FrameSubscription(self, zone_id, max_frames)
+        self._subscriptions[zone_id].add(subscription)
+        if zone_id in self._latest:
+            subscription.push(self._latest[zone_id])
+        return subscription
+
+    def unsubscribe(self, subscription: FrameSubscription):
+        self._subscriptions.get(subscription.zone_id, set()) \
+            .discard(subscription)
+
+    def subscribers(self, zone_id: str) -> int:
+        return len(self._subscriptions.get(zone_id, ()))
+
+    async def tick(self):
+        """Update, move and draw every zone once and publish the frames"""
+        started = time.monotonic()
+        self.ticks += 1
+        for zone_id, zone in list(self.zones.items()):
+            try:
+                frame = await self._advance(zone_id, zone)
+            except Exception:
+                # one broken zone must not stop the rest of them
+                logger.exception('Failed to advance zone %s', zone_id)
+                continue
+            if zone_id not in self.zones:
+                # removed while its bodies were being updated
+                continue
+            self._latest[zone_id] = frame
+            for subscription in list(self._subscriptions.get(zone_id, ())):
+                subscription.push(frame)
+        tick_duration.record(time.monotonic() - started)
+
+    async def _advance(self, zone_id: str, zone: Zone) -> Frame:
+        try:
+            await zone.async_update_objects()
+        except RedisError:
+            logger.exception('Failed to update bodies of zone %s, '
+                             'moving the ones it has', zone_id)
+        zone.move_objects()
+        image, delta, compact = zone.draw_tick()
+        return Frame(zone_id, self.ticks, image, delta, compact)
+
+    async def run(self):
+        """
+        Run ticks every tick_interval seconds. Ticks that are missed because
+        of an overrun are skipped rather than run back to back
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time()
+        while True:
+            await self.tick()
+            deadline += self.tick_interval
+            delay = deadline - loop.time()
+            if delay < 0:
+                self.overruns += 1
+                deadline = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
+
+    def start(self):
+        """Start running ticks in the background of the current event loop"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,104 @@
+from collections import defaultdict
+from typing import Dict, Hashable, Iterator, List, NamedTuple, Set, Tuple
+
+
+class Box(NamedTuple):
+    x: int
+    y: int
+    width: int
+    height: int
+
+    def intersects(self, other: 'Box') -> bool:
+        return (self.x < other.x + other.width
+                and other.x < self.x + self.width
+                and self.y < other.y + other.height
+                and other.y < self.y + self.height)
+
+
+class SpatialIndex:
+    """
+    Uniform grid of square buckets, each holding the items whose bounding
+    boxes cross it, so that area lookups only look at nearby items.
+
+    Bucket size should be at least as big as the biggest item, then every
+    item crosses at most 4 buckets
+    """
+
+    def __init__(self, bucket_size: int = 16):
+        self.bucket_size = bucket_size
+        self._buckets: Dict[Tuple[int, int], Set[Hashable]] = defaultdict(set)
+        self._boxes: Dict[Hashable, Box] = {}
+
+    def insert(self, item: Hashable, x: int, y: int, width: int, height: int):
+        if item in self._boxes:
+            self.remove(item)
+        box = Box(x, y, width, height)
+        self._boxes[item] = box
+        for bucket in self._covered_buckets(box):
+            self._buckets[bucket].add(item)
+
+    def remove(self, item: Hashable):
+        box = self._boxes.pop(item)
+        for bucket in self._covered_buckets(box):
+            items = self._buckets[bucket]
+            items.discard(item)
+            if not items:
+                del self._buckets[bucket]
+
+    def move(self, item: Hashable, x: int, y: int):
+        """Update item's position, touching buckets only if it crosses them"""
+        old_box = self._boxes[item]
+        new_box = Box(x, y, old_box.width, old_box.height)
+        self._boxes[item] = new_box
+        old_buckets = self._bucket_range(old_box)
+        new_buckets = self._bucket_range(new_box)
+        if old_buckets == new_buckets:
+            return
+        for bucket in self._covered_buckets(old_box):
+            items = self._buckets[bucket]
+            items.discard(item)
+            if not items:
+                del self._buckets[bucket]
+        for bucket in self._covered_buckets(new_box):
+            self._buckets[bucket].add(item)
+
+    def query(self, x: int, y: int, width: int, height: int) -> List[Hashable]:
+        """Get all items whose bounding boxes intersect the region"""
+        region = Box(x, y, width, height)
+        found = []
+        seen = set()
+        for bucket in self._covered_buckets(region):
+            for item in self._buckets.get(bucket, ()):
+                if item not in seen:
+                    seen.add(item)
+                    if self._boxes[item].intersects(region):
+                        found.append(item)
+        return found
+
+    def box(self, item: Hashable) -> Box:
+        return self._boxes[item]
+
+    def clear(self):
+        self._buckets.clear()
+        self._boxes.clear()
+
+    def __contains__(self, item: Hashable) -> bool:
+        return item in self._boxes
+
+    def __len__(self) -> int:
+        return len(self._boxes)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self._boxes)
+
+    def _bucket_range(self, box: Box) -> Tuple[int, int, int, int]:
+        size = self.bucket_size
+        return (box.x // size, box.y // size,
+                (box.x + box.width - 1) // size,
+                (box.y + box.height - 1) // size)
+
+    def _covered_buckets(self, box: Box) -> Iterator[Tuple[int, int]]:
+        left, top, right, bottom = self._bucket_range(box)
+        for bucket_y in range(top, bottom + 1):
+            for bucket_x in range(left, right + 1):
+                yield bucket_x, bucket_y
@@ -1,14 +1,28 @@
+import logging
+import time
 from collections import namedtuple
-from itertools import repeat
-from operator import attrgetter
-from random import randint, randrange
-from copy import deepcopy
-from typing import Iterable, List, Dict, Optional
-
-from radar.engine.directions_meta import Position
-from radar.engine.moving_objects import MovingObject
-from radar.engine.body_objects import BodyObjectsPool, BodyObject
+from typing import Iterable, List, Dict, Optional, Tuple
+
+from radar.engine.moving_objects import (
+    MovingObject, MovingObjectsStore, MovingObjectSnapshot
+)
+from radar.engine.occupancy import OccupancyGrid, PositionVacancy
+from radar.engine.rendering import (
+    FrameRenderer, FrameDelta, RunLengthFrame, make_delta, make_keyframe
+)
+from radar.engine.spatial import SpatialIndex
+from radar.engine.body_objects import (
+    AsyncBodyObjectsPool, BodyObjectsPool, BodyObject, BodiesCursor,
+    BodiesUpdate
+)
+from radar.validation import body_max_width, body_max_height
 from share.metaclasses import Singleton
+from share.metrics import Metrics
+
+
+logger = logging.getLogger(__name__)
+admission_latency = Metrics().latency('body_admission')
+"""Time from adding a body to placing it in a zone"""
 
 
 class Zone:
@@ -17,8 +31,9 @@ class Zone:
 
     def __init__(self, moving_objects: List[MovingObject],
                  width: int = 300, height: int = 100,
-                 position_vacancy: Optional[List[List[bool]]] = None,
-                 max_objects_amount: int = 60):
+                 position_vacancy: Optional[PositionVacancy] = None,
+                 max_objects_amount: int = 60,
+                 keyframe_interval: int = 30):
         # No big reason for that one, just making sure nobody abuses
         # the computational costs that come with this class
         if width >= 1000 or height >= 1000:
@@ -29,25 +44,49 @@ class Zone:
         self.width = width
         self.height = height
         self.max_objects_amount = max_objects_amount
+        self.keyframe_interval = keyframe_interval
 
         self._check_zone_volume(moving_objects)
-        self.__moving_objects = moving_objects
+        self.__moving_objects = MovingObjectsStore(
+            max(len(moving_objects), max_objects_amount))
+        for obj in moving_objects:
+            # an object can only move in one zone at a time
+            if obj.is_attached and obj not in self.__moving_objects:
+                obj = obj.clone()
+            self.__moving_objects.attach(obj)
 
         self._body_pool = BodyObjectsPool()
+        self._bodies_cursor: Optional[BodiesCursor] = None
+        self._renderer = FrameRenderer(width, height, self.void, self.matter)
+        self._previous_frame: Optional[bytes] = None
+        self._frames_since_keyframe = 0
+        self._spatial_index = SpatialIndex(
+            max(body_max_width, body_max_height) + 1)
 
         # if position vacancy matrix isn't provided, provided moving objects'
         # positions are ignored and overridden
         if position_vacancy is None:
-            self._position_vacancy = [
-                [True for _ in range(width)] for _ in range(height)]
-            self._place_moving_objects(self.__moving_objects)
+            self._position_vacancy = OccupancyGrid(width, height)
+            if self._place_moving_objects(self.__moving_objects):
+                raise TooManyMovingObjectsError(
+                    'There is no space left to place all the moving objects')
         else:
-            self._position_vacancy = position_vacancy
+            self._position_vacancy = OccupancyGrid.make(position_vacancy)
+            for obj in self.__moving_objects:
+                if obj.position is not None:
+                    self._index_moving_object(obj)
 
     @property
-    def moving_objects(self):
-        """Objects moving across zone with each move_objects method call"""
-        return deepcopy(self.__moving_objects)
+    def moving_objects(self) -> Tuple[MovingObjectSnapshot, ...]:
+        """
+        Records of objects moving across zone with each move_objects
+        method call
+        """
+        return self.__moving_objects.snapshot()
+
+    def clone_moving_objects(self) -> List[MovingObject]:
+        """Get detached copies of the zone's moving objects"""
+        return [obj.clone() for obj in self.__moving_objects]
 
     def update_image(self) -> str:
         """Update, move and draw all objects in the zone"""
@@ -55,16 +94,50 @@ class Zone:
         self.move_objects()
         return self.draw()
 
+    def update_image_delta(self) -> FrameDelta:
+        """
+        Update, move and draw all objects in the zone, representing the
+        result as changes to the previous frame
+        """
+        self.update_objects()
+        self.move_objects()
+        return self.draw_delta()
+
+    async def async_update_image(self) -> str:
+        """
+        Same as update_image, but without blocking the event loop
+        while waiting for Redis
+        """
+        await self.async_update_objects()
+        self.move_objects()
+        return self.draw()
+
+    async def async_update_image_delta(self) -> FrameDelta:
+        """
+        Same as update_image_delta, but without blocking the event loop
+        while waiting for Redis
+        """
+        await self.async_update_objects()
+        self.move_objects()
+        return self.draw_delta()
+
     def update_objects(self):
         """
         Check objects status in cache, delete expired ones and add new ones
         if there is a place available
         """
-        update = self._body_pool.update_bodies((obj.body.key for obj
-                                                in self.__moving_objects),
-                                               self.max_objects_amount)
-        self._drop_moving_objects(update['dropped_keys'])
-        self._attach_new_moving_objects(update['new_records'])
+        self._apply_bodies_update(self._body_pool.update_bodies(
+            self.__moving_objects.keys(), self.max_objects_amount,
+            self._bodies_cursor))
+
+    async def async_update_objects(self):
+        """
+        Same as update_objects, but without blocking the event loop
+        while waiting for Redis
+        """
+        self._apply_bodies_update(await AsyncBodyObjectsPool().update_bodies(
+            self.__moving_objects.keys(), self.max_objects_amount,
+            self._bodies_cursor))
 
     def fits_profile(self, profile: 'ZoneProfile') -> bool:
         """
@@ -78,53 +151,67 @@ class Zone:
         moving or in a new direction in the case of collision;
         or don't move them at all in the case they are trapped
         """
-        for obj in self.__moving_objects:
-            attempts = 0
-            while attempts < max_attempts:
-                goto_positions = obj.estimate_movement()
-                if self._are_available(goto_positions):
-                    self._occupy_positions(goto_positions)
-                    freed_positions = obj.move()
-                    self._free_positions(freed_positions)
-                    break
-                else:
-                    obj.evade_collision()
-                    attempts += 1
+        moved_objects = self.__moving_objects.step(self._position_vacancy,
+                                                    max_attempts)
+        for obj in moved_objects:
+            self._spatial_index.move(obj, *obj.position)
+
+    def find_object(self, key: str) -> Optional[MovingObjectSnapshot]:
+        """Get a record of a moving object by its body key"""
+        obj = self.__moving_objects.find(key)
+        return obj.snapshot() if obj is not None else None
+
+    def objects_in_region(self, x: int, y: int,
+                          width: int, height: int
+                          ) -> List[MovingObjectSnapshot]:
+        """Get records of moving objects overlapping the region of the zone"""
+        return [obj.snapshot() for obj
+                in self._spatial_index.query(x, y, width, height)]
 
     def draw(self, positive_noise=3, negative_noise=5):
         """Represent the zone and objects in it as string"""
-        self.__moving_objects.sort(key=attrgetter('position.y'))
-        printable_objects = [_PrintableObject(obj.position.x,
-                                              obj.width,
-                                              obj.position.y,
-                                              obj.get_line_iterator())
-                             for obj in self.__moving_objects]
-        zone_lines = []
-        objects_drawn = 0
-        for y in range(self.height):
-            obj_lines = []
-            for obj in printable_objects[objects_drawn:]:
-                if y < obj.y:
-                    break
-                else:
-                    try:
-                        obj_line_str = next(obj.lines)
-                    except StopIteration:
-                        objects_drawn += 1
-                    else:
-                        obj_lines.append(_ObjectLine(
-                            obj.x, obj.width, obj_line_str))
-            obj_lines.sort(key=attrgetter('x'))
-            line = []
-            x = 0
-            for obj_line in obj_lines:
-                line += self._fill_void(obj_line.x - x)
-                line += obj_line.line
-                x = obj_line.x + obj_line.width
-            line += self._fill_void(self.width - x)
-            self._apply_noise(line, positive_noise, negative_noise)
-            zone_lines.append(''.join(line))
-        return '\n'.join(zone_lines)
+        return self._renderer.render(self.__moving_objects,
+                                     positive_noise, negative_noise)
+
+    def draw_delta(self, positive_noise=3, negative_noise=5) -> FrameDelta:
+        """
+        Represent the zone as changes to the previously drawn delta frame.
+        The first frame and then every keyframe_interval-th one are keyframes
+        """
+        return self.draw_frame(positive_noise, negative_noise)[1]
+
+    def draw_frame(self, positive_noise=3, negative_noise=5
+                   ) -> Tuple[str, FrameDelta]:
+        """
+        Represent the zone both as string and as changes to the previously
+        drawn delta frame, for consumers that need either of them
+        """
+        frame = self.draw(positive_noise, negative_noise)
+        return frame, self._make_delta(frame)
+
+    def draw_tick(self, positive_noise=3, negative_noise=5
+                  ) -> Tuple[str, FrameDelta, RunLengthFrame]:
+        """
+        Represent the zone the ways draw_frame and draw_compact do at once,
+        composing the frame only once
+        """
+        frame, compact = self._renderer.render_both(
+            self.__moving_objects, positive_noise, negative_noise)
+        return frame, self._make_delta(frame), compact
+
+    def draw_compact(self, positive_noise=3, negative_noise=5
+                     ) -> RunLengthFrame:
+        """
+        Represent the zone as run-length encoded rows, leaving the noise
+        to the client. Takes far less space than the string of the zone
+        and doesn't need the string to be made
+        """
+        return self._renderer.render_runs(self.__moving_objects,
+                                          positive_noise, negative_noise)
+
+    def request_keyframe(self):
+        """Make the next delta frame a keyframe"""
+        self._previous_frame = None
 
     def __str__(self):
         return self.draw()
@@ -135,10 +222,7 @@ class Zone:
         ignoring their body strings and only accounting for their profile.
         Useful for debugging.
         """
-        lines = (''.join((self.void if vacant else self.matter
-                          for vacant in line))
-                 for line in self._position_vacancy)
-        return '\n'.join(lines)
+        return self._position_vacancy.draw(self.void, self.matter)
 
     def _check_zone_volume(self, moving_objects):
         """
@@ -181,78 +265,83 @@ class Zone:
             max_height_on_line = obj.height
         return line_width, max_height_on_line
 
-    def _place_moving_objects(self, moving_objects):
+    def _place_moving_objects(self, moving_objects: Iterable[MovingObject]
+                              ) -> List[MovingObject]:
+        """
+        Put objects that don't have a position yet in random vacant places
+        and return the objects that don't fit anywhere
+        """
+        unplaced = []
         for obj in moving_objects:
-            while obj.position is None:
-                x = randint(0, self.width - obj.width)
-                y = randint(0, self.height - obj.height)
-                if self._region_is_vacant(x, y, obj.width, obj.height):
-                    obj.position = Position(x, y)
-                    self._occupy_region(x, y, obj.width, obj.height)
-
-    def _attach_new_moving_objects(self, records: Dict[str, str]):
-        new_moving_objects = (MovingObject(BodyObject.generate(key, body_str))
-                              for key, body_str in records.items())
-        self.__moving_objects.extend(new_moving_objects)
-        self._place_moving_objects(new_moving_objects)
+            if obj.position is not None:
+                continue
+            position = self._position_vacancy.random_fitting_position(
+                obj.width, obj.height)
+            if position is None:
+                unplaced.append(obj)
+                continue
+            obj.position = position
+            self._occupy_region(*position, obj.width, obj.height)
+            self._index_moving_object(obj)
+        return unplaced
+
+    def _apply_bodies_update(self, update: BodiesUpdate):
+        self._bodies_cursor = update['cursor']
+        self._drop_moving_objects(update['dropped_keys'])
+        if not self._attach_new_moving_objects(update['new_records'],
+                                               update['arrivals']):
+            # bodies that didn't fit have to be requested again
+            self._bodies_cursor = None
+
+    def _attach_new_moving_objects(self, records: Dict[str, str],
+                                   arrivals: Dict[str, float]) -> bool:
+        """
+        Attach and place objects with the new bodies, recording how long
+        the placed ones took to appear since they arrived.
+        Returns whether all of them were placed
+        """
+        new_moving_objects = [MovingObject(BodyObject.generate(key, body_str))
+                              for key, body_str in records.items()]
+        for obj in new_moving_objects:
+            self.__moving_objects.attach(obj)
+        unplaced = self._place_moving_objects(new_moving_objects)
+        for obj in unplaced:
+            logger.debug('No space left in the zone for %s', obj)
+            self.__moving_objects.detach(obj)
+        now = time.time() * 1000
+        for obj in new_moving_objects:
+            if obj.is_attached and obj.body.key in arrivals:
+                admission_latency.record(
+                    max(now - arrivals[obj.body.key], 0) / 1000)
+        return not unplaced
 
     def _drop_moving_objects(self, keys: List[str]):
-        for key in keys:
-            dropped_obj_idx = next(i for i, obj
-                                   in enumerate(self.__moving_objects)
-                                   if obj.body.key == key)
-            obj = self.__moving_objects.pop(dropped_obj_idx)
+        for obj in self.__moving_objects.detach_keys(keys):
             self._free_region(obj.position.x, obj.position.y,
                               obj.width, obj.height)
-
-    def _region_is_vacant(self, x, y, width, height):
-        region_vacancy = ((self._position_vacancy[i][j] for j in
-                           range(x, x + width) for i in range(y, y + height)))
-        return all(region_vacancy)
+            if obj in self._spatial_index:
+                self._spatial_index.remove(obj)
+
+    def _index_moving_object(self, obj: MovingObject):
+        self._spatial_index.insert(obj, obj.position.x, obj.position.y,
+                                   obj.width, obj.height)
+
+    def _make_delta(self, frame: str) -> FrameDelta:
+        encoded_frame = frame.encode('ascii')
+        previous_frame = self._previous_frame
+        self._previous_frame = encoded_frame
+        self._frames_since_keyframe += 1
+        if previous_frame is None \
+                or self._frames_since_keyframe >= self.keyframe_interval:
+            self._frames_since_keyframe = 0
+            return make_keyframe(frame)
+        return make_delta(previous_frame, encoded_frame, self.width)
 
     def _free_region(self, x, y, width, height):
-        self._change_region_vacancy(x, y, width, height, True)
+        self._position_vacancy.free_region(x, y, width, height)
 
     def _occupy_region(self, x, y, width, height):
-        self._change_region_vacancy(x, y, width, height, False)
-
-    def _change_region_vacancy(self, x, y, width, height, vacancy):
-        for i in range(y, y + height):
-            for j in range(x, x + width):
-                self._position_vacancy[i][j] = vacancy
-
-    def _free_positions(self, positions):
-        self._change_positions_vacancy(positions, True)
-
-    def _occupy_positions(self, positions):
-        self._change_positions_vacancy(positions, False)
-
-    def _change_positions_vacancy(self, positions, vacancy):
-        for p in positions:
-            self._position_vacancy[p.y][p.x] = vacancy
-
-    def _are_available(self, positions):
-        try:
-            positions_vacancy = (
-                p.x >= 0 and p.y >= 0 and self._position_vacancy[p.y][p.x]
-                for p in positions
-            )
-            return all(positions_vacancy)
-        except IndexError:
-            return False
-
-    def _apply_noise(self, zone_line, positive_noise, negative_noise):
-        self._add_distortion(zone_line, positive_noise, self.matter)
-        self._add_distortion(zone_line, negative_noise, self.void)
-
-    def _add_distortion(self, zone_line, percent, symbol):
-        distorted_positions = int(self.width * percent / 100)
-        for _ in range(distorted_positions):
-            x = randrange(0, self.width)
-            zone_line[x] = symbol
-
-    def _fill_void(self, num):
-        return list(repeat(self.void, num))
+        self._position_vacancy.occupy_region(x, y, width, height)
 
 
 class TooManyMovingObjectsError(ValueError):
@@ -263,8 +352,6 @@ class TooManyMovingObjectsError(ValueError):
     pass
 
 
-_PrintableObject = namedtuple('_PrintableObject', ('x', 'width', 'y', 'lines'))
-_ObjectLine = namedtuple('_ObjectLine', ('x', 'width', 'line'))
 ObjectRequest = namedtuple('ObjectRequest', ('body_obj', 'num'))
 ZoneProfile = namedtuple('ZoneProfile', ('width', 'height'))
 
@@ -322,7 +409,7 @@ class ZoneBuilder(metaclass=Singleton):
 
     @classmethod
     def create_small_zone(cls, moving_objects: List[MovingObject],
-                          position_vacancy: Optional[List[List[bool]]] = None) -> Zone:
+                          position_vacancy: Optional[PositionVacancy] = None) -> Zone:
         """
         Creates a Zone instance with small profile
         """
@@ -332,7 +419,7 @@ class ZoneBuilder(metaclass=Singleton):
     @classmethod
     def create_medium_zone(cls, moving_objects: List[MovingObject],
                            position_vacancy: Optional[
-                           List[List[bool]]] = None) -> Zone:
+                           PositionVacancy] = None) -> Zone:
         """
         Creates a Zone instance with medium profile
         """
@@ -342,7 +429,7 @@ class ZoneBuilder(metaclass=Singleton):
     @classmethod
     def create_large_zone(cls, moving_objects: List[MovingObject],
                           position_vacancy: Optional[
-                          List[List[bool]]] = None) -> Zone:
+                          PositionVacancy] = None) -> Zone:
         """
         Creates a Zone instance with large profile
         """
@@ -352,7 +439,7 @@ class ZoneBuilder(metaclass=Singleton):
     @staticmethod
     def create_custom_zone(moving_objects: List[MovingObject],
                            width: int, height: int,
-                           position_vacancy: Optional[List[List[bool]]] = None) -> Zone:
+                           position_vacancy: Optional[PositionVacancy] = None) -> Zone:
         """
         Creates a Zone instance with set profile
         """
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from radar.engine.body_objects import BodyObjectsPool
+
+
+class Command(BaseCommand):
+    help = 'Move bodies cached as separate Redis keys into the body registry'
+
+    def handle(self, *args, **options):
+        moved = BodyObjectsPool().migrate_body_keys()
+        self.stdout.write(f'Moved {moved} bodies into the body registry')
@@ -1,4 +1,6 @@
+import asyncio
 from typing import Tuple
+from caching.connections import AsyncRedisConnections
 from radar.engine.directions_meta import Position
 
 from radar.tests.engine._moving import assert_pos_moved
@@ -9,3 +11,16 @@ def make_positions(*coordinates: Tuple[int, int]):
     for x, y in coordinates:
         positions.append(Position(x, y))
     return positions
+
+
+def run_async(coroutine):
+    """
+    Run the coroutine in a new event loop, closing the connections
+    of the shared async pool in the end, since they are bound to the loop
+    """
+    async def run():
+        try:
+            return await coroutine
+        finally:
+            await AsyncRedisConnections().pool.disconnect()
+    return asyncio.run(run())
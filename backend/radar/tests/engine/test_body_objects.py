@@ -1,9 +1,15 @@
 import pytest
 import redis
+import time
 import uuid
+from copy import deepcopy
 from unittest.mock import Mock
 from backend import settings
-from radar.engine.body_objects import BodyObjectsPool
+from radar.engine.body_objects import (
+    BodyObjectsPool, BodyObject, BodiesCursor, BodiesUpdate, BodyTable,
+    BodyEventsListener, AsyncBodyObjectsPool
+)
+from radar.tests.engine.share import run_async
 
 
 @pytest.fixture(scope='session')
@@ -30,8 +36,8 @@ def test_add_body(pool, new_body, r):
     body_key = pool.make_body_key(body_id)
 
     pool.add_body(new_body, body_id)
-    assert r.exists(body_key), "Can't find added bodies"
-    assert r.get(body_key).decode() == new_body, \
+    assert r.zscore(pool.expiry_key, body_key), "Can't find added bodies"
+    assert r.hget(pool.registry_key, body_key).decode() == new_body, \
         "The bodies added to Redis aren't the same as original bodies"
 
 
@@ -40,21 +46,206 @@ def test_ping_body(pool, r):
     body_id = str(uuid.uuid4())
     body_key = pool.make_body_key(body_id)
 
-    r.set(body_key, '~', pool.body_expiration - 1)
+    pool.add_body('~', body_id)
+    expiry = r.zscore(pool.expiry_key, body_key)
+    time.sleep(0.01)
     pool.ping_body(body_id)
-    assert r.ttl(body_key) == pool.body_expiration
+    assert r.zscore(pool.expiry_key, body_key) > expiry, \
+        "Body's expiration time hasn't been reset"
 
 
 @pytest.mark.django_db
-def test_update_bodies(pool, r):
+def test_add_bodies(pool, new_body, r):
+    body_ids = [str(uuid.uuid4()) for _ in range(3)]
+    errors = pool.add_bodies({body_ids[0]: new_body,
+                              body_ids[1]: 'o\n' * 20,
+                              body_ids[2]: new_body})
+    assert errors[body_ids[0]] is None and errors[body_ids[2]] is None
+    assert isinstance(errors[body_ids[1]], ValueError), \
+        'Invalid bodies have to be reported'
+    assert [r.hget(pool.registry_key, pool.make_body_key(body_id))
+            for body_id in body_ids] == [new_body.encode(), None,
+                                         new_body.encode()]
+
+    with pytest.raises(ValueError):
+        pool.add_body('o\n' * 20, body_ids[1])
+
+
+@pytest.mark.django_db
+def test_add_bodies_with_malformed_bodies(pool, new_body, r):
+    body_ids = [str(uuid.uuid4()) for _ in range(3)]
+    errors = pool.add_bodies({body_ids[0]: '',
+                              body_ids[1]: 5,
+                              body_ids[2]: new_body})
+    assert isinstance(errors[body_ids[0]], ValueError)
+    assert isinstance(errors[body_ids[1]], ValueError)
+    assert errors[body_ids[2]] is None, \
+        'Malformed bodies must not abort the rest of the batch'
+    assert r.hget(pool.registry_key, pool.make_body_key(body_ids[2])) == \
+        new_body.encode()
+
+
+@pytest.mark.django_db
+def test_ping_bodies(pool, new_body, r):
+    body_ids = [str(uuid.uuid4()) for _ in range(3)]
+    pool.add_bodies({body_id: new_body for body_id in body_ids[:2]})
+    assert pool.ping_bodies(body_ids) == {body_ids[0]: True,
+                                          body_ids[1]: True,
+                                          body_ids[2]: False}
+    assert pool.ping_bodies([]) == {}
+
+
+@pytest.mark.django_db
+def test_update_bodies(pool, r, monkeypatch):
     dropped_keys = ['a', 'b']
     new_records = {'c': '1', 'd': '2'}
-    pool._scripts.update_records = Mock(
+    monkeypatch.setattr(pool._scripts, 'update_registry', Mock(
         return_value='{"dropped_keys":' + str(dropped_keys).replace("'", '"') +
                      ',"new_records":' + str(new_records).replace("'",
-                                                                  '"') + '}'
-    )
+                                                                  '"') +
+                     ',"arrivals":[["c",1],["d",2]],'
+                     '"generation":5,"next_expiry":null}'
+    ))
     update = pool.update_bodies(['dummy', 'data'], 10)
     assert update['dropped_keys'] == dropped_keys and \
            update['new_records'] == new_records, \
            'Incorrect json handling'
+    assert update['arrivals'] == {'c': 1, 'd': 2}
+    assert update['cursor'] == BodiesCursor(5, None)
+
+
+@pytest.mark.django_db
+def test_update_bodies_with_cursor(pool, new_body, monkeypatch):
+    update = pool.update_bodies([], 10)
+    monkeypatch.setattr(pool._scripts, 'update_registry',
+                        Mock(wraps=pool._scripts.update_registry))
+
+    repeated_update = pool.update_bodies([], 10, update['cursor'])
+    assert not pool._scripts.update_registry.called, \
+        "Update script doesn't have to run if the body set hasn't changed"
+    assert repeated_update == BodiesUpdate(dropped_keys=[], new_records={},
+                                           arrivals={},
+                                           cursor=update['cursor'])
+
+    pool.add_body(new_body, str(uuid.uuid4()))
+    pool.update_bodies([], 10, update['cursor'])
+    assert pool._scripts.update_registry.called, \
+        'Added bodies have to be looked up'
+
+    expired_cursor = BodiesCursor(update['cursor'].generation,
+                                  time.time() * 1000)
+    pool._scripts.update_registry.reset_mock()
+    pool.update_bodies([], 10, expired_cursor)
+    assert pool._scripts.update_registry.called, \
+        'Expired bodies have to be looked up'
+
+
+@pytest.mark.django_db
+def test_migrate_body_keys(pool, new_body, r):
+    body_key = pool.make_body_key(str(uuid.uuid4()))
+    r.set(body_key, new_body, pool.body_expiration)
+    assert pool.migrate_body_keys() >= 1
+    assert r.hget(pool.registry_key, body_key).decode() == new_body
+
+
+@pytest.mark.django_db
+def test_async_pool(new_body, r, monkeypatch):
+    pool = AsyncBodyObjectsPool()
+    body_ids = [str(uuid.uuid4()) for _ in range(2)]
+    body_keys = [pool.sync_pool.make_body_key(body_id)
+                 for body_id in body_ids]
+
+    async def use_pool():
+        errors = await pool.add_bodies({body_ids[0]: new_body,
+                                        body_ids[1]: 'o\n' * 20})
+        assert errors[body_ids[0]] is None
+        with pytest.raises(ValueError):
+            await pool.add_body('o\n' * 20, body_ids[1])
+        assert await pool.ping_bodies(body_ids) == {body_ids[0]: True,
+                                                    body_ids[1]: False}
+
+        update = await pool.update_bodies([], 10 ** 6)
+        assert update['new_records'][body_keys[0]] == new_body
+        monkeypatch.setattr(pool._scripts, 'update_registry', Mock())
+        assert await pool.update_bodies([], 10 ** 6, update['cursor']) == \
+            BodiesUpdate(dropped_keys=[], new_records={}, arrivals={},
+                         cursor=update['cursor'])
+        assert not pool._scripts.update_registry.called
+
+    run_async(use_pool())
+    assert r.hget(pool.sync_pool.registry_key, body_keys[0]).decode() == \
+        new_body
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.mark.django_db
+def test_subscribe(pool, new_body, monkeypatch):
+    monkeypatch.setattr(BodyEventsListener, 'purge_interval', 0.01)
+    table = pool.subscribe()
+    try:
+        assert pool.subscribe() is table, \
+            'There has to be one listener per process'
+        assert wait_for(pool._listener.ready.is_set)
+
+        body_id = str(uuid.uuid4())
+        body_key = pool.make_body_key(body_id)
+        pool.add_body(new_body, body_id)
+        assert wait_for(lambda: body_key in table), \
+            "Added bodies haven't reached the body table"
+        monkeypatch.setattr(pool._scripts, 'update_registry', Mock())
+        assert body_key in pool.update_bodies([], 10 ** 6)['new_records']
+        assert not pool._scripts.update_registry.called, \
+            'Subscribed pool has to make updates from the body table'
+
+        monkeypatch.setattr(pool, 'body_expiration', 0.01)
+        pool.ping_body(body_id)
+        assert wait_for(lambda: body_key not in table), \
+            "Expired bodies haven't been removed from the body table"
+    finally:
+        pool.unsubscribe()
+
+
+def test_body_table_update():
+    table = BodyTable()
+    table.reset({'a': '1', 'b': '2'}, {'a': 1, 'b': 2})
+    table.apply({'added': {'d': '4', 'c': '3'}, 'arrived': 3})
+    table.apply({'added': {'d': '5'}, 'arrived': 4})
+    table.apply({'expired': ['a', 'unknown']})
+    assert len(table) == 3
+
+    update = table.update(['a', 'b', 'b'], 4)
+    assert update['dropped_keys'] == ['a']
+    assert list(update['new_records'].items()) == [('d', '5'), ('c', '3')], \
+        'New records have to be given in the order of arrival'
+    assert update['arrivals'] == {'c': 3, 'd': 3}, \
+        'Replaced bodies have to keep their arrival time'
+    assert len(table.update(['a', 'b', 'b'], 3)['new_records']) == 1, \
+        'Only bodies that fit the capacity have to be given'
+
+
+def test_generate_body_object(new_body):
+    body = BodyObject.generate('key', new_body)
+    assert body.rows == ('o--o', '-oo-', 'o--o')
+    assert (body.width, body.height) == (4, 3)
+    assert body.pixels.tobytes() == b'o--o-oo-o--o'
+
+
+def test_body_objects_are_interned(new_body):
+    assert BodyObject.generate('key', new_body) is \
+           BodyObject.generate('key', new_body), \
+           'Every record has to be parsed only once'
+    assert BodyObject.generate('key', new_body).shape is \
+           BodyObject.generate('other key', new_body).shape, \
+           'Bodies that look alike have to share their shape'
+    assert BodyObject.generate('key', new_body) != \
+           BodyObject.generate('other key', new_body)
+    assert deepcopy(BodyObject.generate('key', new_body)) is \
+           BodyObject.generate('key', new_body)
@@ -1,6 +1,8 @@
 import pytest
+import numpy as np
 from radar.engine.directions_meta import Position
-from radar.engine.directions import DirectionPool
+from radar.engine.directions import DirectionPool, risk_zones
+from radar.engine.occupancy import OccupancyGrid
 from radar.tests.engine.share import make_positions
 
 
@@ -59,3 +61,62 @@ def test_positions_freed_by_movement(direction, expected_output):
            == set(expected_output), \
            'Incorrect prediction for positions freed by moving ' \
            f'{direction.name} from {start_pos}'
+
+
+@pytest.mark.parametrize('direction', DirectionPool.values)
+def test_risk_zone_table(direction):
+    for width in range(1, risk_zones.max_width + 1):
+        for height in range(1, risk_zones.max_height + 1):
+            expected = direction._risk_zone_provider(start_pos, width=width,
+                                                     height=height)
+            assert direction.positions_to_occupy_by_movement(
+                start_pos, width, height) == expected, \
+                f'Precomputed risk zone of {direction.name} for ' \
+                f'{width}x{height} differs from the provided one'
+
+
+def test_cells_to_occupy_by_movement():
+    direction = DirectionPool.top_left
+    xs, ys = direction.cells_to_occupy_by_movement(start_pos, width, height)
+    assert set(zip(xs.tolist(), ys.tolist())) == \
+           set(occupy_when_moving_top_left)
+
+
+def test_translate_risk_zones():
+    directions = [DirectionPool.left, DirectionPool.bottom_right]
+    sizes = [(4, 6), (2, 3)]
+    positions = [start_pos, Position(10, 0)]
+    owners, xs, ys = risk_zones.translate(
+        np.array([direction.code for direction in directions]),
+        np.array([pos.x for pos in positions]),
+        np.array([pos.y for pos in positions]),
+        np.array([w for w, _ in sizes]), np.array([h for _, h in sizes]))
+    for i, direction in enumerate(directions):
+        translated = {Position(x, y) for x, y
+                      in zip(xs[owners == i].tolist(),
+                             ys[owners == i].tolist())}
+        assert translated == direction.positions_to_occupy_by_movement(
+            positions[i], *sizes[i])
+
+
+def test_feasible_directions():
+    grid = OccupancyGrid(width + 2, height + 2)
+    assert set(DirectionPool.feasible_directions(grid, Position(1, 1),
+                                                 width, height)) \
+        == set(DirectionPool.values)
+
+    grid.occupy_region(width + 1, 0, 1, height + 2)
+    grid.occupy_region(0, 0, width + 2, 1)
+    feasible = DirectionPool.feasible_directions(grid, Position(1, 1),
+                                                 width, height)
+    assert set(feasible) == {DirectionPool.left, DirectionPool.down,
+                             DirectionPool.bottom_left}, \
+        'Directions with occupied risk zones have to be excluded'
+
+
+def test_no_feasible_directions():
+    grid = OccupancyGrid(width, height)
+    assert DirectionPool.feasible_directions(grid, Position(0, 0),
+                                             width, height) == []
+    assert DirectionPool.random_feasible_direction(grid, Position(0, 0),
+                                                   width, height) is None
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import pytest
+from unittest import mock
+
+from radar.engine import frame_cache
+from radar.engine.frame_cache import FrameCache, frame_cache_hits
+from radar.engine.rendering import (
+    RunLengthFrame, make_delta, make_keyframe
+)
+from radar.engine.scheduler import Frame
+from radar.tests.engine.share import run_async
+
+
+def make_frames(zone_id='test', ticks=3):
+    images = ['-' * (tick % 4) + 'o' + '-' * (3 - tick % 4) + '\n----'
+              for tick in range(ticks)]
+    frames = [Frame(zone_id, 1, images[0], make_keyframe(images[0]))]
+    for tick in range(1, ticks):
+        frames.append(Frame(zone_id, tick + 1, images[tick], make_delta(
+            images[tick - 1].encode(), images[tick].encode(), 4)))
+    return frames
+
+
+@pytest.fixture
+def hits():
+    frame_cache_hits.reset()
+    yield frame_cache_hits
+    frame_cache_hits.reset()
+
+
+def test_encode(hits):
+    first, second = make_frames(ticks=2)
+    cache = FrameCache()
+    encoded = [cache.encode(frame)
+               for frame in (first, second, second, second)]
+    assert encoded[0].keyframe == encoded[0].delta
+    assert json.loads(encoded[0].keyframe)['image'] == first.image
+    delta = json.loads(encoded[1].delta)
+    assert (delta['zone'], delta['tick'], delta['keyframe']) == \
+        ('test', 2, False)
+    assert second.delta.apply(first.image) == second.image
+    assert encoded[3] is encoded[2] is encoded[1], \
+        'All the viewers have to get the same encoded frame'
+    assert (hits.hits, hits.misses) == (2, 2)
+
+
+def test_concurrent_viewers_encode_once(monkeypatch):
+    frame = make_frames(ticks=1)[0]
+    cache = FrameCache()
+    encode = mock.Mock(wraps=frame_cache.encode_frame)
+    monkeypatch.setattr(frame_cache, 'encode_frame', encode)
+
+    async def view():
+        await asyncio.sleep(0)
+        return cache.encode(frame)
+
+    async def watch():
+        return await asyncio.gather(*(view() for _ in range(20)))
+
+    encoded = run_async(watch())
+    assert all(viewed is encoded[0] for viewed in encoded)
+    assert encode.call_count == 1, 'A frame has to be encoded once'
+
+
+def test_old_ticks_are_evicted():
+    cache = FrameCache(max_ticks=2)
+    for frame in make_frames(ticks=3):
+        cache.encode(frame)
+    oldest, *latest = [cache.get('test', tick) for tick in (1, 2, 3)]
+    assert oldest is None and all(latest)
+    cache.forget('test')
+    assert cache.get('test', 3) is None
+
+
+def test_encode_compact():
+    first, second = make_frames(ticks=2)
+    compact = RunLengthFrame((('o-', (1, 3)), ('-', (4,))), 3, 5)
+    encoded = FrameCache().encode(second._replace(compact=compact))
+    message = json.loads(encoded.compact)
+    assert message['rows'] == [['o-', [1, 3]], ['-', [4]]]
+    assert message['noise'] == [3, 5]
+    encoded = FrameCache().encode(first)
+    assert encoded.compact == encoded.keyframe, \
+        'Frames without compact form have to fall back to keyframes'
@@ -1,6 +1,10 @@
 import pytest
-from radar.engine.body_objects import BodyObjectsPool
-from radar.engine.moving_objects import MovingObject, Position
+from radar.engine.body_objects import BodyObjectsPool, BodyObject
+from radar.engine.directions import DirectionPool
+from radar.engine.moving_objects import (
+    MovingObject, MovingObjectsStore, Position
+)
+from radar.engine.occupancy import OccupancyGrid
 from radar.tests.engine.share import assert_pos_moved
 
 
@@ -47,8 +51,136 @@ def test_evade_collision(moving_obj):
     assert estimate_before != estimate_after
 
 
+def test_evade_collision_on_grid(moving_obj):
+    x, y = moving_obj.position
+    grid = OccupancyGrid(x + moving_obj.width + 1, y + moving_obj.height + 1)
+    grid.occupy_region(x, y, moving_obj.width, moving_obj.height)
+    grid.occupy_region(x + moving_obj.width, 0, 1, grid.height)
+    grid.occupy_region(0, 0, grid.width, 1)
+
+    assert moving_obj.evade_collision(grid)
+    assert moving_obj.direction in {DirectionPool.left, DirectionPool.down,
+                                    DirectionPool.bottom_left}, \
+        'Object has to evade collision in a free direction'
+
+    grid.occupy_region(0, 0, grid.width, grid.height)
+    direction = moving_obj.direction
+    assert not moving_obj.evade_collision(grid)
+    assert moving_obj.direction is direction
+
+
 def test_get_line_iterator(moving_obj):
-    str_body = moving_obj.body.matrix
+    str_body = list(moving_obj.body.rows)
     iter_body = list(moving_obj.get_line_iterator())
     assert str_body == iter_body
 
+
+
+@pytest.fixture
+def store():
+    return MovingObjectsStore(capacity=2)
+
+
+def _footprints(objects, width, height):
+    grid = OccupancyGrid(width, height)
+    for obj in objects:
+        x, y = obj.position
+        assert grid.region_is_vacant(x, y, obj.width, obj.height), \
+            'Moving objects overlap'
+        grid.occupy_region(x, y, obj.width, obj.height)
+    return grid
+
+
+def test_attach_and_detach(store, moving_obj):
+    direction = moving_obj.direction
+    store.attach(moving_obj)
+    assert moving_obj in store
+    assert moving_obj.position == Position(1, 1)
+    assert moving_obj.direction is direction
+
+    moving_obj.position = Position(2, 3)
+    store.detach(moving_obj)
+    assert moving_obj not in store
+    assert len(store) == 0
+    assert moving_obj.position == Position(2, 3), \
+        'Detached object lost the state it had in the store'
+
+
+def test_attach_grows_store(store, body_pool):
+    objects = [MovingObject(body_pool.first, Position(i, i))
+               for i in range(5)]
+    for obj in objects:
+        store.attach(obj)
+    assert list(store) == objects
+    assert [obj.position for obj in objects] == \
+           [Position(i, i) for i in range(5)]
+
+
+def test_step(store, body_pool):
+    width, height = 60, 40
+    objects = [MovingObject(body_pool.first, Position(x, y))
+               for x, y in ((0, 0), (20, 0), (40, 10), (0, 20), (30, 25))]
+    grid = _footprints(objects, width, height)
+    for obj in objects:
+        store.attach(obj)
+
+    for _ in range(50):
+        positions_before = {obj: obj.position for obj in objects}
+        moved = store.step(grid)
+        for obj in objects:
+            if obj in moved:
+                assert_pos_moved(positions_before[obj], obj.position,
+                                 obj.direction.name, fail_on_unmoved=True)
+            else:
+                assert obj.position == positions_before[obj]
+        assert grid.tolist() == _footprints(objects, width, height).tolist(), \
+            'Occupancy grid went out of sync with moving objects'
+
+
+def test_step_resolves_contests(store, body_pool):
+    body = body_pool.first
+    grid = OccupancyGrid(body.width * 2 + 1, body.height)
+    left = MovingObject(body, Position(0, 0))
+    right = MovingObject(body, Position(body.width + 1, 0))
+    left.direction = DirectionPool.right
+    right.direction = DirectionPool.left
+    for obj in (left, right):
+        grid.occupy_region(*obj.position, obj.width, obj.height)
+        store.attach(obj)
+
+    assert store.step(grid, max_attempts=1) == [left], \
+        'Only one of objects competing for a position can move'
+    assert right.position == Position(body.width + 1, 0)
+
+
+def test_step_leaves_trapped_objects(store, body_pool):
+    body = body_pool.first
+    grid = OccupancyGrid(body.width, body.height)
+    obj = MovingObject(body, Position(0, 0))
+    grid.occupy_region(0, 0, body.width, body.height)
+    store.attach(obj)
+    assert store.step(grid) == []
+    assert obj.position == Position(0, 0)
+
+
+def test_lookup_by_key(store):
+    bodies = [BodyObject.generate(key, 'oo\noo') for key in 'abc']
+    objects = [MovingObject(body, Position(i * 3, 0))
+               for i, body in enumerate(bodies + bodies[:1])]
+    for obj in objects:
+        store.attach(obj)
+
+    assert sorted(store.keys()) == ['a', 'a', 'b', 'c']
+    assert store.find('b') is objects[1]
+    assert store.find('d') is None
+
+    detached = store.detach_keys(['a', 'c', 'd'])
+    assert len(detached) == 2
+    assert sorted(obj.body.key for obj in detached) == ['a', 'c']
+    assert all(not obj.is_attached for obj in detached)
+    assert sorted(store.keys()) == ['a', 'b']
+    assert store.find('c') is None
+    assert len(store) == 2
+
+    store.detach(store.find('a'))
+    assert store.keys() == ['b'], 'Keys of detached objects are still known'
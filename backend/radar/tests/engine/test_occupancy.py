@@ -0,0 +1,87 @@
+import pytest
+from radar.engine.occupancy import OccupancyGrid
+from radar.tests.engine.share import make_positions
+
+
+@pytest.fixture
+def grid():
+    return OccupancyGrid(10, 5)
+
+
+def test_from_matrix():
+    matrix = [[True, False, True],
+              [False, True, True]]
+    grid = OccupancyGrid.from_matrix(matrix)
+    assert (grid.width, grid.height) == (3, 2)
+    assert grid.tolist() == matrix, \
+        'Grid created from a matrix has a different vacancy state'
+
+
+def test_make_keeps_grid(grid):
+    assert OccupancyGrid.make(grid) is grid
+
+
+def test_occupy_and_free_region(grid):
+    grid.occupy_region(2, 1, 3, 2)
+    assert not grid.region_is_vacant(0, 0, 3, 2)
+    assert grid.region_is_vacant(5, 0, 5, 5)
+    assert grid.region_is_vacant(0, 3, 10, 2)
+
+    grid.free_region(2, 1, 3, 2)
+    assert grid.region_is_vacant(0, 0, 10, 5)
+
+
+@pytest.mark.parametrize('x, y, width, height', [
+    (-1, 0, 2, 2), (0, -1, 2, 2), (9, 0, 2, 2), (0, 4, 2, 2)
+])
+def test_region_out_of_bounds(grid, x, y, width, height):
+    assert not grid.region_is_vacant(x, y, width, height), \
+        'Regions crossing the grid border must not be considered vacant'
+
+
+def test_are_available(grid):
+    positions = make_positions((0, 0), (9, 4), (5, 2))
+    assert grid.are_available(positions)
+
+    grid.occupy_positions(positions[1:2])
+    assert not grid.are_available(positions)
+
+    grid.free_positions(positions[1:2])
+    assert grid.are_available(positions)
+
+
+@pytest.mark.parametrize('position', [(-1, 0), (0, -1), (10, 0), (0, 5)])
+def test_are_available_out_of_bounds(grid, position):
+    assert not grid.are_available(make_positions(position))
+
+
+def test_draw(grid):
+    grid.occupy_region(1, 1, 2, 1)
+    drawing = grid.draw('-', 'o')
+    lines = drawing.splitlines()
+    assert len(lines) == grid.height
+    assert all(len(line) == grid.width for line in lines)
+    assert lines[1] == '-oo-------'
+
+
+def test_fitting_positions(grid):
+    grid.occupy_region(3, 1, 2, 2)
+    grid.occupy_positions(make_positions((8, 4)))
+    xs, ys = grid.fitting_positions(3, 2)
+    expected = {(x, y) for x in range(grid.width - 2)
+                for y in range(grid.height - 1)
+                if grid.region_is_vacant(x, y, 3, 2)}
+    assert set(zip(xs.tolist(), ys.tolist())) == expected, \
+        'Summed-area table gives wrong fitting positions'
+
+    grid.free_region(3, 1, 2, 2)
+    xs, _ = grid.fitting_positions(3, 2)
+    assert len(xs) > len(expected), 'Summed-area table is outdated'
+
+
+def test_random_fitting_position(grid):
+    grid.occupy_region(0, 0, 10, 5)
+    grid.free_region(6, 2, 2, 3)
+    assert grid.random_fitting_position(2, 3) == (6, 2)
+    assert grid.random_fitting_position(3, 3) is None
+    assert grid.random_fitting_position(11, 1) is None
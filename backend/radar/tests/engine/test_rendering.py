@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from unittest import mock
+from radar.engine.body_objects import BodyObject
+from radar.engine.moving_objects import MovingObject, Position
+from radar.engine.rendering import (
+    FrameRenderer, encode_runs, make_delta, make_keyframe
+)
+
+
+width = 12
+height = 6
+
+
+@pytest.fixture
+def renderer():
+    return FrameRenderer(width, height, '-', 'o')
+
+
+@pytest.fixture
+def moving_objects():
+    body = BodyObject.generate('key', 'o-o\n'
+                                      '-o-')
+    return [MovingObject(body, Position(0, 0)),
+            MovingObject(body, Position(9, 4)),
+            MovingObject(body, Position(4, 2))]
+
+
+def test_render_without_noise(renderer, moving_objects):
+    frame = renderer.render(moving_objects, 0, 0)
+    assert frame == 'o-o---------\n' \
+                    '-o----------\n' \
+                    '----o-o-----\n' \
+                    '-----o------\n' \
+                    '---------o-o\n' \
+                    '----------o-', \
+        'Objects are drawn in the wrong place'
+
+
+def test_render_is_repeatable(renderer, moving_objects):
+    assert renderer.render(moving_objects, 0, 0) == \
+           renderer.render(moving_objects[:1] + moving_objects[1:], 0, 0)
+    assert renderer.render([], 0, 0) == '\n'.join(['-' * width] * height), \
+        'Previous frame leaks into the next one'
+
+
+@pytest.mark.parametrize('positive_noise, negative_noise', [
+    (50, 0), (0, 50), (25, 25)
+])
+def test_render_with_noise(renderer, positive_noise, negative_noise):
+    frame = renderer.render([], positive_noise, negative_noise)
+    lines = frame.split('\n')
+    assert len(lines) == height
+    for line in lines:
+        assert len(line) == width
+        assert line.count('o') <= int(width * positive_noise / 100), \
+            'Too much positive noise'
+
+
+@pytest.mark.parametrize('previous, current', [
+    ('----\n----', '----\n----'),
+    ('----\n----', 'o---\n---o'),
+    ('----\n----', '-o-o\n----'),
+    ('o-------o\n---------', '---------\n-o-----o-'),
+    ('oooo\noooo', '----\n----')
+])
+def test_delta(previous, current):
+    width = len(previous.split('\n')[0])
+    delta = make_delta(previous.encode(), current.encode(), width, max_gap=1)
+    assert not delta.keyframe
+    assert delta.apply(previous) == current, \
+        'Applying delta to the previous frame has to give the current one'
+    assert all('\n' not in text for _, _, text in delta.runs), \
+        'Runs must not cross row boundaries'
+
+
+def test_delta_merges_close_runs():
+    delta = make_delta(b'--------', b'o-o----o', 8, max_gap=1)
+    assert delta.runs == ((0, 0, 'o-o'), (0, 7, 'o'))
+
+
+def test_keyframe():
+    frame = 'o--\n-o-\n--o'
+    keyframe = make_keyframe(frame)
+    assert keyframe.keyframe
+    assert keyframe.apply(None) == frame
+
+
+def test_render_runs(renderer, moving_objects):
+    frame = renderer.render_runs(moving_objects, 3, 5)
+    assert frame.expand() == renderer.render(moving_objects, 0, 0)
+    assert frame.rows[0] == ('o-o-', (1, 1, 1, 9))
+    assert (frame.positive_noise, frame.negative_noise) == (3, 5), \
+        'Noise has to be left for the client'
+
+
+
+def test_render_both(renderer, moving_objects, monkeypatch):
+    compose = mock.Mock(wraps=renderer.compose)
+    monkeypatch.setattr(renderer, 'compose', compose)
+    frame, runs = renderer.render_both(moving_objects, 3, 5)
+    assert compose.call_count == 1, 'Objects have to be drawn once'
+    assert len(frame.split('\n')) == renderer.height
+    assert runs.expand() == renderer.render(moving_objects, 0, 0)
+    assert (runs.positive_noise, runs.negative_noise) == (3, 5)
+
+def test_runs_split_by_rows():
+    canvas = np.frombuffer(b'--o' b'oo1' b'111', dtype=np.uint8).reshape(3, 3)
+    assert encode_runs(canvas) == (('-o', (2, 1)),
+                                   ('o1', (2, 1)),
+                                   ('1', (3,)))
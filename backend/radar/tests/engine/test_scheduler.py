@@ -0,0 +1,145 @@
+import asyncio
+import pytest
+import time
+from unittest import mock
+
+from radar.engine.body_objects import BodyObjectsPool
+from radar.engine.moving_objects import MovingObject
+from radar.engine.scheduler import (
+    SubscriptionEnded, ZoneScheduler, tick_duration
+)
+from radar.engine.zone import Zone
+from radar.tests.engine.share import run_async
+
+
+pytestmark = pytest.mark.usefixtures('session_db_fix')
+
+
+@pytest.fixture
+def zone(monkeypatch):
+    zone = Zone([MovingObject(BodyObjectsPool().first)], 50, 50)
+    monkeypatch.setattr(zone, 'async_update_objects', mock.AsyncMock())
+    return zone
+
+
+@pytest.fixture
+def scheduler(zone):
+    scheduler = ZoneScheduler(tick_interval=0.01)
+    scheduler.add_zone('test', zone)
+    return scheduler
+
+
+def test_tick(scheduler, zone):
+    async def consume():
+        subscription = scheduler.subscribe('test', max_frames=2)
+        await scheduler.tick()
+        await scheduler.tick()
+        return await subscription.get(), await subscription.get()
+
+    first, second = run_async(consume())
+    assert (first.tick, second.tick) == (1, 2)
+    assert first.delta.keyframe and not second.delta.keyframe
+    assert second.delta.apply(first.image) == second.image
+    assert zone.async_update_objects.await_count == 2
+    assert scheduler.latest('test') == second
+
+
+def test_zone_is_advanced_once_for_all_subscribers(scheduler, zone):
+    async def consume():
+        subscriptions = [scheduler.subscribe('test') for _ in range(5)]
+        await scheduler.tick()
+        return [await subscription.get() for subscription in subscriptions]
+
+    frames = run_async(consume())
+    assert all(frame is frames[0] for frame in frames), \
+        'All the subscribers have to get the same frame'
+    assert zone.async_update_objects.await_count == 1
+
+
+def test_slow_subscriber_gets_latest_frames(scheduler):
+    async def consume():
+        subscription = scheduler.subscribe('test', max_frames=1)
+        for _ in range(3):
+            await scheduler.tick()
+        frame = await subscription.get()
+        subscription.close()
+        await scheduler.tick()
+        return subscription, frame
+
+    subscription, frame = run_async(consume())
+    assert frame.tick == 3, 'Only the latest frame has to be kept'
+    assert subscription.dropped == 2
+    assert scheduler.subscribers('test') == 0
+
+
+def test_new_subscriber_gets_last_frame(scheduler):
+    async def consume():
+        await scheduler.tick()
+        return await scheduler.subscribe('test').get()
+
+    assert run_async(consume()).tick == 1
+    with pytest.raises(KeyError):
+        scheduler.subscribe('unknown')
+
+
+def test_run_counts_overruns(scheduler, zone, monkeypatch):
+    draw_tick = zone.draw_tick
+
+    def slow_draw_tick():
+        time.sleep(scheduler.tick_interval * 2)
+        return draw_tick()
+    monkeypatch.setattr(zone, 'draw_tick', slow_draw_tick)
+    count = tick_duration.count
+
+    async def run():
+        scheduler.start()
+        await asyncio.sleep(scheduler.tick_interval * 5)
+        await scheduler.stop()
+
+    run_async(run())
+    assert scheduler.ticks > 1
+    assert scheduler.overruns >= scheduler.ticks - 1, \
+        'Ticks longer than the interval have to be counted'
+    assert tick_duration.count - count == scheduler.ticks
+
+
+def test_broken_zone_does_not_stop_others(scheduler, monkeypatch):
+    broken = Zone([MovingObject(BodyObjectsPool().first)], 50, 50)
+    monkeypatch.setattr(broken, 'async_update_objects', mock.AsyncMock())
+    monkeypatch.setattr(broken, 'move_objects',
+                        mock.Mock(side_effect=RuntimeError('broken')))
+    scheduler.add_zone('broken', broken)
+
+    async def run():
+        scheduler.start()
+        await asyncio.sleep(scheduler.tick_interval * 5)
+        running = not scheduler._task.done()
+        await scheduler.stop()
+        return running
+
+    running = run_async(run())
+    assert running, 'Errors of a zone must not stop the scheduler'
+    assert scheduler.ticks > 1
+    assert scheduler.latest('broken') is None
+    assert scheduler.latest('test').tick == scheduler.ticks
+
+
+def test_removing_zone_ends_subscriptions(scheduler):
+    async def consume():
+        subscription = scheduler.subscribe('test', max_frames=2)
+        await scheduler.tick()
+        waiting = asyncio.ensure_future(subscription.get())
+        await asyncio.sleep(0)
+        first = waiting.result()
+        waiting = asyncio.ensure_future(subscription.get())
+        await asyncio.sleep(0)
+        scheduler.remove_zone('test')
+        with pytest.raises(SubscriptionEnded):
+            await waiting
+        with pytest.raises(SubscriptionEnded):
+            await subscription.get()
+        return first, [frame async for frame in subscription]
+
+    first, rest = run_async(consume())
+    assert first.tick == 1 and rest == []
+    assert scheduler.subscribers('test') == 0
@@ -0,0 +1,48 @@
+import pytest
+from radar.engine.spatial import SpatialIndex, Box
+
+
+@pytest.fixture
+def index():
+    index = SpatialIndex(bucket_size=4)
+    index.insert('a', 0, 0, 3, 3)
+    index.insert('b', 5, 1, 4, 2)
+    index.insert('c', 10, 10, 2, 2)
+    return index
+
+
+@pytest.mark.parametrize('region, expected', [
+    [(0, 0, 20, 20), {'a', 'b', 'c'}],
+    [(2, 2, 1, 1), {'a'}],
+    [(3, 0, 2, 10), set()],
+    [(4, 0, 2, 2), {'b'}],
+    [(8, 2, 4, 9), {'b', 'c'}],
+    [(-5, -5, 5, 5), set()]
+])
+def test_query(index, region, expected):
+    assert set(index.query(*region)) == expected, \
+        f'Wrong items found in region {region}'
+
+
+def test_move(index):
+    index.move('a', 9, 9)
+    assert index.box('a') == Box(9, 9, 3, 3)
+    assert set(index.query(0, 0, 3, 3)) == set()
+    assert set(index.query(9, 9, 2, 2)) == {'a', 'c'}
+
+    index.move('c', 11, 10)
+    assert set(index.query(12, 10, 1, 1)) == {'c'}
+
+
+def test_remove(index):
+    index.remove('b')
+    assert 'b' not in index
+    assert len(index) == 2
+    assert index.query(5, 1, 4, 2) == []
+
+
+def test_insert_replaces(index):
+    index.insert('c', 0, 8, 1, 1)
+    assert len(index) == 3
+    assert index.query(10, 10, 2, 2) == []
+    assert index.query(0, 8, 1, 1) == ['c']
@@ -1,13 +1,17 @@
 import pytest
 import random
+import time
 from unittest import mock
 from collections import namedtuple
-from radar.engine.body_objects import BodyObjectsPool, BodyObject
+from radar.engine.body_objects import (
+    AsyncBodyObjectsPool, BodyObjectsPool, BodyObject, BodiesCursor
+)
 from radar.engine.zone import (
-    Zone, ZoneBuilder, ObjectRequest, TooManyMovingObjectsError
+    Zone, ZoneBuilder, ObjectRequest, TooManyMovingObjectsError,
+    admission_latency
 )
 from radar.engine.moving_objects import MovingObject
-from radar.tests.engine.share import assert_pos_moved
+from radar.tests.engine.share import assert_pos_moved, run_async
 
 
 pytestmark = pytest.mark.usefixtures('session_db_fix')
@@ -152,6 +156,29 @@ def _drawing_test(def_zone, draw_func):
     assert str1 != str2
 
 
+def test_draw_delta(def_zone):
+    def_zone.keyframe_interval = 2
+    first = def_zone.draw_delta()
+    assert first.keyframe, 'The first delta frame has to be a keyframe'
+    frame = first.apply(None)
+    assert len(frame.splitlines()) == def_zone.height
+
+    # frames between keyframes are deltas: K, D, K with the interval of 2
+    for _ in range(def_zone.keyframe_interval - 1):
+        def_zone.move_objects()
+        delta = def_zone.draw_delta()
+        assert not delta.keyframe
+        frame = delta.apply(frame)
+        assert len(frame) == len(first.apply(None))
+    assert frame.encode() == def_zone._previous_frame, \
+        'Applied deltas diverged from the drawn frames'
+    assert def_zone.draw_delta().keyframe, \
+        'Keyframes have to be sent every keyframe_interval frames'
+
+    def_zone.request_keyframe()
+    assert def_zone.draw_delta().keyframe
+
+
 def test_move_objects(def_zone):
     objects_before_move = def_zone.moving_objects
     def_zone.move_objects()
@@ -162,6 +189,55 @@ def test_move_objects(def_zone):
         assert_pos_moved(old_pos, new_pos, direction, fail_on_unmoved=False)
 
 
+def test_moving_objects_snapshot(def_zone):
+    snapshot = def_zone.moving_objects
+    with pytest.raises(AttributeError):
+        snapshot[0].position = None
+    def_zone.move_objects()
+    assert [obj.position for obj in snapshot] != \
+           [obj.position for obj in def_zone.moving_objects], \
+        'Snapshot has to keep the state it was taken at'
+    assert all(old.body is new.body for old, new
+               in zip(snapshot, def_zone.moving_objects)), \
+        'Snapshots have to share bodies instead of copying them'
+
+
+def test_clone_moving_objects(def_zone):
+    clones = def_zone.clone_moving_objects()
+    positions = [obj.position for obj in def_zone.moving_objects]
+    assert [obj.position for obj in clones] == positions
+    for obj in clones:
+        obj.move()
+    assert [obj.position for obj in def_zone.moving_objects] == positions, \
+        'Moving clones must not affect the zone'
+
+
+def test_move_objects_keeps_vacancy(def_zone):
+    for _ in range(20):
+        def_zone.move_objects()
+    expected = [[True] * def_zone.width for _ in range(def_zone.height)]
+    for obj in def_zone.moving_objects:
+        for y in range(obj.position.y, obj.position.y + obj.height):
+            for x in range(obj.position.x, obj.position.x + obj.width):
+                assert expected[y][x], 'Moving objects overlap'
+                expected[y][x] = False
+    assert def_zone._position_vacancy.tolist() == expected, \
+        'Position vacancy went out of sync with moving objects'
+
+
+def test_objects_in_region(def_zone):
+    def_zone.move_objects()
+    for obj in def_zone.moving_objects:
+        x, y = obj.position
+        found = def_zone.objects_in_region(x, y, obj.width, obj.height)
+        assert [(o.body, o.position) for o in found] \
+            == [(obj.body, obj.position)], \
+            'Objects have to be found exactly at their own region'
+    assert len(def_zone.objects_in_region(0, 0, def_zone.width,
+                                          def_zone.height)) \
+        == len(def_zone.moving_objects)
+
+
 @pytest.mark.parametrize('zone_provider, profile', [
     ['request_small_zone', ZoneBuilder.small_zone_profile],
     ['request_medium_zone', ZoneBuilder.medium_zone_profile],
@@ -182,9 +258,70 @@ def test_update_objects(body_pool, new_body):
     body_pool.update_bodies = mock.Mock(
         return_value={'dropped_keys': known_expired_keys,
                       'new_records': {key: new_body for key
-                                      in unknown_live_keys}}
+                                      in unknown_live_keys},
+                      'arrivals': {key: time.time() * 1000 for key
+                                   in unknown_live_keys},
+                      'cursor': None}
     )
     zone = Zone([MovingObject(BodyObject.generate(key, new_body))
                  for key in known_keys], 50, 50)
+    admissions = admission_latency.count
     zone.update_objects()
     assert set(obj.body.key for obj in zone.moving_objects) == live_keys
+    assert admission_latency.count == admissions + len(unknown_live_keys), \
+        'Latency of placing new bodies has to be recorded'
+    assert all(obj.position is not None for obj in zone.moving_objects), \
+        'New objects have to be placed in the zone'
+    assert all(zone.find_object(key) is not None for key in live_keys)
+    assert all(zone.find_object(key) is None for key in known_expired_keys)
+
+
+def test_update_objects_without_space(body_pool, new_body):
+    body_pool.update_bodies = mock.Mock(
+        return_value={'dropped_keys': [],
+                      'new_records': {'new': new_body},
+                      'arrivals': {'new': time.time() * 1000},
+                      'cursor': BodiesCursor(1, None)}
+    )
+    body = BodyObject.generate('old', new_body)
+    zone = Zone([MovingObject(body)], body.width * 2, body.height,
+                position_vacancy=[[False] * body.width * 2] * body.height)
+    admissions = admission_latency.count
+    zone.update_objects()
+    assert admission_latency.count == admissions
+    assert zone.find_object('new') is None, \
+        "Objects that don't fit in the zone must not be attached"
+    zone.update_objects()
+    assert body_pool.update_bodies.call_args[0][2] is None, \
+        "Bodies that didn't fit in the zone have to be requested again"
+
+
+def test_draw_compact(def_zone):
+    frame = def_zone.draw_compact()
+    assert frame.expand() == def_zone.draw(0, 0)
+    assert len(frame.rows) == def_zone.height
+
+
+
+def test_draw_tick(def_zone):
+    image, delta, compact = def_zone.draw_tick(0, 0)
+    assert delta.keyframe and delta.apply(None) == image
+    assert compact.expand() == image
+    _, delta, _ = def_zone.draw_tick(0, 0)
+    assert delta.apply(image) == def_zone.draw(0, 0)
+
+def test_async_update_image(new_body, monkeypatch):
+    update_bodies = mock.AsyncMock(
+        return_value={'dropped_keys': [],
+                      'new_records': {'new': new_body},
+                      'arrivals': {'new': time.time() * 1000},
+                      'cursor': None}
+    )
+    monkeypatch.setattr(AsyncBodyObjectsPool(), 'update_bodies',
+                        update_bodies)
+    body = BodyObject.generate('old', new_body)
+    zone = Zone([MovingObject(body)], 50, 50)
+    image = run_async(zone.async_update_image())
+    assert len(image.splitlines()) == zone.height
+    assert zone.find_object('new') is not None
+    update_bodies.assert_awaited_once()
@@ -0,0 +1,370 @@
+import asyncio
+import json
+import pytest
+from unittest import mock
+
+from redis import RedisError
+
+from radar.asgi import RadarApplication
+from radar.engine.body_objects import (
+    AsyncBodyObjectsPool, BodyEventsListener, BodyObjectsPool
+)
+from radar.engine.frame_cache import FrameCache
+from radar.engine.moving_objects import MovingObject
+from radar.engine.rendering import FrameDelta
+from radar.engine.scheduler import ZoneScheduler
+from radar.engine.zone import Zone
+from radar.tests.engine.share import run_async
+
+
+pytestmark = pytest.mark.usefixtures('session_db_fix')
+
+
+@pytest.fixture
+def application(monkeypatch):
+    # the body events listener started with the application stops sooner
+    monkeypatch.setattr(BodyEventsListener, 'reconnect_delay', 0.01)
+    monkeypatch.setattr(BodyEventsListener, 'purge_interval', 0.01)
+    zone = Zone([MovingObject(BodyObjectsPool().first)], 50, 50)
+    monkeypatch.setattr(zone, 'async_update_objects', mock.AsyncMock())
+    scheduler = ZoneScheduler(tick_interval=0.01)
+    scheduler.add_zone('test', zone)
+    django_application = mock.AsyncMock()
+    application = RadarApplication(django_application, scheduler,
+                                   FrameCache())
+    application.zone_requests = {}
+    yield application
+    BodyObjectsPool().unsubscribe()
+
+
+def http_scope(path, query_string=b''):
+    return {'type': 'http', 'method': 'GET', 'path': path, 'headers': [],
+            'query_string': query_string}
+
+
+def parse_events(messages):
+    events = []
+    for message in messages:
+        if message['type'] == 'http.response.body' and message['body']:
+            event, data = message['body'].decode().strip().split('\n')
+            assert event == 'event: frame'
+            events.append(json.loads(data[len('data: '):]))
+    return events
+
+
+def test_stream_frames(application):
+    sent = []
+
+    async def stream():
+        received = asyncio.Queue()
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 4:
+                await received.put({'type': 'http.disconnect'})
+        try:
+            await asyncio.wait_for(application(
+                http_scope('/zones/test/frames/'), received.get, send), 1)
+        finally:
+            await application.scheduler.stop()
+
+    run_async(stream())
+    assert sent[0]['status'] == 200
+    assert (b'content-type', b'text/event-stream') in sent[0]['headers']
+    events = parse_events(sent)
+    assert len(events) == 3
+    assert events[0]['keyframe'] and 'image' in events[0], \
+        'The first frame of a stream has to be a keyframe'
+    frame = None
+    for previous, event in zip([None, *events], events):
+        if 'image' in event:
+            frame = event['image']
+        else:
+            assert event['tick'] == previous['tick'] + 1, \
+                'Deltas can only follow the frame of the previous tick'
+            frame = FrameDelta(False, event['runs']).apply(frame)
+        assert len(frame.split('\n')) == 50
+    assert application.scheduler.subscribers('test') == 0, \
+        'Subscription has to be closed when the client disconnects'
+
+
+def test_stream_compact_frames(application):
+    sent = []
+
+    async def stream():
+        received = asyncio.Queue()
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 3:
+                await received.put({'type': 'http.disconnect'})
+        try:
+            await asyncio.wait_for(application(
+                http_scope('/zones/test/frames/', b'format=compact'),
+                received.get, send), 1)
+        finally:
+            await application.scheduler.stop()
+
+    run_async(stream())
+    events = parse_events(sent)
+    assert len(events) == 2
+    assert all('rows' in event and 'noise' in event for event in events), \
+        'Compact clients have to get all the frames run-length encoded'
+    assert len(events[0]['rows']) == 50
+
+
+def test_stream_ends_when_zone_is_removed(application):
+    sent = []
+
+    async def stream():
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 2:
+                application.scheduler.remove_zone('test')
+        try:
+            await asyncio.wait_for(application(
+                http_scope('/zones/test/frames/'), asyncio.Queue().get,
+                send), 1)
+        finally:
+            await application.scheduler.stop()
+
+    run_async(stream())
+    assert len(parse_events(sent)) == 1
+    assert sent[-1] == {'type': 'http.response.body', 'body': b''}, \
+        'The response has to be finished when the zone is removed'
+
+
+
+def test_frames_of_removed_zone_are_forgotten(application):
+    scheduler = application.scheduler
+    run_async(scheduler.tick())
+    application.frame_cache.encode(scheduler.latest('test'))
+    scheduler.remove_zone('test')
+    assert application.frame_cache.get('test', 1) is None, \
+        'Frames of removed zones must not be kept'
+
+
+def test_unknown_zone(application):
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    async def stream():
+        try:
+            await application(http_scope('/zones/unknown/frames/'),
+                              asyncio.Queue().get, send)
+        finally:
+            await application.scheduler.stop()
+
+    run_async(stream())
+    assert sent[0]['status'] == 404
+
+
+def test_other_requests_go_to_django(application):
+    scope = http_scope('/health/scripts/')
+    run_async(application(scope, None, None))
+    application.django_application.assert_awaited_once_with(scope, None,
+                                                            None)
+
+
+def test_lifespan(application, monkeypatch):
+    sent = []
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+
+    async def receive():
+        if messages[0]['type'] == 'lifespan.shutdown':
+            # let the scheduler run before shutting it down
+            await asyncio.sleep(0.05)
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    subscribe = mock.Mock(wraps=BodyObjectsPool().subscribe)
+    unsubscribe = mock.Mock(wraps=BodyObjectsPool().unsubscribe)
+    monkeypatch.setattr(BodyObjectsPool(), 'subscribe', subscribe)
+    monkeypatch.setattr(BodyObjectsPool(), 'unsubscribe', unsubscribe)
+    run_async(application({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert application.scheduler.ticks > 0
+    subscribe.assert_called_once_with()
+    unsubscribe.assert_called_once_with()
+
+
+def websocket_scope(path):
+    return {'type': 'websocket', 'path': path, 'headers': []}
+
+
+def test_frames_socket(application, monkeypatch):
+    add_body = mock.AsyncMock(side_effect=[None, ValueError('Too wide')])
+    ping_bodies = mock.AsyncMock(return_value={'1': False})
+    monkeypatch.setattr(AsyncBodyObjectsPool(), 'add_body', add_body)
+    monkeypatch.setattr(AsyncBodyObjectsPool(), 'ping_bodies', ping_bodies)
+    sent = []
+
+    async def talk():
+        received = asyncio.Queue()
+        for message in ({'type': 'add', 'id': 1, 'body': 'o'},
+                        {'type': 'add', 'id': 2, 'body': 'ooo'},
+                        {'type': 'ping', 'id': 1}):
+            received.put_nowait({'type': 'websocket.receive',
+                                 'text': json.dumps(message)})
+        received.put_nowait({'type': 'websocket.receive', 'text': 'oops'})
+
+        async def receive():
+            if not sent:
+                return {'type': 'websocket.connect'}
+            if received.empty():
+                # let a few frames be sent before disconnecting
+                await asyncio.sleep(0.05)
+                return {'type': 'websocket.disconnect'}
+            return received.get_nowait()
+
+        async def send(message):
+            sent.append(message)
+        try:
+            await application(websocket_scope('/zones/test/socket/'),
+                              receive, send)
+        finally:
+            await application.scheduler.stop()
+
+    run_async(talk())
+    assert sent[0] == {'type': 'websocket.accept'}
+    messages = [json.loads(message['text']) for message in sent[1:]]
+    replies = [message for message in messages if 'type' in message]
+    assert replies == [
+        {'type': 'added', 'id': '1'},
+        {'type': 'error', 'id': '2', 'error': 'Too wide'},
+        {'type': 'pinged', 'id': '1', 'alive': False},
+        {'type': 'error', 'error': 'Invalid message'},
+    ]
+    add_body.assert_any_await('o', '1')
+    frames = [message for message in messages if 'tick' in message]
+    assert frames and 'image' in frames[0]
+    assert application.scheduler.subscribers('test') == 0
+
+
+def test_frames_socket_rejects_malformed_bodies(application, monkeypatch):
+    ping_bodies = mock.AsyncMock(return_value={'1': True})
+    monkeypatch.setattr(AsyncBodyObjectsPool(), 'ping_bodies', ping_bodies)
+    sent = []
+
+    async def talk():
+        received = asyncio.Queue()
+        for message in ({'type': 'add', 'id': 1, 'body': ''},
+                        {'type': 'add', 'id': 2},
+                        {'type': 'add', 'id': 3, 'body': ['o']},
+                        {'type': 'ping', 'id': 1}):
+            received.put_nowait({'type': 'websocket.receive',
+                                 'text': json.dumps(message)})
+
+        async def receive():
+            if not sent:
+                return {'type': 'websocket.connect'}
+            if received.empty():
+                await asyncio.sleep(0.05)
+                return {'type': 'websocket.disconnect'}
+            return received.get_nowait()
+
+        async def send(message):
+            sent.append(message)
+        try:
+            await application(websocket_scope('/zones/test/socket/'),
+                              receive, send)
+        finally:
+            await application.scheduler.stop()
+
+    run_async(talk())
+    assert all(message['type'] != 'websocket.close' for message in sent), \
+        'Malformed bodies must not close the socket'
+    messages = [json.loads(message['text']) for message in sent[1:]]
+    replies = [message for message in messages if 'type' in message]
+    assert replies == [
+        {'type': 'error', 'id': '1', 'error': "Body string can't be empty"},
+        {'type': 'error', 'id': '2', 'error': 'Body has to be a string'},
+        {'type': 'error', 'id': '3', 'error': 'Body has to be a string'},
+        {'type': 'pinged', 'id': '1', 'alive': True},
+    ]
+
+
+
+def test_socket_is_closed_when_frames_fail(application, monkeypatch):
+    monkeypatch.setattr(application.frame_cache, 'encode',
+                        mock.Mock(side_effect=RedisError('Gone')))
+    sent = []
+
+    async def receive():
+        if not sent:
+            return {'type': 'websocket.connect'}
+        # the client only waits for frames
+        return await asyncio.Queue().get()
+
+    async def send(message):
+        sent.append(message)
+
+    async def talk():
+        try:
+            await asyncio.wait_for(application(
+                websocket_scope('/zones/test/socket/'), receive, send), 1)
+        finally:
+            await application.scheduler.stop()
+
+    run_async(talk())
+    assert sent == [{'type': 'websocket.accept'},
+                    {'type': 'websocket.close',
+                     'code': application.failed_frames_close_code}], \
+        "Sockets that can't be sent frames have to be closed"
+    assert application.scheduler.subscribers('test') == 0
+
+def test_slow_socket_gets_latest_frame(application):
+    sent = []
+
+    async def talk():
+        connected = asyncio.Event()
+        scheduler = application.scheduler
+        # the scheduler is advanced by hand here
+        application._started = True
+
+        async def receive():
+            if not connected.is_set():
+                connected.set()
+                return {'type': 'websocket.connect'}
+            for _ in range(3):
+                await scheduler.tick()
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.05)
+            return {'type': 'websocket.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if message['type'] == 'websocket.send':
+                # the client takes longer than all the ticks to get a frame
+                await asyncio.sleep(0.02)
+        await application(websocket_scope('/zones/test/socket/'),
+                          receive, send)
+
+    run_async(talk())
+    ticks = [json.loads(message['text'])['tick'] for message in sent[1:]]
+    assert ticks == [1, 3], 'Frames a slow client missed have to be dropped'
+
+
+def test_unknown_zone_socket(application):
+    sent = []
+
+    async def receive():
+        return {'type': 'websocket.connect'}
+
+    async def send(message):
+        sent.append(message)
+
+    async def talk():
+        try:
+            await application(websocket_scope('/zones/unknown/socket/'),
+                              receive, send)
+        finally:
+            await application.scheduler.stop()
+
+    run_async(talk())
+    assert sent == [{'type': 'websocket.close',
+                     'code': application.unknown_zone_close_code}]
@@ -0,0 +1,20 @@
+import pytest
+import redis
+from backend import settings
+
+
+@pytest.fixture
+def r():
+    return redis.Redis(host=settings.REDIS_HOSTNAME)
+
+
+def test_scripts_health(client, r):
+    response = client.get('/health/scripts/')
+    assert response.status_code == 200
+    assert all(response.json()['scripts'].values())
+
+    r.script_flush()
+    response = client.get('/health/scripts/')
+    assert response.status_code == 503, \
+        'Missing scripts have to be reported'
+    assert not any(response.json()['scripts'].values())
@@ -3,8 +3,16 @@ body_max_height = 15
 
 
 def validate_body_str_profile(body: str):
+    if not isinstance(body, (str, bytes)):
+        raise ValueError("Body string has to be a string")
     body_lines = body.splitlines()
+    if not body_lines:
+        raise ValueError("Body string can't be empty")
     width = len(body_lines[0])
     height = len(body_lines)
     if width > body_max_width or height > body_max_height:
         raise ValueError("Body string is too big")
+    if any(len(line) != width for line in body_lines):
+        raise ValueError("Body string lines have to be of the same length")
+    if not body.isascii():
+        raise ValueError("Body string has to consist of ASCII symbols")
@@ -1,3 +1,20 @@
-from django.shortcuts import render
+from django.http import JsonResponse
+from redis import RedisError
 
-# Create your views here.
+from caching.backends import get_scripts_pool
+
+
+def scripts_health(request):
+    """
+    Report which of the Lua scripts Redis has and their versions;
+    respond with 503 if Redis is missing any of them
+    """
+    scripts_pool = get_scripts_pool()
+    try:
+        scripts = scripts_pool.health_check()
+    except RedisError:
+        return JsonResponse({'redis': False}, status=503)
+    return JsonResponse({'redis': True,
+                         'scripts': scripts,
+                         'versions': scripts_pool.versions()},
+                        status=200 if all(scripts.values()) else 503)
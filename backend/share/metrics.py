@@ -0,0 +1,117 @@
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from share.metaclasses import Singleton
+
+
+class LatencyMetric:
+    """
+    Summary of the latest latency samples of some process (in seconds),
+    kept in a window of fixed size
+    """
+
+    def __init__(self, name: str, window: int = 1024):
+        self.name = name
+        self.count = 0
+        """Number of all the samples ever recorded"""
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Get q-th percentile (0 <= q <= 100) of the samples in the window"""
+        with self._lock:
+            samples = sorted(self._samples)
+        return _percentile(samples, q)
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        with self._lock:
+            samples = sorted(self._samples)
+            count = self.count
+        return {'count': count,
+                'mean': sum(samples) / len(samples) if samples else None,
+                'p50': _percentile(samples, 50),
+                'p95': _percentile(samples, 95),
+                'max': samples[-1] if samples else None}
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self.count = 0
+
+
+class HitRateMetric:
+    """Share of lookups of some cache that found what they looked for"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    @property
+    def rate(self) -> Optional[float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return self.hits / lookups if lookups else None
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {'hits': hits, 'misses': misses,
+                'rate': hits / (hits + misses) if hits + misses else None}
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+class Metrics(metaclass=Singleton):
+    """
+    Metrics of the process by their names
+    """
+
+    def __init__(self):
+        self._latencies: Dict[str, LatencyMetric] = {}
+        self._hit_rates: Dict[str, HitRateMetric] = {}
+        self._lock = threading.Lock()
+
+    def latency(self, name: str) -> LatencyMetric:
+        """Get the latency metric with the name, creating it if needed"""
+        with self._lock:
+            if name not in self._latencies:
+                self._latencies[name] = LatencyMetric(name)
+            return self._latencies[name]
+
+    def hit_rate(self, name: str) -> HitRateMetric:
+        """Get the hit rate metric with the name, creating it if needed"""
+        with self._lock:
+            if name not in self._hit_rates:
+                self._hit_rates[name] = HitRateMetric(name)
+            return self._hit_rates[name]
+
+    def summary(self) -> Dict[str, Dict[str, Optional[float]]]:
+        with self._lock:
+            metrics = [*self._latencies.values(), *self._hit_rates.values()]
+        return {metric.name: metric.summary() for metric in metrics}
+
+
+def _percentile(sorted_samples, q):
+    if not sorted_samples:
+        return None
+    index = min(int(len(sorted_samples) * q / 100), len(sorted_samples) - 1)
+    return sorted_samples[index]
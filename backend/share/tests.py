@@ -1,4 +1,5 @@
 from share.metaclasses import Singleton
+from share.metrics import HitRateMetric, LatencyMetric, Metrics
 
 
 def test_singleton():
@@ -14,3 +15,36 @@ def test_singleton():
     obj3 = SingleObj2()
     assert obj1 != obj3, \
         'Singleton has created a single instance for two different classes'
+
+
+def test_latency_metric():
+    metric = LatencyMetric('test', window=100)
+    assert metric.percentile(50) is None
+    for i in range(200):
+        metric.record(i)
+    assert metric.count == 200
+    summary = metric.summary()
+    assert summary['max'] == 199
+    assert summary['p50'] == 150, 'Only the latest samples have to be kept'
+    assert metric.percentile(95) == 195
+
+    metric.reset()
+    assert metric.summary()['count'] == 0
+
+
+def test_metrics():
+    metric = Metrics().latency('test')
+    assert Metrics().latency('test') is metric
+    metric.record(1)
+    assert Metrics().summary()['test']['count'] == metric.count
+
+
+def test_hit_rate_metric():
+    metric = HitRateMetric('test')
+    assert metric.rate is None
+    for _ in range(3):
+        metric.hit()
+    metric.miss()
+    assert metric.rate == 0.75
+    assert metric.summary() == {'hits': 3, 'misses': 1, 'rate': 0.75}
+    assert Metrics().hit_rate('test_hits') is Metrics().hit_rate('test_hits')
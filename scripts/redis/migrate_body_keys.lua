@@ -0,0 +1,47 @@
+--[[
+    Move bodies stored as separate string keys with expiration time
+    into the body registry, and make bodies that are already in the registry
+    but have no arrival time arrive now
+    :param KEYS[1]: hash of body strings by body keys
+    :param KEYS[2]: sorted set of body keys scored by their expiry time (ms)
+    :param KEYS[3]: generation of the body set, bumped whenever bodies are
+                    added or removed
+    :param KEYS[4]: channel to publish body events to
+    :param KEYS[5]: sorted set of body keys scored by their arrival time (ms)
+    :param ARGV[1]: pattern of the body keys
+    :returns number of moved bodies
+]]
+redis.replicate_commands()
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local cursor = "0"
+local moved = 0
+local added = {}
+
+repeat
+    local keys
+    cursor, keys = unpack(redis.call("SCAN", cursor, "MATCH", ARGV[1]))
+    for _, key in ipairs(keys) do
+        local ttl = redis.call("PTTL", key)
+        if ttl > 0 and redis.call("TYPE", key).ok == "string" then
+            redis.call("HSET", KEYS[1], key, redis.call("GET", key))
+            redis.call("ZADD", KEYS[2], now + ttl, key)
+            redis.call("ZADD", KEYS[5], "NX", now, key)
+            added[key] = redis.call("HGET", KEYS[1], key)
+            redis.call("DEL", key)
+            moved = moved + 1
+        end
+    end
+until cursor == "0"
+
+local registered = redis.call("ZRANGE", KEYS[2], 0, -1)
+for _, key in ipairs(registered) do
+    redis.call("ZADD", KEYS[5], "NX", now, key)
+end
+
+if moved > 0 then
+    redis.call("INCR", KEYS[3])
+    redis.call("PUBLISH", KEYS[4], cjson.encode({added = added, arrived = now}))
+end
+
+return moved
@@ -0,0 +1,25 @@
+--[[
+    Reset expiration time of bodies in the body registry
+    :param KEYS[1]: sorted set of body keys scored by their expiry time (ms)
+    :param ARGV[1]: body expiration time in seconds
+    :param ARGV[2...]: body keys
+    :returns array with 1 for every body that was pinged and 0 for every body
+             that has already expired or never existed
+]]
+redis.replicate_commands()
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local expiry = now + tonumber(ARGV[1]) * 1000
+local reply = {}
+
+for i = 2, #ARGV do
+    local score = redis.call("ZSCORE", KEYS[1], ARGV[i])
+    if score and tonumber(score) > now then
+        redis.call("ZADD", KEYS[1], "XX", expiry, ARGV[i])
+        table.insert(reply, 1)
+    else
+        table.insert(reply, 0)
+    end
+end
+
+return reply
@@ -0,0 +1,27 @@
+--[[
+    Remove expired bodies from the body registry
+    :param KEYS[1]: hash of body strings by body keys
+    :param KEYS[2]: sorted set of body keys scored by their expiry time (ms)
+    :param KEYS[3]: generation of the body set, bumped whenever bodies are
+                    added or removed
+    :param KEYS[4]: channel to publish body events to
+    :param KEYS[5]: sorted set of body keys scored by their arrival time (ms)
+    :returns array of removed body keys
+]]
+redis.replicate_commands()
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local expired = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", now)
+for i = 1, #expired, 1000 do
+    local last = math.min(i + 999, #expired)
+    redis.call("HDEL", KEYS[1], unpack(expired, i, last))
+    redis.call("ZREM", KEYS[5], unpack(expired, i, last))
+end
+redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", now)
+if #expired > 0 then
+    redis.call("INCR", KEYS[3])
+    redis.call("PUBLISH", KEYS[4], cjson.encode({expired = expired}))
+end
+
+return expired
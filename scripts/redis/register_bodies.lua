@@ -0,0 +1,32 @@
+--[[
+    Add bodies to the body registry or replace them there
+    :param KEYS[1]: hash of body strings by body keys
+    :param KEYS[2]: sorted set of body keys scored by their expiry time (ms)
+    :param KEYS[3]: generation of the body set, bumped whenever bodies are
+                    added or removed
+    :param KEYS[4]: channel to publish body events to
+    :param KEYS[5]: sorted set of body keys scored by their arrival time (ms)
+    :param ARGV[1]: body expiration time in seconds
+    :param ARGV[2...]: body keys, each followed by its body string
+    :returns number of registered bodies
+]]
+redis.replicate_commands()
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local expiry = now + tonumber(ARGV[1]) * 1000
+
+local added = {}
+
+for i = 2, #ARGV, 2 do
+    redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+    redis.call("ZADD", KEYS[2], expiry, ARGV[i])
+    -- replacing a body doesn't make it arrive again
+    redis.call("ZADD", KEYS[5], "NX", now, ARGV[i])
+    added[ARGV[i]] = ARGV[i + 1]
+end
+redis.call("INCR", KEYS[3])
+if #ARGV > 1 then
+    redis.call("PUBLISH", KEYS[4], cjson.encode({added = added, arrived = now}))
+end
+
+return (#ARGV - 1) / 2
@@ -0,0 +1,86 @@
+--[[
+    Get a json string that represents what has to be changed in given known
+    keys, looking them up in the body registry instead of the whole keyspace
+    :param KEYS[1]: hash of body strings by body keys
+    :param KEYS[2]: sorted set of body keys scored by their expiry time (ms)
+    :param KEYS[3]: generation of the body set, bumped whenever bodies are
+                    added or removed
+    :param KEYS[4]: channel to publish body events to
+    :param KEYS[5]: sorted set of body keys scored by their arrival time (ms)
+    :param ARGV[1]: the maximum number of live keys that have to be processed
+    :param ARGV[2...]: all the already known keys
+    :returns json object reply:
+        reply.dropped_keys: array of keys that expired and have to be deleted
+                            from known keys
+        reply.new_records: object with key-value pairs that have to be added to
+                           known keys, taken in the order the bodies arrived
+        reply.arrivals: array of [key, arrival time (ms)] pairs of the new
+                        records in the order the bodies arrived
+        reply.generation: generation of the body set the reply is based on
+        reply.next_expiry: the earliest expiry time (ms) among live bodies,
+                           or null if there are none
+]]
+redis.replicate_commands()
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+-- forget expired bodies
+local expired = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", now)
+for i = 1, #expired, 1000 do
+    local last = math.min(i + 999, #expired)
+    redis.call("HDEL", KEYS[1], unpack(expired, i, last))
+    redis.call("ZREM", KEYS[5], unpack(expired, i, last))
+end
+redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", now)
+if #expired > 0 then
+    redis.call("INCR", KEYS[3])
+    redis.call("PUBLISH", KEYS[4], cjson.encode({expired = expired}))
+end
+
+local reply = {}
+reply.dropped_keys = {}
+reply.new_records = {}
+reply.arrivals = {}
+local max_relevant_keys = tonumber(ARGV[1])
+local keys_to_add = max_relevant_keys - (#ARGV - 1)
+
+-- find all the dropped keys
+local known_keys_contain = {}
+for i = 2, #ARGV do
+    local key = ARGV[i]
+    known_keys_contain[key] = true
+    if not redis.call("ZSCORE", KEYS[2], key) then
+        table.insert(reply.dropped_keys, key)
+        keys_to_add = keys_to_add + 1
+    end
+end
+
+-- if there is a need to add more keys - take the earliest arrived ones
+if keys_to_add > 0 then
+    local batch_size = math.max(max_relevant_keys, 1)
+    local offset = 0
+    local arrivals
+    repeat
+        arrivals = redis.call("ZRANGE", KEYS[5], offset,
+                              offset + batch_size - 1, "WITHSCORES")
+        for i = 1, #arrivals, 2 do
+            local key = arrivals[i]
+            if not known_keys_contain[key] then
+                reply.new_records[key] = redis.call("HGET", KEYS[1], key)
+                table.insert(reply.arrivals,
+                             {key, tonumber(arrivals[i + 1])})
+                keys_to_add = keys_to_add - 1
+                if keys_to_add == 0 then
+                    break
+                end
+            end
+        end
+        offset = offset + batch_size
+    until keys_to_add == 0 or #arrivals < batch_size * 2
+end
+
+reply.generation = tonumber(redis.call("GET", KEYS[3]) or 0)
+local earliest = redis.call("ZRANGE", KEYS[2], 0, 0, "WITHSCORES")
+reply.next_expiry = earliest[2] and tonumber(earliest[2]) or cjson.null
+
+return cjson.encode(reply)